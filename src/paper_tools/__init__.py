@@ -1 +1 @@
-__all__ = ["inspirehep_tools", "latex_tools", "lmdb_wrapper", "config", "analytic"]
+__all__ = ["inspirehep_tools", "latex_tools", "latex_batch", "lmdb_wrapper", "config", "analytic", "embedding_server", "lexical_index", "citation_index", "column_store", "record_query", "record_index"]
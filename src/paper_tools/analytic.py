@@ -1,42 +1,679 @@
-import re
-import networkx as nx
+import os
+import array
+import collections
+import heapq
+import concurrent.futures
+import multiprocessing
+import numpy as np
+import scipy.sparse
+import paper_tools.citation_index as citation_index
+
+
+class CitationGraph:
+    """Compact citation graph with integer node IDs.
+
+    Node n corresponds to the record ID ids[n]; adjacency is a CSR matrix whose
+    row n holds the out-edges of node n (each stored with weight 1).
+    """
+
+    def __init__(self, ids, adjacency: scipy.sparse.csr_matrix):
+        self.ids = np.asarray(ids, dtype=object)
+        self.index_of = {rec_id: n for n, rec_id in enumerate(self.ids)}
+        self.adjacency = adjacency
+
+    @classmethod
+    def from_edges(cls, ids, sources, targets):
+        """Build a graph over ids from parallel arrays of integer edge endpoints. Duplicate edges are merged."""
+        n = len(ids)
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        adjacency = scipy.sparse.csr_matrix(
+            (np.ones(len(sources), dtype=np.float64), (sources, targets)), shape=(n, n))
+        adjacency.sum_duplicates()
+        adjacency.data[:] = 1.0
+        return cls(ids, adjacency)
+
+    @classmethod
+    def from_adjacency(cls, adjacency: dict):
+        """Build a graph from {id: [referenced ids]}; references outside the dict are dropped."""
+        ids = list(adjacency)
+        index_of = {rec_id: n for n, rec_id in enumerate(ids)}
+        sources = []
+        targets = []
+        for n, rec_id in enumerate(ids):
+            for ref_id in adjacency[rec_id]:
+                m = index_of.get(ref_id)
+                if m != None:
+                    sources.append(n)
+                    targets.append(m)
+        return cls.from_edges(ids, sources, targets)
+
+    @classmethod
+    def from_id_arrays(cls, pairs):
+        """Build a graph from (id, integer array of referenced ids) pairs, e.g. CitationIndex.adjacency().
+
+        References to IDs outside the pairs are dropped.
+        """
+        ids = []
+        counts = array.array('q')
+        targets = array.array('q')
+        for rec_id, refs in pairs:
+            ids.append(rec_id)
+            counts.append(len(refs))
+            targets.frombytes(np.asarray(refs, dtype=np.int64).tobytes())
+        n = len(ids)
+        if n == 0:
+            return cls.from_edges([], [], [])
+        node_ints = np.array([int(i) for i in ids], dtype=np.int64)
+        order = np.argsort(node_ints)
+        sorted_ints = node_ints[order]
+        counts = np.frombuffer(counts, dtype=np.int64)
+        sources = np.repeat(np.arange(n, dtype=np.int64), counts)
+        targets_int = np.frombuffer(targets, dtype=np.int64)
+        pos = np.searchsorted(sorted_ints, targets_int)
+        pos[pos == n] = 0
+        found = sorted_ints[pos] == targets_int
+        return cls.from_edges(ids, sources[found], order[pos[found]])
+
+    def __len__(self):
+        return self.adjacency.shape[0]
+
+    @property
+    def num_edges(self) -> int:
+        return self.adjacency.nnz
+
+    def out_degree(self) -> np.ndarray:
+        return np.diff(self.adjacency.indptr)
+
+    def in_degree(self) -> np.ndarray:
+        return np.bincount(self.adjacency.indices, minlength=len(self))
+
+    def reversed(self) -> "CitationGraph":
+        """Graph with every edge reversed (cited paper -> citing paper)."""
+        return CitationGraph(self.ids, self.adjacency.T.tocsr())
+
+    def symmetrized(self) -> "CitationGraph":
+        """Graph with every edge present in both directions."""
+        adjacency = (self.adjacency + self.adjacency.T).tocsr()
+        adjacency.data[:] = 1.0
+        return CitationGraph(self.ids, adjacency)
+
+    def to_dict(self, values) -> dict:
+        """Map a per-node array back to {id: value}."""
+        return dict(zip(self.ids.tolist(), np.asarray(values).tolist()))
+
+
+def pagerank(adjacency: scipy.sparse.csr_matrix,
+             alpha: float = 0.85,
+             max_iter: int = 100,
+             tol: float = 1.0e-6,
+             x0: np.ndarray = None,
+             dangling: np.ndarray = None,
+             personalization: np.ndarray = None) -> np.ndarray:
+    """PageRank of a sparse adjacency matrix by power iteration.
+
+    The random surfer teleports according to personalization (uniform if not given).
+    Nodes without out-edges (dangling nodes) redistribute their rank according to
+    the dangling weights, which default to the personalization. Iteration stops once
+    the L1 change falls below n * tol (the networkx criterion). x0 warm-starts the
+    iteration, e.g. with the vector from a previous run.
+    """
+    n = adjacency.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    out_degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    is_dangling = out_degree == 0
+    inv_out_degree = np.zeros(n)
+    inv_out_degree[~is_dangling] = 1.0 / out_degree[~is_dangling]
+    # CSC view of the transpose; no copy of the edge arrays
+    transposed = adjacency.T
+    if personalization is None:
+        teleport = 1.0 / n
+    else:
+        teleport = np.asarray(personalization, dtype=np.float64) / np.sum(personalization)
+    if dangling is None:
+        dangling_weights = teleport
+    else:
+        dangling_weights = np.asarray(dangling, dtype=np.float64) / np.sum(dangling)
+
+    if x0 is None:
+        x = np.full(n, 1.0 / n)
+    else:
+        x = np.asarray(x0, dtype=np.float64) / np.sum(x0)
+    for _ in range(max_iter):
+        x_last = x
+        x = alpha * (transposed @ (x_last * inv_out_degree))
+        x += alpha * x_last[is_dangling].sum() * dangling_weights + (1.0 - alpha) * teleport
+        if np.abs(x - x_last).sum() < n * tol:
+            return x
+    raise RuntimeError("PageRank failed to converge in {} iterations".format(max_iter))
+
+
+def personalized_pagerank_push(adjacency: scipy.sparse.csr_matrix,
+                               seeds: np.ndarray,
+                               weights: np.ndarray = None,
+                               alpha: float = 0.85,
+                               epsilon: float = 1.0e-6) -> np.ndarray:
+    """Approximate personalized PageRank from seed nodes by forward push.
+
+    Only the neighborhood reached by significant residual mass is touched, so the
+    cost depends on epsilon and alpha rather than on the graph size. Each node's
+    remaining residual is below epsilon times its out-degree; the result converges
+    to pagerank(adjacency, alpha, personalization=seed weights) as epsilon -> 0.
+    Dangling nodes send their mass back to the seeds.
+    """
+    n = adjacency.shape[0]
+    indptr = adjacency.indptr
+    indices = adjacency.indices
+    out_degree = np.diff(indptr)
+    threshold = epsilon * np.maximum(out_degree, 1)
+    seeds = np.asarray(seeds, dtype=np.int64)
+    if weights is None:
+        weights = np.ones(len(seeds))
+    weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+
+    estimate = np.zeros(n)
+    residual = np.zeros(n)
+    np.add.at(residual, seeds, weights)
+    queued = np.zeros(n, dtype=bool)
+    queue = collections.deque()
+    for u in np.unique(seeds).tolist():
+        if residual[u] >= threshold[u]:
+            queue.append(u)
+            queued[u] = True
+
+    while queue:
+        u = queue.popleft()
+        queued[u] = False
+        mass = residual[u]
+        residual[u] = 0.0
+        estimate[u] += (1.0 - alpha) * mass
+        degree = out_degree[u]
+        if degree > 0:
+            targets = indices[indptr[u]:indptr[u + 1]]
+            residual[targets] += alpha * mass / degree
+        else:
+            targets = seeds
+            np.add.at(residual, seeds, alpha * mass * weights)
+        ready = targets[(residual[targets] >= threshold[targets]) & ~queued[targets]]
+        ready = np.unique(ready)
+        queued[ready] = True
+        queue.extend(ready.tolist())
+    return estimate
+
+
+def hits(adjacency: scipy.sparse.csr_matrix,
+         max_iter: int = 100,
+         tol: float = 1.0e-8):
+    """HITS hub and authority scores by power iteration, each normalized to sum 1.
+
+    Stops once the L1 change of the hub vector falls below n * tol (the networkx criterion).
+    """
+    n = adjacency.shape[0]
+    if n == 0:
+        return np.zeros(0), np.zeros(0)
+    transposed = adjacency.T
+    h = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        h_last = h
+        a = transposed @ h_last
+        h = adjacency @ a
+        h /= h.max() if h.max() > 0 else 1.0
+        if np.abs(h - h_last).sum() < n * tol:
+            break
+    else:
+        raise RuntimeError("HITS failed to converge in {} iterations".format(max_iter))
+    a = transposed @ h
+    h_sum, a_sum = h.sum(), a.sum()
+    return (h / h_sum if h_sum > 0 else h), (a / a_sum if a_sum > 0 else a)
+
+
+def _undirected_simple(adjacency: scipy.sparse.csr_matrix) -> scipy.sparse.csr_matrix:
+    coo = adjacency.tocoo()
+    off_diagonal = coo.row != coo.col
+    rows, cols = coo.row[off_diagonal], coo.col[off_diagonal]
+    undirected = scipy.sparse.csr_matrix(
+        (np.ones(2 * len(rows)), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+        shape=adjacency.shape)
+    undirected.sum_duplicates()
+    undirected.data[:] = 1.0
+    return undirected
+
+
+def core_number(adjacency: scipy.sparse.csr_matrix) -> np.ndarray:
+    """k-core number of every node of the underlying undirected simple graph.
+
+    Peels all nodes of degree <= k at once; each round only touches the edges
+    of the nodes it removes.
+    """
+    undirected = _undirected_simple(adjacency)
+    n = undirected.shape[0]
+    indptr = undirected.indptr
+    indices = undirected.indices
+    degree = np.diff(indptr).astype(np.int64)
+    alive = np.ones(n, dtype=bool)
+    core = np.zeros(n, dtype=np.int64)
+    remaining = n
+    k = 0
+    while remaining > 0:
+        k = max(k, int(degree[alive].min()))
+        peel = np.flatnonzero(alive & (degree <= k))
+        while len(peel) > 0:
+            core[peel] = k
+            alive[peel] = False
+            remaining -= len(peel)
+            starts, ends = indptr[peel], indptr[peel + 1]
+            lengths = ends - starts
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            neighbors = indices[offsets]
+            neighbors = neighbors[alive[neighbors]]
+            degree -= np.bincount(neighbors, minlength=n)
+            candidates = np.unique(neighbors)
+            peel = candidates[degree[candidates] <= k]
+    return core
+
+
+def weakly_connected_components(adjacency: scipy.sparse.csr_matrix) -> np.ndarray:
+    """Component label of every node, ignoring edge direction."""
+    import scipy.sparse.csgraph
+    _, labels = scipy.sparse.csgraph.connected_components(adjacency, directed=True, connection='weak')
+    return labels
+
+
+def _run_analysis(name: str, indptr, indices, n: int, options: dict):
+    adjacency = scipy.sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(n, n))
+    if name == "pagerank":
+        return pagerank(adjacency, **options)
+    if name == "hits":
+        return hits(adjacency, **options)
+    if name == "core_number":
+        return core_number(adjacency)
+    if name == "components":
+        return weakly_connected_components(adjacency)
+    if name == "degree":
+        return np.diff(adjacency.indptr), np.bincount(adjacency.indices, minlength=n)
+    raise ValueError("Unknown analysis {}".format(name))
+
+
+# CSR arrays of the graph being reported on, inherited by forked pool workers
+_report_graph = None
+
+def _run_shared_analysis(name: str, options: dict):
+    return _run_analysis(name, *_report_graph, options)
+
+
+def graph_report(graph: CitationGraph, processes: int = None, pagerank_options: dict = None,
+                 hits_options: dict = None) -> dict:
+    """Run every bulk analysis over one graph and collect the results.
+
+    The analyses are independent; with processes > 1 they run in a process pool.
+    Where fork is available, workers inherit the CSR arrays instead of receiving
+    a pickled copy per task.
+    """
+    global _report_graph
+    tasks = {
+        "pagerank": pagerank_options or {},
+        "hits": hits_options or {},
+        "core_number": {},
+        "components": {},
+        "degree": {},
+    }
+    args = (graph.adjacency.indptr, graph.adjacency.indices, len(graph))
+    if processes != None and processes > 1:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            _report_graph = args
+            try:
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers=processes, mp_context=multiprocessing.get_context('fork')) as pool:
+                    futures = {name: pool.submit(_run_shared_analysis, name, options)
+                               for name, options in tasks.items()}
+                    results = {name: future.result() for name, future in futures.items()}
+            finally:
+                _report_graph = None
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+                futures = {name: pool.submit(_run_analysis, name, *args, options)
+                           for name, options in tasks.items()}
+                results = {name: future.result() for name, future in futures.items()}
+    else:
+        results = {name: _run_analysis(name, *args, options) for name, options in tasks.items()}
+
+    hubs, authorities = results["hits"]
+    out_degree, in_degree = results["degree"]
+    labels = results["components"]
+    component_sizes = np.bincount(labels) if len(labels) > 0 else np.zeros(0, dtype=np.int64)
+    return {
+        "num_nodes": len(graph),
+        "num_edges": graph.num_edges,
+        "pagerank": graph.to_dict(results["pagerank"]),
+        "hubs": graph.to_dict(hubs),
+        "authorities": graph.to_dict(authorities),
+        "core_number": graph.to_dict(results["core_number"]),
+        "component": graph.to_dict(labels),
+        "component_sizes": sorted(component_sizes.tolist(), reverse=True),
+        "in_degree_distribution": np.bincount(in_degree).tolist() if len(graph) > 0 else [],
+        "out_degree_distribution": np.bincount(out_degree).tolist() if len(graph) > 0 else [],
+    }
+
+
+class SimilarityIndex:
+    """Top-k co-citation or bibliographic-coupling neighbors of every paper.
+
+    With A the citation adjacency (paper -> cited paper), co-citation counts are
+    A^T A (papers cited together) and bibliographic coupling counts are A A^T
+    (papers sharing references). With normalize=True counts are divided by the
+    geometric mean of the two papers' citation (resp. reference) counts.
+    Rows are computed blockwise so the full product is never materialized.
+    """
+
+    KINDS = ("cocitation", "coupling")
+
+    def __init__(self, kind: str = "cocitation", k: int = 20, normalize: bool = True,
+                 block_size: int = 4096):
+        if kind not in self.KINDS:
+            raise ValueError("kind must be one of {}".format(self.KINDS))
+        self.kind = kind
+        self.k = k
+        self.normalize = normalize
+        self.block_size = block_size
+        self.ids = np.zeros(0, dtype=object)
+        self.index_of = dict()
+        self.adjacency = scipy.sparse.csr_matrix((0, 0))
+        self.neighbors = np.zeros((0, k), dtype=np.int64)
+        self.scores = np.zeros((0, k), dtype=np.float32)
+
+    def _operands(self, adjacency):
+        transposed = adjacency.T.tocsr()
+        if self.kind == "cocitation":
+            return transposed, adjacency, np.asarray(adjacency.sum(axis=0)).ravel()
+        return adjacency, transposed, np.asarray(adjacency.sum(axis=1)).ravel()
+
+    def _compute_rows(self, adjacency, rows: np.ndarray):
+        left, right, degree = self._operands(adjacency)
+        for start in range(0, len(rows), self.block_size):
+            block = rows[start:start + self.block_size]
+            product = (left[block] @ right).tocsr()
+            for r, i in enumerate(block.tolist()):
+                cols = product.indices[product.indptr[r]:product.indptr[r + 1]]
+                vals = product.data[product.indptr[r]:product.indptr[r + 1]]
+                keep = cols != i
+                cols, vals = cols[keep], vals[keep]
+                if self.normalize and len(vals) > 0:
+                    vals = vals / np.sqrt(degree[i] * degree[cols])
+                self.neighbors[i] = -1
+                self.scores[i] = 0.0
+                if len(vals) > self.k:
+                    top = np.argpartition(-vals, self.k - 1)[:self.k]
+                    cols, vals = cols[top], vals[top]
+                order = np.argsort(-vals, kind='stable')
+                self.neighbors[i, :len(order)] = cols[order]
+                self.scores[i, :len(order)] = vals[order]
+
+    def build(self, graph: CitationGraph):
+        """Compute neighbors of every node of a directed citation graph."""
+        n = len(graph)
+        self.ids = graph.ids
+        self.index_of = graph.index_of
+        self.adjacency = graph.adjacency
+        self.neighbors = np.full((n, self.k), -1, dtype=np.int64)
+        self.scores = np.zeros((n, self.k), dtype=np.float32)
+        self._compute_rows(self.adjacency, np.arange(n))
+        return self
+
+    def _affected(self, adjacency, changed: np.ndarray) -> np.ndarray:
+        """Rows whose neighbor lists can change when the out-edges of changed nodes change."""
+        left, right, _ = self._operands(adjacency)
+        if self.kind == "cocitation":
+            # Papers referenced by the changed papers, and everything co-cited with them
+            seeds = np.unique(adjacency[changed].indices)
+        else:
+            seeds = changed
+        reached = (left[seeds] @ right).indices if len(seeds) > 0 else np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate([seeds, changed, reached]).astype(np.int64))
+
+    def update(self, graph: CitationGraph):
+        """Bring the neighbor lists up to date with a newer version of the graph.
+
+        Only rows affected by added, removed or re-referenced papers are recomputed.
+        """
+        n = len(graph)
+        old_to_new = np.array([graph.index_of.get(i, -1) for i in self.ids.tolist()], dtype=np.int64)
+        kept = old_to_new >= 0
+
+        # Old adjacency in the new index space (edges touching removed papers dropped)
+        old = self.adjacency.tocoo()
+        mask = kept[old.row] & kept[old.col]
+        remapped = scipy.sparse.csr_matrix(
+            (old.data[mask], (old_to_new[old.row[mask]], old_to_new[old.col[mask]])), shape=(n, n))
+        is_new = np.ones(n, dtype=bool)
+        is_new[old_to_new[kept]] = False
+        diff = (graph.adjacency - remapped).tocsr()
+        diff.eliminate_zeros()
+        changed_mask = (np.diff(diff.indptr) > 0) | is_new
+
+        # Papers that lost edges to removed papers changed too
+        removed = np.flatnonzero(~kept)
+        if len(removed) > 0:
+            lost = self.adjacency[:, removed].tocsr()
+            had_lost = np.flatnonzero((np.diff(lost.indptr) > 0) & kept)
+            changed_mask[old_to_new[had_lost]] = True
+        changed = np.flatnonzero(changed_mask)
+
+        neighbors = np.full((n, self.k), -1, dtype=np.int64)
+        scores = np.zeros((n, self.k), dtype=np.float32)
+        remap = np.append(old_to_new, -1)  # index -1 (padding) stays -1
+        neighbors[old_to_new[kept]] = remap[self.neighbors[kept]]
+        scores[old_to_new[kept]] = self.scores[kept]
+
+        affected = self._affected(graph.adjacency, changed)
+        if len(removed) > 0 or len(changed) > 0:
+            # Rows affected through edges of the old graph, computed in the old index space
+            new_to_old = np.full(n, -1, dtype=np.int64)
+            new_to_old[old_to_new[kept]] = np.flatnonzero(kept)
+            changed_old = np.concatenate([new_to_old[changed][new_to_old[changed] >= 0], removed])
+            affected_old = old_to_new[self._affected(self.adjacency, changed_old)]
+            affected = np.union1d(affected, affected_old[affected_old >= 0])
+            # Rows that pointed at removed papers now have a gap
+            affected = np.union1d(affected, np.flatnonzero(
+                ((neighbors == -1) & (scores != 0.0)).any(axis=1)))
+
+        self.ids = graph.ids
+        self.index_of = graph.index_of
+        self.adjacency = graph.adjacency
+        self.neighbors, self.scores = neighbors, scores
+        self._compute_rows(self.adjacency, affected)
+        return affected
+
+    def neighbors_of(self, rec_id: str):
+        """(id, score) pairs of the top-k neighbors of a paper, best first."""
+        i = self.index_of[rec_id]
+        valid = self.neighbors[i] >= 0
+        return list(zip(self.ids[self.neighbors[i][valid]].tolist(), self.scores[i][valid].tolist()))
+
+    def save(self, path: str):
+        """Write the index to a .npz file."""
+        np.savez(path, kind=self.kind, k=self.k, normalize=self.normalize,
+                 ids=np.array(self.ids.tolist(), dtype=str),
+                 indptr=self.adjacency.indptr, indices=self.adjacency.indices,
+                 neighbors=self.neighbors, scores=self.scores)
+
+    @classmethod
+    def load(cls, path: str) -> "SimilarityIndex":
+        with np.load(path) as data:
+            index = cls(str(data['kind']), int(data['k']), bool(data['normalize']))
+            index.ids = np.array(data['ids'].tolist(), dtype=object)
+            index.index_of = {rec_id: n for n, rec_id in enumerate(index.ids)}
+            n = len(index.ids)
+            index.adjacency = scipy.sparse.csr_matrix(
+                (np.ones(len(data['indices'])), data['indices'], data['indptr']), shape=(n, n))
+            index.neighbors = data['neighbors']
+            index.scores = data['scores']
+        return index
 
 
 # Citation graph analytics over an InspireHEP record collection.
 # Provides graph construction and PageRank computation for a set of literature records.
+# The collection is a {id: record} mapping or a CitationIndex.
 class InspireHEPAnalytics:
-    def __init__(self, collection):
+    # Edge direction used for graph analytics:
+    # "directed": paper -> cited paper, "reverse": cited paper -> citing paper,
+    # "symmetric": both directions (twice the edges).
+    GRAPH_MODES = ("directed", "reverse", "symmetric")
+
+    def __init__(self, collection, graph_mode: str = "directed"):
+        if graph_mode not in self.GRAPH_MODES:
+            raise ValueError("graph_mode must be one of {}".format(self.GRAPH_MODES))
         self.collection = collection
+        self.graph_mode = graph_mode
+        self.last_pagerank = None
+        self.graphs = dict()
+
+    def _reference_arrays(self):
+        # (id, referenced ids) pairs without decoding full records, or None for plain collections
+        collection = self.collection
+        if isinstance(collection, citation_index.CitationIndex):
+            return collection.adjacency()
+        if hasattr(collection, 'reference_arrays'):
+            return collection.reference_arrays()
+        return None
 
     def make_citation_graph(self):
         collection = self.collection
-        re_extract_id = re.compile('/([0-9]+)$')
-        graph = dict()
-        for record_id, record in collection.items():
-            graph[record_id] = []
-            references = record['metadata'].get('references')
-            if references == None:
-                continue
-            for ref in references:
-                if ref.get('record') == None:
-                    continue
-                ref_id = re_extract_id.findall(ref['record']['$ref'])[0]
-                graph[record_id].append(ref_id)
+        pairs = self._reference_arrays()
+        if pairs != None:
+            return {rec_id: [str(r) for r in refs.tolist()] for rec_id, refs in pairs}
+        # the same reference IDs the citation index stores, skipping links it cannot parse
+        return {record_id: citation_index.extract_reference_ids(record) for record_id, record in collection.items()}
+
+    def make_compact_graph(self, graph_mode: str = None) -> CitationGraph:
+        """Citation graph restricted to the collection, in CSR form.
+
+        Edges follow graph_mode (default: the mode given at construction).
+        """
+        graph_mode = graph_mode or self.graph_mode
+        pairs = self._reference_arrays()
+        if pairs != None:
+            graph = CitationGraph.from_id_arrays(pairs)
+        else:
+            graph = CitationGraph.from_adjacency(self.make_citation_graph())
+        if graph_mode == "reverse":
+            return graph.reversed()
+        if graph_mode == "symmetric":
+            return graph.symmetrized()
         return graph
 
-    def compute_pagerank(self, alpha=0.85, max_iter=100):
-        G = nx.DiGraph()
+    def get_graph(self, graph_mode: str = None, refresh: bool = False) -> CitationGraph:
+        """Compact graph for graph_mode, built once and cached until refresh=True."""
+        graph_mode = graph_mode or self.graph_mode
+        if refresh or graph_mode not in self.graphs:
+            self.graphs[graph_mode] = self.make_compact_graph(graph_mode)
+        return self.graphs[graph_mode]
+
+    def _seed_vector(self, graph: CitationGraph, seeds):
+        if isinstance(seeds, dict):
+            pairs = [(graph.index_of[i], w) for i, w in seeds.items() if i in graph.index_of]
+        else:
+            pairs = [(graph.index_of[i], 1.0) for i in seeds if i in graph.index_of]
+        if len(pairs) == 0:
+            raise ValueError("None of the seeds are in the citation graph")
+        nodes, weights = zip(*pairs)
+        return np.array(nodes, dtype=np.int64), np.array(weights, dtype=np.float64)
+
+    def personalized_pagerank(self, seeds, alpha=0.85, epsilon=1.0e-6, graph_mode=None) -> dict:
+        """Approximate PageRank personalized to seeds, as {id: score} over the touched nodes.
+
+        seeds is a list of IDs (equal weight) or an {id: weight} dict, e.g. a draft's
+        bibliography or a list of search hits with their scores. Uses the cached graph.
+        """
+        graph = self.get_graph(graph_mode)
+        nodes, weights = self._seed_vector(graph, seeds)
+        x = personalized_pagerank_push(graph.adjacency, nodes, weights, alpha=alpha, epsilon=epsilon)
+        touched = np.flatnonzero(x)
+        return dict(zip(graph.ids[touched].tolist(), x[touched].tolist()))
+
+    def recommend(self, seeds, top_n=20, alpha=0.85, epsilon=1.0e-6, graph_mode="symmetric",
+                  exclude_seeds=True):
+        """Top-N papers by personalized PageRank from seeds, as (id, score) pairs, best first.
+
+        The symmetric graph (default) reaches both references and citing papers of the seeds.
+        """
+        scores = self.personalized_pagerank(seeds, alpha=alpha, epsilon=epsilon, graph_mode=graph_mode)
+        if exclude_seeds:
+            for rec_id in seeds:
+                scores.pop(rec_id, None)
+        return heapq.nlargest(top_n, scores.items(), key=lambda x: x[1])
+
+    def similarity(self, kind: str = "cocitation", k: int = 20, cache_path: str = None,
+                   normalize: bool = True) -> SimilarityIndex:
+        """Co-citation or bibliographic-coupling neighbors of every paper (see SimilarityIndex).
+
+        With cache_path (a .npz file), a cached index is loaded and updated incrementally
+        to the current collection, then written back.
+        """
+        graph = self.get_graph("directed", refresh=True)
+        index = None
+        if cache_path != None and os.path.exists(cache_path):
+            index = SimilarityIndex.load(cache_path)
+            if index.kind != kind or index.k != k or index.normalize != normalize:
+                index = None
+        if index == None:
+            index = SimilarityIndex(kind, k, normalize).build(graph)
+        else:
+            index.update(graph)
+        if cache_path != None:
+            index.save(cache_path)
+        return index
+
+    def compute_hits(self, max_iter=100, tol=1.0e-8, graph_mode=None):
+        """HITS (hubs, authorities) as two {id: score} dicts."""
+        graph = self.get_graph(graph_mode, refresh=True)
+        hubs, authorities = hits(graph.adjacency, max_iter=max_iter, tol=tol)
+        return graph.to_dict(hubs), graph.to_dict(authorities)
+
+    def compute_core_number(self):
+        """k-core number of every paper in the undirected citation graph, as {id: k}."""
+        graph = self.get_graph(refresh=True)
+        return graph.to_dict(core_number(graph.adjacency))
+
+    def compute_components(self):
+        """Weakly connected component label of every paper, as {id: label}."""
+        graph = self.get_graph(refresh=True)
+        return graph.to_dict(weakly_connected_components(graph.adjacency))
+
+    def report(self, processes=None, graph_mode=None, pagerank_options=None, hits_options=None):
+        """Full-corpus analytics (PageRank, HITS, k-core, components, degree distributions) in one pass.
+
+        See graph_report for the returned fields.
+        """
+        graph = self.get_graph(graph_mode, refresh=True)
+        return graph_report(graph, processes=processes, pagerank_options=pagerank_options,
+                            hits_options=hits_options)
+
+    def compute_pagerank(self, alpha=0.85, max_iter=100, tol=1.0e-6, nstart=None, warm_start=False,
+                         dangling=None, graph_mode=None):
+        """PageRank of every record in the collection as {id: score}.
+
+        nstart ({id: value}) or warm_start=True (reuse the previous result) seeds the iteration.
+        dangling ({id: weight}) sets where papers without (in-collection) references send their rank;
+        unlisted papers get weight 0. Default is uniform.
+        """
+        graph = self.get_graph(graph_mode, refresh=True)
+
+        if warm_start and nstart == None:
+            nstart = self.last_pagerank
+        x0 = None
+        if nstart != None:
+            x0 = np.array([nstart.get(i, 0.0) for i in graph.ids.tolist()], dtype=np.float64)
+            x0[x0 == 0.0] = 1.0 / len(graph)
 
-        graph = self.make_citation_graph()
-        for lit_id, lit_cites in graph.items():
-            # Add edges: paper -> cited_paper
-            for cite_id in lit_cites:
-                if cite_id in graph:  # Only track papers in our initial set
-                    G.add_edge(lit_id, cite_id)
-                    G.add_edge(cite_id, lit_id)
+        dangling_weights = None
+        if dangling != None:
+            dangling_weights = np.array([dangling.get(i, 0.0) for i in graph.ids.tolist()], dtype=np.float64)
 
-        pr = nx.pagerank(G, alpha=alpha, max_iter=max_iter)
-        return {x[0]: x[1] for x in pr.items()}
+        x = pagerank(graph.adjacency, alpha=alpha, max_iter=max_iter, tol=tol, x0=x0,
+                     dangling=dangling_weights)
+        self.last_pagerank = graph.to_dict(x)
+        return self.last_pagerank
 
 
-__all__ = ["InspireHEPAnalytics"]
+__all__ = ["InspireHEPAnalytics", "CitationGraph", "pagerank", "personalized_pagerank_push", "hits", "core_number", "weakly_connected_components", "graph_report", "SimilarityIndex"]
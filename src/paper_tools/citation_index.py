@@ -0,0 +1,168 @@
+import re
+import struct
+import msgpack
+import numpy as np
+from typing import List, Dict, Generator, Tuple
+import paper_tools.lmdb_wrapper as lmdb_wrapper
+
+# Persistent citation adjacency for an InspireHEP record store.
+# Forward references are stored per record as a packed uint32 array, reverse
+# citations as a dupsort table, so graph analytics and crawl expansion can read
+# adjacency without decoding full records.
+
+_re_extract_id = re.compile('/([0-9]+)$')
+_ID = struct.Struct('>I')
+_REFS_DTYPE = np.dtype('<u4')
+
+def extract_reference_ids(record: dict) -> List[str]:
+    """IDs of the InspireHEP records referenced by a record, in order"""
+    references = record['metadata'].get('references')
+    if references == None:
+        return []
+    result = []
+    for ref in references:
+        linked = ref.get('record')
+        if linked == None:
+            continue
+        match = _re_extract_id.search(linked['$ref'])
+        if match:
+            result.append(match.group(1))
+    return result
+
+
+def packed_reference_ids(packed: bytes) -> List[int]:
+    """IDs referenced by a msgpack-encoded record, as ints, in order.
+
+    Only metadata.references is decoded; every other field is skipped in the
+    byte stream without building Python objects.
+    """
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=max(len(packed), 1))
+    unpacker.feed(packed)
+    for _ in range(unpacker.read_map_header()):
+        if unpacker.unpack() != 'metadata':
+            unpacker.skip()
+            continue
+        for _ in range(unpacker.read_map_header()):
+            if unpacker.unpack() != 'references':
+                unpacker.skip()
+                continue
+            result = []
+            try:
+                n_refs = unpacker.read_array_header()
+            except ValueError:  # references: null
+                return result
+            for _ in range(n_refs):
+                for _ in range(unpacker.read_map_header()):
+                    if unpacker.unpack() != 'record':
+                        unpacker.skip()
+                        continue
+                    linked = unpacker.unpack()
+                    match = _re_extract_id.search(linked['$ref'])
+                    if match:
+                        result.append(int(match.group(1)))
+            return result
+        return []
+    return []
+
+
+class CitationIndex(lmdb_wrapper.LmdbTablesBase):
+    """Forward references and reverse citations of the records in a record store."""
+
+    TABLES = {
+        'refs': {},                                   # id -> uint32[] of referenced ids
+        'cites': {'dupsort': True, 'dupfixed': True},  # id -> citing id (big-endian uint32), one dup each
+    }
+
+    def __len__(self):
+        """Number of indexed records."""
+        with self.env.begin() as txn:
+            return txn.stat(self.tables['refs'])['entries']
+
+    def __contains__(self, rec_id) -> bool:
+        with self.env.begin() as txn:
+            return txn.get(rec_id.encode(), db=self.tables['refs']) != None
+
+    def on_write(self, env, txn, items: dict):
+        """Write hook keeping the index in sync with a record store (see LmdbWrapperBase.add_write_hook)."""
+        self.update(items, env=env, txn=txn)
+
+    def update(self, records: Dict[str, dict], env=None, txn=None):
+        """Index (or re-index) a {id: record} collection."""
+        self.update_references(((rec_id, extract_reference_ids(record)) for rec_id, record in records.items()),
+                               env=env, txn=txn)
+
+    def update_references(self, pairs, env=None, txn=None):
+        """Index (or re-index) records given as (id, referenced ids) pairs."""
+        with self.write_txn(env, txn) as wtxn:
+            for rec_id, refs in pairs:
+                refs = np.array(list(dict.fromkeys(int(r) for r in refs)), dtype=_REFS_DTYPE)
+                self._set_refs(wtxn, rec_id, refs)
+
+    def remove(self, rec_ids: List[str]):
+        """Drop records from the index. Citations from other records to them are kept."""
+        with self.env.begin(write=True) as txn:
+            for rec_id in rec_ids:
+                self._set_refs(txn, rec_id, None)
+
+    def _set_refs(self, txn, rec_id: str, refs):
+        key = rec_id.encode()
+        citing = _ID.pack(int(rec_id))
+        packed = txn.get(key, db=self.tables['refs'])
+        old = set(np.frombuffer(packed, dtype=_REFS_DTYPE).tolist()) if packed != None else set()
+        new = set(refs.tolist()) if refs is not None else set()
+        for ref in old - new:
+            txn.delete(str(ref).encode(), citing, db=self.tables['cites'])
+        for ref in new - old:
+            txn.put(str(ref).encode(), citing, db=self.tables['cites'])
+        if refs is None:
+            txn.delete(key, db=self.tables['refs'])
+        else:
+            txn.put(key, refs.tobytes(), db=self.tables['refs'])
+
+    def rebuild(self, records):
+        """Clear the index and re-index every record of a record store (anything with items()).
+
+        Record stores providing reference_arrays() are read without decoding full records.
+        """
+        with self.env.begin(write=True) as txn:
+            txn.drop(self.tables['refs'], delete=False)
+            txn.drop(self.tables['cites'], delete=False)
+        if hasattr(records, 'reference_arrays'):
+            pairs = records.reference_arrays()
+        else:
+            pairs = ((rec_id, extract_reference_ids(record)) for rec_id, record in records.items())
+        batch = []
+        for pair in pairs:
+            batch.append(pair)
+            if len(batch) >= 1000:
+                self.update_references(batch)
+                batch = []
+        self.update_references(batch)
+
+    def reference_array(self, rec_id: str) -> np.ndarray:
+        """Referenced IDs of a record as a uint32 array (empty if not indexed)."""
+        with self.env.begin() as txn:
+            packed = txn.get(rec_id.encode(), db=self.tables['refs'])
+            return np.frombuffer(packed, dtype=_REFS_DTYPE) if packed != None else np.zeros(0, dtype=_REFS_DTYPE)
+
+    def references(self, rec_id: str) -> List[str]:
+        """IDs referenced by a record."""
+        return [str(i) for i in self.reference_array(rec_id).tolist()]
+
+    def citations(self, rec_id: str) -> List[str]:
+        """IDs of indexed records that cite a record."""
+        with self.env.begin() as txn:
+            cursor = txn.cursor(db=self.tables['cites'])
+            if not cursor.set_key(rec_id.encode()):
+                return []
+            return [str(_ID.unpack(v)[0]) for v in cursor.iternext_dup()]
+
+    def adjacency(self) -> Generator[Tuple[str, np.ndarray], None, None]:
+        """Iterate over (id, uint32 array of referenced ids) for every indexed record."""
+        with self.env.begin() as txn:
+            cursor = txn.cursor(db=self.tables['refs'])
+            for key, value in cursor:
+                yield key.decode(), np.frombuffer(value, dtype=_REFS_DTYPE)
+
+
+__all__ = ["CitationIndex", "extract_reference_ids", "packed_reference_ids"]
@@ -0,0 +1,417 @@
+import struct
+import datetime
+import msgpack
+import numpy as np
+from typing import List, Dict, Tuple
+from collections.abc import Mapping
+import paper_tools.lmdb_wrapper as lmdb_wrapper
+
+# Columnar metadata side-store for an InspireHEP record store.
+# Each record is reduced to one small msgpack row (created, citation_count,
+# document_type, title, authors, position of the abstract in the packed record),
+# maintained through record-store write hooks. columns() materializes the rows
+# as NumPy arrays so filters and sorts scan arrays instead of decoding records.
+
+_COUNT = struct.Struct('>Q')
+NO_DATE = np.iinfo(np.int64).min
+MAX_DOCUMENT_TYPES = 64  # one bit each in RecordColumns.document_type
+
+def epoch_seconds(created) -> int:
+    """Seconds since the epoch of an ISO 8601 date (UTC if naive), NO_DATE if missing or invalid"""
+    if not created:
+        return NO_DATE
+    try:
+        dt = datetime.datetime.fromisoformat(created)
+    except ValueError:
+        return NO_DATE
+    if dt.tzinfo == None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+def _skip_unless_array(unpacker):
+    try:
+        return unpacker.read_array_header()
+    except ValueError:  # field is null
+        return None
+
+def packed_row(packed: bytes) -> list:
+    """Column row of a msgpack-encoded record, decoding only the fields it needs.
+
+    Returns [created (epoch seconds), citation_count, document_type, titles, authors,
+    abstract offset, abstract length]; the offset and length locate the UTF-8 bytes
+    of the first abstract inside packed (-1, 0 without abstract).
+    """
+    created, citation_count, document_type, titles, authors = NO_DATE, 0, [], [], []
+    abstract_offset, abstract_length = -1, 0
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=max(len(packed), 1))
+    unpacker.feed(packed)
+    for _ in range(unpacker.read_map_header()):
+        key = unpacker.unpack()
+        if key == 'created':
+            created = epoch_seconds(unpacker.unpack())
+            continue
+        if key != 'metadata':
+            unpacker.skip()
+            continue
+        for _ in range(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            if key == 'titles':
+                titles = [t['title'] for t in unpacker.unpack() or []]
+            elif key == 'citation_count':
+                citation_count = unpacker.unpack() or 0
+            elif key == 'document_type':
+                document_type = unpacker.unpack() or []
+            elif key == 'authors':
+                for _ in range(_skip_unless_array(unpacker) or 0):
+                    for _ in range(unpacker.read_map_header()):
+                        if unpacker.unpack() == 'full_name':
+                            authors.append(unpacker.unpack())
+                        else:
+                            unpacker.skip()
+            elif key == 'abstracts':
+                n_abstracts = _skip_unless_array(unpacker) or 0
+                for i in range(n_abstracts):
+                    if i > 0:
+                        unpacker.skip()
+                        continue
+                    for _ in range(unpacker.read_map_header()):
+                        if unpacker.unpack() != 'value':
+                            unpacker.skip()
+                            continue
+                        value = unpacker.unpack()
+                        abstract_length = len(value.encode())
+                        abstract_offset = unpacker.tell() - abstract_length
+            else:
+                unpacker.skip()
+    return [created, citation_count, document_type, titles, authors, abstract_offset, abstract_length]
+
+
+def packed_fields(packed: bytes, keys=(), metadata_keys=()) -> dict:
+    """Record-shaped dict holding only the given top-level and metadata fields of a msgpack record.
+
+    Decoding stops once every requested field has been found.
+    """
+    result = dict()
+    wanted = len(keys) + (1 if metadata_keys else 0)
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=max(len(packed), 1))
+    unpacker.feed(packed)
+    for _ in range(unpacker.read_map_header()):
+        if wanted == 0:
+            break
+        key = unpacker.unpack()
+        if key in keys:
+            result[key] = unpacker.unpack()
+            wanted -= 1
+        elif key == 'metadata' and metadata_keys:
+            metadata = result.setdefault('metadata', dict())
+            for _ in range(unpacker.read_map_header()):
+                if wanted == 1 and len(metadata) == len(metadata_keys):
+                    return result
+                key = unpacker.unpack()
+                if key in metadata_keys:
+                    metadata[key] = unpacker.unpack()
+                else:
+                    unpacker.skip()
+            wanted -= 1
+        else:
+            unpacker.skip()
+    return result
+
+def _is_packed_map(first_byte: int) -> bool:
+    return 0x80 <= first_byte <= 0x8f or first_byte in (0xde, 0xdf)
+
+class LazyRecord(Mapping):
+    """Read-only view of a msgpack-encoded map that decodes a value only when it is accessed.
+
+    Keys are located by skipping over the encoded values in order, only as far as
+    the requested key; map values (e.g. 'metadata') are LazyRecords themselves, other
+    values are decoded whole. record['metadata']['titles'] decodes the titles and
+    nothing else. decode() returns the plain dict.
+    """
+    __slots__ = ('packed', '_unpacker', '_remaining', '_spans', '_values')
+
+    def __init__(self, packed: bytes):
+        self.packed = packed
+        self._unpacker = None
+        self._remaining = 0
+        self._spans = dict()
+        self._values = dict()
+
+    def _scan(self, until=None):
+        """Index keys up to and including until (all keys if None)."""
+        unpacker = self._unpacker
+        if unpacker == None:
+            if self._spans:
+                return  # fully indexed
+            unpacker = msgpack.Unpacker(raw=False, max_buffer_size=max(len(self.packed), 1))
+            unpacker.feed(self.packed)
+            self._remaining = unpacker.read_map_header()
+            self._unpacker = unpacker
+        while self._remaining > 0:
+            key = unpacker.unpack()
+            start = unpacker.tell()
+            unpacker.skip()
+            self._spans[key] = (start, unpacker.tell())
+            self._remaining -= 1
+            if until != None and key == until:
+                return
+        self._unpacker = None
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        if key not in self._spans:
+            self._scan(key)
+        start, end = self._spans[key]
+        if _is_packed_map(self.packed[start]):
+            value = LazyRecord(self.packed[start:end])
+        else:
+            value = msgpack.unpackb(self.packed[start:end], raw=False)
+        self._values[key] = value
+        return value
+
+    def __contains__(self, key):
+        if key not in self._spans:
+            self._scan(key)
+        return key in self._spans
+
+    def __iter__(self):
+        self._scan()
+        return iter(self._spans)
+
+    def __len__(self):
+        self._scan()
+        return len(self._spans)
+
+    def __repr__(self):
+        return "LazyRecord({} bytes)".format(len(self.packed))
+
+    def decode(self) -> dict:
+        return msgpack.unpackb(self.packed, raw=False)
+
+
+class TextColumn:
+    """Lowercased strings, one per row, concatenated for fast substring scans."""
+
+    SEPARATOR = "\0"
+
+    def __init__(self, texts: List[str]):
+        self.blob = self.SEPARATOR.join(t.lower() for t in texts) + self.SEPARATOR
+        lengths = np.fromiter((len(t) + 1 for t in texts), dtype=np.int64, count=len(texts))
+        self.starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]) if len(texts) > 0 else np.zeros(0, dtype=np.int64)
+
+    def contains(self, needle: str) -> np.ndarray:
+        """Boolean mask of rows containing needle (case-insensitive)."""
+        needle = needle.lower()
+        mask = np.zeros(len(self.starts), dtype=bool)
+        if self.SEPARATOR in needle:
+            return mask
+        positions = []
+        pos = self.blob.find(needle)
+        while pos >= 0:
+            positions.append(pos)
+            # Resume at the next row: one hit per row is enough
+            row = np.searchsorted(self.starts, pos, side='right')
+            if row >= len(self.starts):
+                break
+            pos = self.blob.find(needle, self.starts[row])
+        if positions:
+            mask[np.searchsorted(self.starts, positions, side='right') - 1] = True
+        return mask
+
+
+class RecordColumns:
+    """In-memory columns of a ColumnStore; row n describes record ids[n]."""
+
+    def __init__(self, ids: List[str], rows: List[list]):
+        n = len(ids)
+        self.ids = np.array(ids, dtype=object)
+        self.row_of_id = {rec_id: i for i, rec_id in enumerate(ids)}
+        self.created = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+        self.citation_count = np.fromiter((r[1] for r in rows), dtype=np.int64, count=n)
+        self.document_types = sorted({t for r in rows for t in r[2]})
+        if len(self.document_types) > MAX_DOCUMENT_TYPES:
+            raise ValueError("{} document types, the column store can hold at most {}: {}".format(
+                len(self.document_types), MAX_DOCUMENT_TYPES, ", ".join(self.document_types)))
+        type_bit = {t: 1 << i for i, t in enumerate(self.document_types)}
+        self.document_type = np.fromiter((sum(type_bit[t] for t in set(r[2])) for r in rows), dtype=np.uint64, count=n)
+        self.title = np.array([r[3][0] if r[3] else "" for r in rows], dtype=object)
+        self.authors = np.array([tuple(r[4]) for r in rows] + [None], dtype=object)[:-1]
+        self.abstract_offset = np.fromiter((r[5] for r in rows), dtype=np.int64, count=n)
+        self.abstract_length = np.fromiter((r[6] for r in rows), dtype=np.int64, count=n)
+        self.title_text = TextColumn(["\n".join(r[3]) for r in rows])
+        self.author_text = TextColumn(["\n".join(a) for a in self.authors])
+        dated = self.created != NO_DATE
+        self.year = np.zeros(n, dtype=np.int32)
+        self.year[dated] = self.created[dated].astype('datetime64[s]').astype('datetime64[Y]').astype(np.int32) + 1970
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows_of(self, ids) -> np.ndarray:
+        """Row of each ID, -1 for IDs without a row."""
+        return np.array([self.row_of_id.get(i, -1) for i in ids], dtype=np.int64)
+
+    def year_mask(self, first: int, last: int = None) -> np.ndarray:
+        """Rows created in [first, last] (inclusive; last defaults to first)."""
+        last = first if last == None else last
+        return (self.year >= first) & (self.year <= last)
+
+    def created_mask(self, after: datetime.datetime = None, before: datetime.datetime = None) -> np.ndarray:
+        """Rows created at or after `after` and at or before `before` (naive datetimes are UTC)."""
+        mask = self.created != NO_DATE
+        if after != None:
+            mask &= self.created >= epoch_seconds(after.isoformat())
+        if before != None:
+            mask &= self.created <= epoch_seconds(before.isoformat())
+        return mask
+
+    def document_type_mask(self, document_type: str) -> np.ndarray:
+        if document_type not in self.document_types:
+            return np.zeros(len(self), dtype=bool)
+        bit = np.uint64(1 << self.document_types.index(document_type))
+        return (self.document_type & bit) != 0
+
+    def author_mask(self, name: str) -> np.ndarray:
+        """Rows with an author whose full name contains name (case-insensitive)."""
+        return self.author_text.contains(name)
+
+    def title_mask(self, keyword: str) -> np.ndarray:
+        """Rows with a title containing keyword (case-insensitive)."""
+        return self.title_text.contains(keyword)
+
+    def top_by_citations(self, mask: np.ndarray = None, n: int = None, descending: bool = True) -> np.ndarray:
+        """Rows selected by mask, ordered by citation count (all of them, or the first n)."""
+        rows = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+        counts = self.citation_count[rows]
+        if descending:
+            counts = -counts
+        if n != None and n < len(rows):
+            top = np.argpartition(counts, n - 1)[:n]
+            return rows[top[np.argsort(counts[top], kind='stable')]]
+        return rows[np.argsort(counts, kind='stable')]
+
+
+class ColumnStore(lmdb_wrapper.LmdbTablesBase):
+    """Per-record metadata rows derived from a record store, kept in sync on writes."""
+
+    TABLES = {
+        'rows': {},  # id -> msgpack column row (see packed_row)
+        'meta': {},  # 'version': bumped on every write
+    }
+
+    _cached = None
+
+    def __len__(self):
+        with self.env.begin() as txn:
+            return txn.stat(self.tables['rows'])['entries']
+
+    def __contains__(self, rec_id) -> bool:
+        with self.env.begin() as txn:
+            return txn.get(rec_id.encode(), db=self.tables['rows']) != None
+
+    def _version(self, txn) -> int:
+        packed = txn.get(b'version', db=self.tables['meta'])
+        return _COUNT.unpack(packed)[0] if packed != None else 0
+
+    def _bump_version(self, txn):
+        txn.put(b'version', _COUNT.pack(self._version(txn) + 1), db=self.tables['meta'])
+
+    def on_write(self, env, txn, items: dict, record_store=None):
+        """Write hook keeping the store in sync with a record store (see LmdbWrapperBase.add_write_hook).
+
+        Rows are built from the packed values just written in txn, read through
+        record_store (its database handle and compression setting); without it,
+        from the main database of env, uncompressed.
+        """
+        if record_store != None:
+            packed = (record_store.decompress_value(txn.get(key.encode(), db=record_store.db)) for key in items)
+        else:
+            packed = (txn.get(key.encode()) for key in items)
+        self.update_packed(zip(items, packed), env=env, txn=txn)
+
+    def update(self, records: Dict[str, dict], env=None, txn=None, pack_value=None):
+        """Add (or replace) the rows of a {id: record} collection.
+
+        Abstract positions must point into the bytes the record store holds, so they
+        are only recorded when pack_value (the record store's pack_value) is given;
+        abstracts() skips rows without them.
+        """
+        pack = pack_value if pack_value != None else msgpack.packb
+        self.update_packed(((rec_id, pack(record)) for rec_id, record in records.items()),
+                           env=env, txn=txn, offsets=pack_value != None)
+
+    def update_packed(self, pairs, env=None, txn=None, offsets: bool = True):
+        """Add (or replace) rows from (id, msgpack-encoded record) pairs.
+
+        With offsets=False the packed bytes are not those of the record store, and
+        no abstract position is recorded.
+        """
+        with self.write_txn(env, txn) as wtxn:
+            for rec_id, packed in pairs:
+                row = packed_row(packed)
+                if not offsets:
+                    row[5:] = [-1, 0]
+                wtxn.put(rec_id.encode(), msgpack.packb(row), db=self.tables['rows'])
+            self._bump_version(wtxn)
+
+    def remove(self, rec_ids: List[str]):
+        with self.env.begin(write=True) as txn:
+            for rec_id in rec_ids:
+                txn.delete(rec_id.encode(), db=self.tables['rows'])
+            self._bump_version(txn)
+
+    def rebuild(self, records):
+        """Clear the store and add a row for every record of a record store.
+
+        Record stores providing raw_items() are read without decoding full records;
+        other sources are packed with their pack_value if they have one (see update).
+        """
+        with self.env.begin(write=True) as txn:
+            txn.drop(self.tables['rows'], delete=False)
+            self._bump_version(txn)
+        pack_value = getattr(records, 'pack_value', None)
+        offsets = hasattr(records, 'raw_items') or pack_value != None
+        if hasattr(records, 'raw_items'):
+            pairs = records.raw_items()
+        else:
+            pack = pack_value if pack_value != None else msgpack.packb
+            pairs = ((rec_id, pack(record)) for rec_id, record in records.items())
+        batch = []
+        for pair in pairs:
+            batch.append(pair)
+            if len(batch) >= 1000:
+                self.update_packed(batch, offsets=offsets)
+                batch = []
+        self.update_packed(batch, offsets=offsets)
+
+    def columns(self) -> RecordColumns:
+        """Current rows as NumPy columns; rebuilt only after the store has changed."""
+        with self.env.begin() as txn:
+            version = self._version(txn)
+            if self._cached == None or self._cached[0] != version:
+                ids, rows = [], []
+                for key, value in txn.cursor(db=self.tables['rows']):
+                    ids.append(key.decode())
+                    rows.append(msgpack.unpackb(value))
+                self._cached = (version, RecordColumns(ids, rows))
+        return self._cached[1]
+
+    def abstracts(self, record_store, ids: List[str]) -> Dict[str, str]:
+        """First abstract of each record, sliced out of the packed records in record_store."""
+        columns = self.columns()
+        result = dict()
+        with record_store.env.begin(buffers=True) as txn:
+            for rec_id in ids:
+                row = columns.row_of_id.get(rec_id)
+                if row == None or columns.abstract_offset[row] < 0:
+                    continue
+                packed = record_store.decompress_value(txn.get(rec_id.encode(), db=record_store.db))
+                if packed == None:
+                    continue
+                offset = int(columns.abstract_offset[row])
+                result[rec_id] = bytes(packed[offset:offset + int(columns.abstract_length[row])]).decode()
+        return result
+
+
+__all__ = ["ColumnStore", "RecordColumns", "TextColumn", "packed_row", "packed_fields", "LazyRecord", "epoch_seconds", "NO_DATE"]
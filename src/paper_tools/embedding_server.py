@@ -0,0 +1,186 @@
+import os
+import threading
+import queue
+import time
+import secrets
+import argparse
+from multiprocessing.managers import BaseManager
+import numpy as np
+
+# Serve one loaded embedding model to several processes.
+# A server process loads the model once and exposes a BatchingEncoder through a
+# multiprocessing manager listening on a Unix socket (or a (host, port) pair).
+# Concurrent encode_queries calls from different clients are coalesced into a
+# single model call.
+#
+# The manager unpickles what clients send, so the authkey is what keeps other
+# users from running code in the server. There is no default key: a server on a
+# Unix socket without one generates a random key into a 0600 file next to the
+# socket (authkey_path), which clients on the same machine read; a (host, port)
+# address requires the caller to pass a key.
+
+DEFAULT_MODEL_NAME = 'BAAI/bge-large-en-v1.5'
+
+
+def authkey_path(address: str) -> str:
+    """File holding the generated authkey of a server listening on the Unix socket address."""
+    return address + '.key'
+
+def _server_authkey(address, authkey: bytes = None) -> bytes:
+    if authkey != None:
+        return authkey
+    if not isinstance(address, str):
+        raise ValueError("An authkey is required to serve on a (host, port) address.")
+    authkey = secrets.token_bytes(32)
+    fd = os.open(authkey_path(address), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        os.fchmod(fd, 0o600)  # the file may have existed with other permissions
+        f.write(authkey)
+    return authkey
+
+def _client_authkey(address, authkey: bytes = None) -> bytes:
+    if authkey != None:
+        return authkey
+    if not isinstance(address, str):
+        raise ValueError("An authkey is required to connect to a (host, port) address.")
+    with open(authkey_path(address), 'rb') as f:
+        return f.read()
+
+
+def load_flag_model(model_name: str = DEFAULT_MODEL_NAME):
+    """Load a FlagEmbedding model (imports the ML stack on first call)."""
+    from FlagEmbedding import FlagAutoModel
+    return FlagAutoModel.from_finetuned(model_name)
+
+
+class _EncodeRequest:
+    def __init__(self, queries):
+        self.queries = queries
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchingEncoder:
+    """Coalesce concurrent encode_queries calls into batched model calls."""
+
+    def __init__(self, model, max_batch: int = 64, batch_window_s: float = 0.005):
+        """
+        :param model: Object with an encode_queries(list[str]) -> array method
+        :param max_batch: Maximum number of queries per model call
+        :param batch_window_s: How long to wait for more requests before encoding
+        """
+        self.model = model
+        self.max_batch = max_batch
+        self.batch_window_s = batch_window_s
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def encode_queries(self, queries):
+        """Encode a list of queries, sharing the model call with concurrent callers."""
+        request = _EncodeRequest(list(queries))
+        if len(request.queries) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self, first):
+        batch = [first]
+        size = len(first.queries)
+        deadline = time.monotonic() + self.batch_window_s
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            batch.append(request)
+            size += len(request.queries)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            texts = [q for request in batch for q in request.queries]
+            try:
+                embeddings = np.asarray(self.model.encode_queries(texts))
+                offset = 0
+                for request in batch:
+                    request.result = embeddings[offset:offset + len(request.queries)]
+                    offset += len(request.queries)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+
+class EmbeddingManager(BaseManager):
+    pass
+
+
+def serve_embedding_model(address,
+                          authkey: bytes = None,
+                          model_factory=load_flag_model,
+                          **encoder_kwargs):
+    """Load the model once and serve it on address until the process is killed.
+
+    address is a Unix socket path or a (host, port) tuple. Without authkey, a
+    random key is written to authkey_path(address) (Unix sockets only).
+    """
+    authkey = _server_authkey(address, authkey)
+    encoder = BatchingEncoder(model_factory(), **encoder_kwargs)
+    EmbeddingManager.register('get_encoder', callable=lambda: encoder,
+                              exposed=['encode_queries'])
+    manager = EmbeddingManager(address=address, authkey=authkey)
+    server = manager.get_server()
+    server.serve_forever()
+
+
+def connect_encoder(address, authkey: bytes = None):
+    """Connect to a running embedding server and return a proxy with encode_queries.
+
+    Without authkey, the key is read from authkey_path(address) (Unix sockets only).
+    """
+    EmbeddingManager.register('get_encoder')
+    manager = EmbeddingManager(address=address, authkey=_client_authkey(address, authkey))
+    manager.connect()
+    return manager.get_encoder()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a shared embedding model.")
+    parser.add_argument("address", help="Unix socket path to listen on (the authkey is written to <address>.key)")
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--batch-window", type=float, default=0.005,
+                        help="Seconds to wait for concurrent queries")
+    args = parser.parse_args()
+    serve_embedding_model(args.address,
+                          model_factory=lambda: load_flag_model(args.model),
+                          max_batch=args.max_batch,
+                          batch_window_s=args.batch_window)
+
+
+if __name__ == "__main__":
+    main()
+
+
+__all__ = ["BatchingEncoder", "EmbeddingManager", "serve_embedding_model", "connect_encoder", "load_flag_model",
+           "authkey_path"]
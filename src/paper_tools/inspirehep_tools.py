@@ -3,16 +3,27 @@ import json
 import time
 import re
 import copy
+import numbers
 import lmdb
 import msgpack
 import pathlib
+import functools
+import threading
+import contextlib
+import concurrent.futures
 import paper_tools.lmdb_wrapper as lmdb_wrapper
+import paper_tools.embedding_server as embedding_server
+import paper_tools.lexical_index as lexical_index
+import paper_tools.citation_index as citation_index
+import paper_tools.column_store as column_store
+import paper_tools.record_query as record_query
+import paper_tools.record_index as record_index
 import pipe
 from typing import List, Set, Dict, Tuple
 import numpy as np
 
-import faiss
-from FlagEmbedding import FlagAutoModel
+# faiss and FlagEmbedding pull in torch/transformers and are only needed for
+# semantic search, so they are imported lazily inside InspireHEPDatabase.
 
 # A wrapper around requests.
 # Used to limit the rate of InspireHEP API calls.
@@ -24,14 +35,17 @@ class RateLimitedRequests:
         self.last_requested_ns = time.time_ns()
         self.minimum_interval_ns = int(minimum_interval_s * 1e9)
         self.sleep_interval_s = sleep_interval_s
+        self.lock = threading.Lock()
         return
     
     def get(self, query, **arg):
-        while time.time_ns() - self.last_requested_ns < self.minimum_interval_ns:
-            time.sleep(self.sleep_interval_s)
+        # Requests from several threads are spaced out, but may be in flight at the same time
+        with self.lock:
+            while time.time_ns() - self.last_requested_ns < self.minimum_interval_ns:
+                time.sleep(self.sleep_interval_s)
+            self.last_requested_ns = time.time_ns()
         print("QUERYING: {} WITH {}".format(query, json.dumps(arg)))
         response = requests.get(query, **arg)
-        last_requested_ns = time.time_ns()
         return response
 
 
@@ -249,11 +263,30 @@ class InspireHEPClient:
 
 
 
+# Large metadata fields that most readers skip; they are packed after the others,
+# so partial decoders (LazyRecord, packed_fields) usually stop before reaching them.
+COLD_FIELDS = ('authors', 'references')
+
+def _cold_fields_last(record: dict) -> dict:
+    metadata = record.get('metadata')
+    if not isinstance(metadata, dict) or not any(key in metadata for key in COLD_FIELDS):
+        return record
+    reordered = {key: value for key, value in metadata.items() if key not in COLD_FIELDS}
+    reordered.update((key, metadata[key]) for key in COLD_FIELDS if key in metadata)
+    return dict(record, metadata=reordered)
+
 class InspireHEPRecordLmdbWrapper(lmdb_wrapper.LmdbWrapperBase):
     def pack_value(self, value: dict) -> bytes:
-        return msgpack.packb(value)
+        return msgpack.packb(_cold_fields_last(value))
     def unpack_value(self, value: bytes) -> dict:
         return msgpack.unpackb(value)
+    def unpack_lazy(self, value: bytes) -> column_store.LazyRecord:
+        """Record view decoding only the fields that are read, e.g. record['metadata']['titles']."""
+        return column_store.LazyRecord(value)
+    def reference_arrays(self):
+        """Iterate over (id, uint32 array of referenced ids), decoding only the references of each record."""
+        for key, packed in self.raw_items():
+            yield key, np.array(citation_index.packed_reference_ids(packed), dtype=np.uint32)
 
 
 class InspireHEPBibtexLmdbWrapper(lmdb_wrapper.LmdbWrapperBase):
@@ -273,81 +306,518 @@ class EmbeddingLmdbWrapper(lmdb_wrapper.LmdbWrapperBase):
         return np.frombuffer(value, dtype=self.dtype)
 
 
+def _first_abstract(record: dict):
+    abstracts = record['metadata'].get('abstracts')
+    return abstracts[0]['value'] if abstracts else None
+
+# Field extractors for record projection: field name -> function(record)
+RECORD_FIELDS = {
+    'title': lambda r: r['metadata']['titles'][0]['title'],
+    'authors': lambda r: [a['full_name'] for a in r['metadata'].get('authors', [])],
+    'date': lambda r: r.get('created'),
+    'abstract': _first_abstract,
+    'citation_count': lambda r: r['metadata'].get('citation_count', 0),
+    'document_type': lambda r: r['metadata'].get('document_type', []),
+    'texkeys': lambda r: r['metadata'].get('texkeys', []),
+    'arxiv_eprints': lambda r: [e['value'] for e in r['metadata'].get('arxiv_eprints', [])],
+    'keywords': lambda r: [k['value'] for k in r['metadata'].get('keywords', [])],
+}
+
+def project_record(record: dict, fields) -> dict:
+    """Extract the given RECORD_FIELDS from a record into a flat dict"""
+    return {field: RECORD_FIELDS[field](record) for field in fields}
+
+def _created_year(record: dict) -> int:
+    created = record.get('created')
+    return int(created[:4]) if created else 0
+
+def _row_metadata(record: dict) -> tuple:
+    metadata = record['metadata']
+    return (_created_year(record),
+            metadata.get('document_type', []),
+            "\n".join(a['full_name'].lower() for a in metadata.get('authors', [])))
+
+def lexical_text(record: dict) -> str:
+    """Text indexed for keyword search: titles, abstract and keywords"""
+    metadata = record['metadata']
+    parts = [t['title'] for t in metadata.get('titles', [])]
+    parts.append(_first_abstract(record) or "")
+    parts.extend(RECORD_FIELDS['keywords'](record))
+    return "\n".join(parts)
+
+
 # Database manager for InspireHEP records and bibtex items
+#
+# By default every store is its own environment under path (record.lmdb, ...).
+# With shared_env=True they are all named databases of one environment
+# (SHARED_NAME): 'record', 'bibtex', 'embedding', and the tables of the indexes
+# prefixed with their store name ('citation.refs', 'index.date', ...). Writes to
+# several stores can then share one transaction (write_txn), index updates commit
+# together with the record writes that trigger them, and a read transaction
+# (read_txn) sees one consistent snapshot of every store.
 class InspireHEPDatabase:
     RECORD_NAME = "record.lmdb"
     BIBTEX_NAME = "bibtex.lmdb"
     EMBEDDING_NAME = "embedding.lmdb"
+    LEXICAL_NAME = "lexical.lmdb"
+    CITATION_NAME = "citation.lmdb"
+    COLUMNS_NAME = "columns.lmdb"
+    INDEX_NAME = "index.lmdb"
+    SHARED_NAME = "inspirehep.lmdb"
+    SHARED_MAX_DBS = 64  # named databases in the shared environment, with room for future tables
+
+    env = None
+    def _location(self, file_name: str, tables: bool = False) -> dict:
+        """Keyword arguments placing a store: its own environment under path, or a named database of the shared one."""
+        if self.env == None:
+            return {'path': str(pathlib.Path(self.path) / file_name)}
+        name = pathlib.Path(file_name).stem
+        return {'path': None, 'env': self.env, 'prefix': name + '.'} if tables else \
+               {'path': None, 'env': self.env, 'name': name}
+
+    def _exists(self, file_name: str, table: str) -> bool:
+        """Whether the store (with the given table, for table stores) has been created."""
+        if self.env == None:
+            return (pathlib.Path(self.path) / file_name).exists()
+        return lmdb_wrapper.has_db(self.env, pathlib.Path(file_name).stem + '.' + table)
+
+    @contextlib.contextmanager
+    def write_txn(self):
+        """Write transaction spanning every store of a shared environment (shared_env=True).
+
+        Pass it as txn to the stores' setitem_batched; everything written in it,
+        including index updates, is committed together, or not at all if the block raises:
+
+            with db.write_txn() as txn:
+                db.record.setitem_batched({rec_id: record}, txn=txn)
+                db.bibtex.setitem_batched({rec_id: bibtex}, txn=txn)
+        """
+        if self.env == None:
+            raise Exception("InspireHEPDatabase was initialized without shared_env, stores cannot share a transaction.")
+        if self.readonly:
+            raise Exception("InspireHEPDatabase was initialized in readonly mode, cannot write.")
+        with self.env.begin(write=True) as txn:
+            yield txn
+
+    @contextlib.contextmanager
+    def read_txn(self):
+        """Read transaction on a shared environment (shared_env=True): a consistent snapshot of every store.
+
+        Pass it as txn to the stores' get, getitem_batched and items.
+        """
+        if self.env == None:
+            raise Exception("InspireHEPDatabase was initialized without shared_env, stores cannot share a transaction.")
+        with self.env.begin() as txn:
+            yield txn
+
+    def close(self):
+        """Close every open store (and the shared environment)."""
+        for store in (self.record, self.bibtex, self.embedding, self.lexical, self.citation, self.columns, self.indexes):
+            if store != None:
+                store.__exit__(None, None, None)
+        if self.env != None:
+            self.env.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     model = None
+    model_address = None
+    warmup_thread = None
     def load_model(self):
-        if self.model == None:
-            self.model = FlagAutoModel.from_finetuned('BAAI/bge-large-en-v1.5')
+        """Load the embedding model, or connect to a shared embedding server if model_address is set."""
+        with self._model_lock:
+            if self.model == None:
+                if self.model_address != None:
+                    self.model = embedding_server.connect_encoder(self.model_address, self.model_authkey)
+                else:
+                    self.model = embedding_server.load_flag_model(embedding_server.DEFAULT_MODEL_NAME)
 
     id_list = None
+    id_array = None
     abstract_embeddings_list = None
     index_faiss = None
     def index_embeddings(self):
         if self.index_faiss == None:
+            import faiss
             self.id_list = list(self.embedding.keys())
-            self.abstract_embeddings_list = np.array(list(self.embedding.values()))
-            self.index_faiss = faiss.IndexFlatIP(1024) # Use 'BAAI/bge-large-en-v1.5'
+            # Row -> ID lookup table; the trailing None maps faiss's -1 (no hit) to None
+            self.id_array = np.array(self.id_list + [None], dtype=object)
+            self.abstract_embeddings_list = np.array(list(self.embedding.values()), dtype=np.float32)
+            # 1024 dimensions for 'BAAI/bge-large-en-v1.5'
+            self.index_faiss = faiss.IndexFlatIP(self.abstract_embeddings_list.shape[1])
             self.index_faiss.add(self.abstract_embeddings_list)
 
+    # Per-row metadata aligned with the faiss index, used to build search filters
+    row_metadata = None
+    def index_metadata(self):
+        """Build year / document type / author columns aligned with the rows of the faiss index.
+
+        Authors are a column_store.TextColumn (one concatenated buffer), not a
+        fixed-width array padded to the longest author list.
+        """
+        self.index_embeddings()
+        if self.row_metadata == None:
+            store = self._derived_store(self.open_column_store, self.columns)
+            if store != None:
+                columns = store.columns()
+                rows = columns.rows_of(self.id_list)
+                found = rows >= 0
+                years = np.zeros(len(rows), dtype=np.int32)
+                years[found] = columns.year[rows[found]]
+                document_type = {t: found & columns.document_type_mask(t)[rows] for t in columns.document_types}
+                authors = column_store.TextColumn(["\n".join(columns.authors[row]) if row >= 0 else "" for row in rows])
+            else:
+                rows = self.record.getitem_batched(self.id_list, project=_row_metadata, lazy=True)
+                empty = (0, [], "")
+                years = np.array([rows.get(i, empty)[0] for i in self.id_list], dtype=np.int32)
+                document_type = dict()
+                for row, rec_id in enumerate(self.id_list):
+                    for t in rows.get(rec_id, empty)[1]:
+                        document_type.setdefault(t, np.zeros(len(self.id_list), dtype=bool))[row] = True
+                authors = column_store.TextColumn([rows.get(i, empty)[2] for i in self.id_list])
+            self.row_metadata = {
+                'year': years,
+                'document_type': document_type,
+                'authors': authors,
+                'row_of_id': {rec_id: row for row, rec_id in enumerate(self.id_list)},
+            }
+        return self.row_metadata
+
+    def filter_mask(self, search_filter: dict) -> np.ndarray:
+        """Boolean mask over index rows selected by a filter dict.
+
+        Supported keys (all optional, combined with AND):
+        'year': int (numpy integers included) or (first, last) inclusive range,
+        'document_type': str,
+        'author': case-insensitive substring of any author's full name,
+        'ids': iterable of record IDs.
+        """
+        meta = self.index_metadata()
+        mask = np.ones(len(self.id_list), dtype=bool)
+        if 'year' in search_filter:
+            year = search_filter['year']
+            first, last = (year, year) if isinstance(year, numbers.Integral) else year
+            mask &= (meta['year'] >= first) & (meta['year'] <= last)
+        if 'document_type' in search_filter:
+            type_mask = meta['document_type'].get(search_filter['document_type'])
+            mask &= type_mask if type_mask is not None else False
+        if 'author' in search_filter:
+            mask &= meta['authors'].contains(search_filter['author'])
+        if 'ids' in search_filter:
+            id_mask = np.zeros(len(self.id_list), dtype=bool)
+            rows = [meta['row_of_id'][i] for i in search_filter['ids'] if i in meta['row_of_id']]
+            id_mask[rows] = True
+            mask &= id_mask
+        return mask
+
+    # Below this many selected rows, filtered search scores the selected rows directly
+    BRUTE_FORCE_ROWS = 4096
+    def _search_rows(self, query_embeddings: np.ndarray, k: int, mask: np.ndarray):
+        import faiss
+        rows = np.flatnonzero(mask)
+        n_queries = len(query_embeddings)
+        if len(rows) == 0:
+            return np.zeros((n_queries, 0), dtype=np.float32), np.zeros((n_queries, 0), dtype=np.int64)
+        if len(rows) <= self.BRUTE_FORCE_ROWS:
+            scores = query_embeddings @ self.abstract_embeddings_list[rows].T
+            kk = min(k, len(rows))
+            top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            return np.take_along_axis(top_scores, order, axis=1), rows[np.take_along_axis(top, order, axis=1)]
+        bitmap = np.packbits(mask, bitorder='little')
+        selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+        D, I = self.index_faiss.search(query_embeddings, min(k, len(rows)),
+                                       params=faiss.SearchParameters(sel=selector))
+        return D, I
+
+    def search_batch(self, queries : List[str], k : int, filters=None) -> List[List[Tuple[str, float]]]:
+        """Search many queries at once, each restricted by an optional filter dict (see filter_mask).
+
+        filters is None, a single filter dict applied to every query, or a list with one filter
+        (or None) per query. Queries sharing a filter are searched together.
+        Returns, per query, up to k (id, score) pairs, best first.
+        """
+        self.load_model()
+        self.index_embeddings()
+        if filters == None or isinstance(filters, dict):
+            filters = [filters] * len(queries)
+        query_embeddings = np.array(self.model.encode_queries(queries), dtype=np.float32)
+
+        groups = dict()
+        for qi, search_filter in enumerate(filters):
+            key = repr(sorted((search_filter or {}).items()))
+            groups.setdefault(key, (search_filter, []))[1].append(qi)
+
+        results = [None] * len(queries)
+        for search_filter, query_rows in groups.values():
+            x = query_embeddings[query_rows]
+            if search_filter:
+                D, I = self._search_rows(x, k, self.filter_mask(search_filter))
+            else:
+                D, I = self.index_faiss.search(x, k)
+            ids = self.id_array[I].tolist()
+            for qi, row_scores, row_ids in zip(query_rows, D.tolist(), ids):
+                results[qi] = [(i, score) for i, score in zip(row_ids, row_scores) if i != None]
+        return results
+
+    lexical = None
+    def open_lexical_index(self):
+        """Open the BM25 index over titles, abstracts and keywords (lexical.lmdb)."""
+        if self.lexical == None:
+            self.lexical = lexical_index.BM25Index(map_size=self.map_size, readonly=self.readonly,
+                                                   **self._location(self.LEXICAL_NAME, tables=True))
+        return self.lexical
+
+    citation = None
+    def open_citation_index(self):
+        """Open the citation adjacency index (citation.lmdb).
+
+        In write mode the index is built from record.lmdb if it is empty, and is
+        kept up to date on every subsequent write to self.record (in a separate
+        transaction unless shared_env is set).
+        """
+        if self.citation == None:
+            self.citation = citation_index.CitationIndex(map_size=self.map_size, readonly=self.readonly,
+                                                         **self._location(self.CITATION_NAME, tables=True))
+            if not self.readonly:
+                if len(self.citation) == 0 and len(self.record) > 0:
+                    print("Building citation index for {} records.".format(len(self.record)))
+                    self.citation.rebuild(self.record)
+                self.record.add_write_hook(self.citation.on_write)
+        return self.citation
+
+    columns = None
+    def open_column_store(self):
+        """Open the columnar metadata store (columns.lmdb), or None if a readonly database has none.
+
+        In write mode the store is built from record.lmdb if it is empty, and is
+        kept up to date on every subsequent write to self.record (in a separate
+        transaction unless shared_env is set).
+        """
+        if self.columns == None:
+            if self.readonly and not self._exists(self.COLUMNS_NAME, 'rows'):
+                return None
+            self.columns = column_store.ColumnStore(map_size=self.map_size, readonly=self.readonly,
+                                                    **self._location(self.COLUMNS_NAME, tables=True))
+            if not self.readonly:
+                if len(self.columns) == 0 and len(self.record) > 0:
+                    print("Building column store for {} records.".format(len(self.record)))
+                    self.columns.rebuild(self.record)
+                self.record.add_write_hook(functools.partial(self.columns.on_write, record_store=self.record))
+        return self.columns
+
+    indexes = None
+    def open_indexes(self):
+        """Open the date / author / texkey / arXiv ID indexes (index.lmdb), or None if a readonly database has none.
+
+        In write mode the indexes are built from record.lmdb if empty, and are
+        kept up to date on every subsequent write to self.record (in a separate
+        transaction unless shared_env is set).
+        """
+        if self.indexes == None:
+            if self.readonly and not self._exists(self.INDEX_NAME, 'keys'):
+                return None
+            self.indexes = record_index.RecordIndex(map_size=self.map_size, readonly=self.readonly,
+                                                    **self._location(self.INDEX_NAME, tables=True))
+            if not self.readonly:
+                if len(self.indexes) == 0 and len(self.record) > 0:
+                    print("Building record indexes for {} records.".format(len(self.record)))
+                    self.indexes.rebuild(self.record)
+                self.record.add_write_hook(self.indexes.on_write)
+        return self.indexes
+
+    def _derived_store(self, open_store, store):
+        """A derived store for reading when there is one, without building it in write mode.
+
+        In write mode the stores that exist or are tracked were opened by __init__.
+        """
+        return open_store() if self.readonly else store
+
+    def query(self) -> record_query.RecordQuery:
+        """Lazy query over self.record, planned against the column store when there is one.
+
+        Works with the pipe_usage operators: list(db.query() | filter_by_year(2020) | pipe.take(5))
+        """
+        return record_query.RecordQuery(self.record, self._derived_store(self.open_column_store, self.columns))
+
     readonly = True
     def __init__(self,
                  path:str,
                  map_size:int=100737418240,  # Default 100GB
                  readonly:bool=True,
-                 init_model:bool=False):
-        record_path = str(pathlib.Path(path) / self.RECORD_NAME)
-        bibtex_path = str(pathlib.Path(path) / self.BIBTEX_NAME)
-        embedding_path = str(pathlib.Path(path) / self.EMBEDDING_NAME)
-        
-        # 10 GB default map_size
-        self.record = InspireHEPRecordLmdbWrapper(record_path, map_size=map_size, readonly=readonly)
-        self.bibtex = InspireHEPBibtexLmdbWrapper(bibtex_path, map_size=map_size, readonly=readonly)
-        self.embedding = EmbeddingLmdbWrapper(embedding_path, map_size=map_size, readonly=readonly)
+                 init_model:bool=False,
+                 warmup_model:bool=False,
+                 model_address=None,
+                 model_authkey:bytes=None,
+                 track_citations:bool=False,
+                 track_columns:bool=False,
+                 track_indexes:bool=False,
+                 shared_env:bool=False):
+        """
+        :param shared_env: Host every store as a named database of one environment (SHARED_NAME under path),
+            enabling write_txn and read_txn across stores
+        :param track_citations: In write mode, build the citation index if needed and maintain it on record writes
+        :param track_columns: In write mode, build the columnar metadata store if needed and maintain it on record writes
+        :param track_indexes: In write mode, build the date / author / texkey / arXiv ID indexes if needed
+            and maintain them on record writes. A derived store that already exists is maintained in write
+            mode either way, so that it does not go stale. Without shared_env each derived store is its own
+            environment, and its update is committed after, not together with, the record write.
+        :param init_model: Load the embedding model synchronously
+        :param warmup_model: Load the embedding model in a background thread
+        :param model_address: Address of a running embedding_server to use instead of a local model
+        :param model_authkey: Its authkey (default: read from the key file next to a Unix socket)
+        """
         self.readonly = readonly
-        
+        self.path = path
+        self.map_size = map_size
+        if shared_env:
+            self.env = lmdb.open(str(pathlib.Path(path) / self.SHARED_NAME), map_size=map_size, readonly=readonly,
+                                 lock=not readonly, metasync=False, max_dbs=self.SHARED_MAX_DBS)
+
+        # 10 GB default map_size
+        self.record = InspireHEPRecordLmdbWrapper(map_size=map_size, readonly=readonly, **self._location(self.RECORD_NAME))
+        self.bibtex = InspireHEPBibtexLmdbWrapper(map_size=map_size, readonly=readonly, **self._location(self.BIBTEX_NAME))
+        self.embedding = EmbeddingLmdbWrapper(map_size=map_size, readonly=readonly, **self._location(self.EMBEDDING_NAME))
+        if not readonly:
+            if track_citations or self._exists(self.CITATION_NAME, 'refs'):
+                self.open_citation_index()
+            if track_columns or self._exists(self.COLUMNS_NAME, 'rows'):
+                self.open_column_store()
+            if track_indexes or self._exists(self.INDEX_NAME, 'keys'):
+                self.open_indexes()
+
+        self._model_lock = threading.Lock()
+        self.model_address = model_address
+        self.model_authkey = model_authkey
         if init_model:
             self.load_model()
-
-    def update_embedding(self):
+        elif warmup_model:
+            self.warmup_thread = threading.Thread(target=self.load_model, daemon=True)
+            self.warmup_thread.start()
+
+    def embed_texts(self, texts : List[str], batch_size : int = 64) -> np.ndarray:
+        """Embed texts (e.g. the text of latex_tools.TextChunk paragraphs) like abstracts are embedded.
+
+        Texts are encoded in batches of similar length, which keeps padding low;
+        rows of the result follow the order of texts.
+        """
+        texts = list(texts)
+        if len(texts) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        self.load_model()
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        batches = [np.asarray(self.model.encode_queries([texts[i] for i in order[start:start+batch_size]]))
+                   for start in range(0, len(order), batch_size)]
+        embeddings = np.empty((len(texts),) + batches[0].shape[1:], dtype=batches[0].dtype)
+        embeddings[order] = np.concatenate(batches)
+        return embeddings
+
+    def update_embedding(self, ids : List[str] = None, overwrite : bool = False):
+        """Embed the abstracts of the given records (default: all records).
+
+        Records that already have an embedding are skipped unless overwrite is set.
+        A loaded faiss index is extended in place with the new embeddings.
+        """
         if self.embedding.env.flags()['readonly'] == True:
             raise Exception("InspireHEPDatabase was initialized in readonly mode, cannot update embeddings.")
 
-        self.load_model()
-        self.id_list = list(self.record.keys()
-                            | pipe.filter(lambda i: self.record[i]['metadata'].get('abstracts')))
-        abstract_list = [self.record[i]['metadata']['abstracts'][0]['value'] for i in self.id_list]
-        self.abstract_embeddings_list = self.model.encode_queries(abstract_list)
-        for i in range(len(self.id_list)):
-            self.embedding[self.id_list[i]] = self.abstract_embeddings_list[i]
+        if ids == None:
+            ids = self.record.keys()
+        if not overwrite:
+            ids = [i for i in ids if i not in self.embedding]
+        abstracts = {i: a for i, a in self.record.getitem_batched(ids, project=_first_abstract, lazy=True).items() if a}
+        if len(abstracts) == 0:
+            return
+
+        new_ids = list(abstracts)
+        embeddings = self.embed_texts([abstracts[i] for i in new_ids])
+        self.embedding.setitem_batched({new_ids[i]: embeddings[i].astype(self.embedding.dtype) for i in range(len(new_ids))})
+
+        if self.index_faiss != None:
+            if overwrite:
+                # Flat index rows cannot be replaced in place; rebuild on next search
+                self.index_faiss = None
+            else:
+                new_embeddings = embeddings.astype(self.embedding.dtype).astype(np.float32)
+                self.index_faiss.add(new_embeddings)
+                self.abstract_embeddings_list = np.concatenate([self.abstract_embeddings_list, new_embeddings])
+                self.id_list.extend(new_ids)
+                self.id_array = np.array(self.id_list + [None], dtype=object)
+            self.row_metadata = None
+
+    def update_lexical_index(self, ids : List[str] = None):
+        """Add or re-index the given records (default: all records) in the BM25 index."""
+        index = self.open_lexical_index()
+        if ids == None:
+            ids = self.record.keys()
+        index.add_documents(self.record.getitem_batched(ids, project=lexical_text, lazy=True))
+
+    def search_lexical(self, query : str, k : int) -> List[Tuple[str, float]]:
+        """Keyword search over titles, abstracts and keywords. Returns (id, BM25 score) pairs."""
+        return self.open_lexical_index().search(query, k)
+
+    def search_hybrid(self, queries : List[str], k : int, candidates : int = 100, weights=(1.0, 1.0)):
+        """Fuse BM25 and embedding search with reciprocal rank fusion.
+
+        Each ranker contributes its top `candidates` hits; returns, per query, the top k (id, score) pairs.
+        """
+        D, vector_ids = self.search_abstract(queries, candidates)
+        results = []
+        for query, vector_ranking in zip(queries, vector_ids):
+            lexical_ranking = [i for i, _ in self.search_lexical(query, candidates)]
+            fused = lexical_index.reciprocal_rank_fusion([lexical_ranking, vector_ranking], weights=list(weights))
+            results.append(fused[:k])
+        return results
 
     def search_abstract(self, queries : List[str], k : int):
         self.load_model()
         self.index_embeddings()
         
-        query_embeddings = np.array(self.model.encode_queries(queries))
+        query_embeddings = np.array(self.model.encode_queries(queries), dtype=np.float32)
         D, I = self.index_faiss.search(query_embeddings, k)
-        map_to_id = np.vectorize(lambda i: self.id_list[i])
-        ids = map_to_id(I).tolist()
+        ids = self.id_array[I].tolist()
 
         return D, ids
+
+    def search_abstract_records(self, queries : List[str], k : int,
+                                fields=('title', 'authors', 'date', 'abstract')):
+        """Search abstracts and return, per query, a list of hit dicts with id, score and the projected fields.
+
+        All hit records are read in a single LMDB read transaction.
+        """
+        D, ids = self.search_abstract(queries, k)
+        hit_ids = set(i for row in ids for i in row if i != None)
+        projected = self.record.getitem_batched(hit_ids, project=lambda r: project_record(r, fields), lazy=True)
+
+        results = []
+        for row_scores, row_ids in zip(D.tolist(), ids):
+            hits = []
+            for score, rec_id in zip(row_scores, row_ids):
+                if rec_id == None or rec_id not in projected:
+                    continue
+                hit = {'id': rec_id, 'score': score}
+                hit.update(projected[rec_id])
+                hits.append(hit)
+            results.append(hits)
+        return results
             
 def reference_ids(record: dict):
-    references = record['metadata'].get('references')
-    # print(references[0]['record']['$ref'])
-    if references == None:
-        return []
-    else:
-        re_extract_id = re.compile('/([0-9]+)$')
-        return list(references | pipe.filter(lambda r: r.get('record') != None) | pipe.select(lambda r: re_extract_id.findall(r['record']['$ref'])[0]))
+    return citation_index.extract_reference_ids(record)
     
 
 # Batched BFS search download literature works
-def inspirehep_bfs_literature_batch(collection: dict, roots: List[str], max_size: int, mode: str = "refs", batch: int = 50):
+def inspirehep_bfs_literature_batch(collection: dict, roots: List[str], max_size: int, mode: str = "refs", batch: int = 50,
+                                    citations: citation_index.CitationIndex = None):
+    """Breadth-first download of literature into collection, following references and/or citations.
+
+    If a CitationIndex of the collection is given, references of records already in the
+    collection are read from it instead of decoding the stored records.
+    """
     client = InspireHEPClient()
     queue = copy.deepcopy(roots)
     while len(collection) < max_size and len(queue) > 0:
@@ -355,17 +825,23 @@ def inspirehep_bfs_literature_batch(collection: dict, roots: List[str], max_size
         queue = queue[len(inspire_ids):]
         ids_to_grab = list(inspire_ids | pipe.filter(lambda i: i not in collection))
         grabbed = client.get_literature_batched(ids_to_grab)
-        records = list(inspire_ids | pipe.select(lambda i: grabbed[i] if (i in grabbed) else collection[i]))
-        for record in records:
+        for record in grabbed.values():
             if record['id'] not in collection:
                 collection[record['id']] = record
-        
+
+        def refs_of(i):
+            if i in grabbed:
+                return reference_ids(grabbed[i])
+            if citations != None and i in citations:
+                return citations.references(i)
+            return reference_ids(collection[i])
+
         if mode == "refs":
-            branch_ids = set(records | pipe.select(reference_ids) | pipe.chain)
+            branch_ids = set(inspire_ids | pipe.select(refs_of) | pipe.chain)
         elif mode == "cites":
-            branch_ids = set(client.all_cites_to_batched(list(records | pipe.select(lambda r: r['id']))))
+            branch_ids = set(client.all_cites_to_batched(inspire_ids))
         elif mode == "both":
-            branch_ids = set(records | pipe.select(reference_ids) | pipe.chain) | set(client.all_cites_to_batched(list(records | pipe.select(lambda r: r['id']))))
+            branch_ids = set(inspire_ids | pipe.select(refs_of) | pipe.chain) | set(client.all_cites_to_batched(inspire_ids))
 
         not_in_queue = branch_ids - set(queue)
         queue.extend(list(not_in_queue))
@@ -373,5 +849,109 @@ def inspirehep_bfs_literature_batch(collection: dict, roots: List[str], max_size
         print("Downloaded {} new InspireHEP records. {} ids in queue.".format(len(grabbed), len(queue)))
 
 
-
-__all__ = ["InspireHEPClient", "InspireHEPDatabase", "InspireHEPRecordLmdbWrapper", "InspireHEPBibtexLmdbWrapper", "EmbeddingLmdbWrapper", "RateLimitedRequests", "reference_ids", "inspirehep_bfs_literature_batch"]
+# Resolving the citation keys of a manuscript (see latex_tools.extract_cite_keys)
+_re_bibtex_key = re.compile(r"^(\s*@\w+\s*\{\s*)([^,\s]+)")
+
+def bibtex_key(entry: str):
+    """Citation key of a BibTeX entry, e.g. '@article{Einstein:1916vd, ...' -> 'Einstein:1916vd'"""
+    match = _re_bibtex_key.match(entry)
+    return match.group(2) if match else None
+
+def _map_chunks(function, items: list, chunk_size: int, workers: int) -> list:
+    """function over chunks of items on a thread pool; a failing chunk is reported and yields None."""
+    chunks = [items[i:i+chunk_size] for i in range(0, len(items), chunk_size)]
+    def call(chunk):
+        try:
+            return function(chunk)
+        except Exception as e:
+            print("Request for {} items failed: {}: {}".format(len(chunk), type(e).__name__, e))
+            return None
+    if len(chunks) <= 1 or workers <= 1:
+        return [call(chunk) for chunk in chunks]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(call, chunks))
+
+def _texkeys_of(db, rec_ids) -> Dict[str, str]:
+    records = db.record.getitem_batched(set(rec_ids), project=lambda r: r['metadata'].get('texkeys') or [], lazy=True)
+    return {texkey: rec_id for rec_id, texkeys in records.items() for texkey in texkeys}
+
+def resolve_texkeys(texkeys: List[str], db: "InspireHEPDatabase" = None, client: InspireHEPClient = None,
+                    max_results: int = 50, workers: int = 4) -> Dict[str, str]:
+    """{texkey: INSPIRE-HEP ID} for the texkeys that can be resolved.
+
+    Texkeys found in the texkey index of db are not requested; the misses go to
+    get_id_by_texkey in chunks of max_results, with up to `workers` requests in flight.
+    """
+    wanted = set(texkeys)
+    return {key: rec_id for key, rec_id in _resolve_texkeys(texkeys, db, client, max_results, workers).items()
+            if key in wanted}
+
+def _resolve_texkeys(texkeys, db, client, max_results, workers) -> Dict[str, str]:
+    """As resolve_texkeys, but also returns the other texkeys of records returned by INSPIRE-HEP."""
+    texkeys = list(dict.fromkeys(texkeys))
+    indexes = db._derived_store(db.open_indexes, db.indexes) if db != None else None
+    resolved = indexes.by_texkey(texkeys) if indexes != None else dict()
+    misses = [key for key in texkeys if key not in resolved]
+    if misses:
+        client = client or InspireHEPClient()
+        for result in _map_chunks(lambda chunk: client.get_id_by_texkey(chunk, max_results), misses, max_results, workers):
+            if result != None:
+                for key, rec_id in result.items():
+                    resolved.setdefault(key, rec_id)
+    return resolved
+
+def fetch_bibtex(texkeys: List[str], db: "InspireHEPDatabase" = None, client: InspireHEPClient = None,
+                 max_results: int = 100, workers: int = 4, cache: bool = True) -> Dict[str, str]:
+    """{texkey: BibTeX entry} for the texkeys that can be resolved, each entry keyed by its texkey.
+
+    Texkeys and BibTeX present in db are used as they are; only the misses are
+    requested from INSPIRE-HEP (see resolve_texkeys), BibTeX in chunks of max_results
+    with up to `workers` requests in flight. With cache=True, fetched BibTeX is stored
+    in db.bibtex when db is writable.
+    """
+    resolved = _resolve_texkeys(texkeys, db, client, 50, workers)
+    rec_ids = list(dict.fromkeys(resolved[key] for key in texkeys if key in resolved))
+    bibtex = db.bibtex.getitem_batched(rec_ids) if db != None else dict()
+
+    missing = [rec_id for rec_id in rec_ids if rec_id not in bibtex]
+    if missing:
+        client = client or InspireHEPClient()
+        # Entries come back unordered; map them to IDs by key, through every known texkey of the records
+        id_by_key = dict(resolved)
+        if db != None:
+            id_by_key.update(_texkeys_of(db, missing))
+        wanted = set(missing)
+        fetched = dict()
+        for entries in _map_chunks(lambda chunk: client.get_bibtex_batched(chunk, max_results), missing, max_results, workers):
+            for entry in entries or []:
+                rec_id = id_by_key.get(bibtex_key(entry))
+                if rec_id in wanted:
+                    fetched[rec_id] = entry.strip() + "\n"
+        if cache and fetched and db != None and not db.readonly:
+            db.bibtex.setitem_batched(fetched)
+        bibtex.update(fetched)
+
+    result = dict()
+    for key in texkeys:
+        entry = bibtex.get(resolved.get(key))
+        if entry != None:
+            result[key] = _re_bibtex_key.sub(lambda m: m.group(1) + key, entry, count=1)
+    return result
+
+def write_bibliography(texkeys: List[str], path: str, db: "InspireHEPDatabase" = None,
+                       client: InspireHEPClient = None, workers: int = 4) -> List[str]:
+    """Write a .bib file with one entry per resolvable texkey, in the given order (see fetch_bibtex).
+
+    Returns the texkeys that could not be resolved.
+
+        keys = latex_tools.extract_cite_keys(open("paper.tex").read())
+        missing = write_bibliography(keys, "paper.bib", db=db)
+    """
+    texkeys = list(dict.fromkeys(texkeys))
+    entries = fetch_bibtex(texkeys, db=db, client=client, workers=workers)
+    with open(path, 'w') as f:
+        f.write("\n".join(entries[key] for key in texkeys if key in entries))
+    return [key for key in texkeys if key not in entries]
+
+
+__all__ = ["InspireHEPClient", "InspireHEPDatabase", "InspireHEPRecordLmdbWrapper", "InspireHEPBibtexLmdbWrapper", "EmbeddingLmdbWrapper", "RECORD_FIELDS", "project_record", "lexical_text", "RateLimitedRequests", "COLD_FIELDS", "reference_ids", "inspirehep_bfs_literature_batch", "bibtex_key", "resolve_texkeys", "fetch_bibtex", "write_bibliography"]
@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import tarfile
+import argparse
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import msgpack
+from typing import Generator, Iterable, List
+import paper_tools.lmdb_wrapper as lmdb_wrapper
+from paper_tools.latex_tools import LatexSnippet
+
+# Batch processing of many LaTeX sources (e.g. unpacked arXiv sources).
+# pylatexenc is pure Python, so the work is CPU-bound; files are sent to a
+# process pool in chunks, with a bounded number of chunks in flight so that a
+# large tarball is never loaded into memory at once. Results are yielded as
+# chunks complete and can be streamed to JSONL or LMDB. A file that fails is
+# reported with an 'error' entry instead of stopping the batch; if a worker dies
+# (e.g. killed for running out of memory), the files it may have been working on
+# are rerun one by one and the pool is replaced.
+#
+#   python -m paper_tools.latex_batch sources.tar.gz results.jsonl --processes 8
+
+DEFAULT_FIELDS = ('well_formed', 'paragraphs', 'sections')
+FIELDS = ('well_formed', 'paragraphs', 'sections', 'maintext')
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+
+def _decode(data: bytes) -> str:
+    return data.decode('utf-8', errors='replace')
+
+def iter_sources(path: str, suffix: str = '.tex') -> Generator[tuple, None, None]:
+    """Yield (name, text) for every source file under a directory or inside a tarball.
+
+    Names are paths relative to the directory, or member names inside the tarball.
+    Directories are walked in sorted order; undecodable bytes are replaced.
+    """
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file_name in sorted(files):
+                if file_name.endswith(suffix):
+                    full = os.path.join(root, file_name)
+                    with open(full, 'rb') as f:
+                        yield os.path.relpath(full, path), _decode(f.read())
+    elif path.endswith(TAR_SUFFIXES):
+        with tarfile.open(path) as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith(suffix):
+                    yield member.name, _decode(tar.extractfile(member).read())
+    else:
+        raise ValueError("Expected a directory or a tarball, got {!r}".format(path))
+
+def process_source(name: str, text: str, fields: Iterable[str] = DEFAULT_FIELDS) -> dict:
+    """Run the requested LatexSnippet extractions on one source.
+
+    Returns {'name': name, field: value, ...}, or {'name': name, 'error': message}
+    if any extraction raises.
+    """
+    try:
+        snippet = LatexSnippet(text)
+        result = {'name': name}
+        for field in fields:
+            if field == 'well_formed':
+                result[field] = snippet.is_well_formed()
+            elif field == 'paragraphs':
+                result[field] = snippet.get_paragraphs()
+            elif field == 'sections':
+                result[field] = snippet.get_sections()
+            elif field == 'maintext':
+                result[field] = snippet.get_maintext()
+            else:
+                raise ValueError("Unknown field {!r}".format(field))
+        return result
+    except Exception as e:
+        return {'name': name, 'error': "{}: {}".format(type(e).__name__, e)}
+
+def process_chunk(chunk: List[tuple], fields: Iterable[str] = DEFAULT_FIELDS) -> List[dict]:
+    """process_source over a list of (name, text) pairs (the unit of work sent to a worker)."""
+    return [process_source(name, text, fields) for name, text in chunk]
+
+def _chunks(sources, chunksize: int):
+    chunk = []
+    for source in sources:
+        chunk.append(source)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def process_sources(sources, fields: Iterable[str] = DEFAULT_FIELDS, processes: int = None,
+                    chunksize: int = 8) -> Generator[dict, None, None]:
+    """Process (name, text) pairs (e.g. from iter_sources) and yield one result dict per file.
+
+    With processes > 1 (default: one per CPU) chunks of chunksize files run in a
+    process pool and results come out in completion order; at most 2 * processes
+    chunks are read ahead. With processes == 1 everything runs in this process, in order.
+    """
+    fields = tuple(fields)
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError("Unknown field {!r}".format(field))
+    processes = processes or os.cpu_count() or 1
+    chunks = _chunks(sources, chunksize)
+    if processes == 1:
+        for chunk in chunks:
+            yield from process_chunk(chunk, fields)
+        return
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+    pending = dict()
+    broken = []
+    try:
+        for chunk in chunks:
+            try:
+                pending[pool.submit(process_chunk, chunk, fields)] = chunk
+            except BrokenProcessPool:
+                broken.append(chunk)
+            if len(pending) >= 2 * processes:
+                yield from _collect(pending, concurrent.futures.FIRST_COMPLETED, broken)
+            if broken:
+                yield from _recover(pool, pending, broken, fields)
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+        while pending:
+            yield from _collect(pending, concurrent.futures.FIRST_COMPLETED, broken)
+            if broken:
+                yield from _recover(pool, pending, broken, fields)
+    finally:
+        pool.shutdown()
+
+def _error(name: str, e: Exception) -> dict:
+    return {'name': name, 'error': "{}: {}".format(type(e).__name__, e)}
+
+def _collect(pending: dict, return_when, broken: list) -> Generator[dict, None, None]:
+    done, _ = concurrent.futures.wait(pending, return_when=return_when)
+    for future in done:
+        chunk = pending.pop(future)
+        try:
+            yield from future.result()
+        except BrokenProcessPool:
+            # A worker died; which file killed it is not known yet
+            broken.append(chunk)
+        except Exception as e:
+            for name, _ in chunk:
+                yield _error(name, e)
+
+def _recover(pool, pending: dict, broken: list, fields) -> Generator[dict, None, None]:
+    """After a worker died: finish the chunks in flight, then rerun the lost ones file by file.
+
+    Each lost file runs alone in a single-worker pool, so only a file that kills
+    its worker again is reported with an 'error' entry.
+    """
+    yield from _collect(pending, concurrent.futures.ALL_COMPLETED, broken)
+    pool.shutdown()
+    sources = [source for chunk in broken for source in chunk]
+    broken.clear()
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+    try:
+        for name, text in sources:
+            try:
+                yield from pool.submit(process_chunk, [(name, text)], fields).result()
+            except BrokenProcessPool as e:
+                yield _error(name, e)
+                pool.shutdown()
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+            except Exception as e:
+                yield _error(name, e)
+    finally:
+        pool.shutdown()
+
+
+class LatexResultsLmdbWrapper(lmdb_wrapper.LmdbWrapperBase):
+    """Batch results keyed by source name, stored as msgpack."""
+    def pack_value(self, value: dict) -> bytes:
+        return msgpack.packb(value)
+    def unpack_value(self, value: bytes) -> dict:
+        return msgpack.unpackb(value)
+
+def write_jsonl(results: Iterable[dict], path: str) -> dict:
+    """Write results to a JSONL file, one line per source. Returns {'processed': n, 'failed': m}."""
+    counts = {'processed': 0, 'failed': 0}
+    with open(path, 'w') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+            counts['failed' if 'error' in result else 'processed'] += 1
+    return counts
+
+def write_lmdb(results: Iterable[dict], path: str, batch_size: int = 256) -> dict:
+    """Write results to an LMDB database keyed by source name. Returns {'processed': n, 'failed': m}."""
+    counts = {'processed': 0, 'failed': 0}
+    with LatexResultsLmdbWrapper(path, readonly=False) as db:
+        batch = dict()
+        for result in results:
+            batch[result['name']] = result
+            counts['failed' if 'error' in result else 'processed'] += 1
+            if len(batch) >= batch_size:
+                db.setitem_batched(batch)
+                batch = dict()
+        if batch:
+            db.setitem_batched(batch)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract paragraphs and sections from many LaTeX sources.")
+    parser.add_argument("source", help="Directory of .tex files or a tarball")
+    parser.add_argument("output", help="Output .jsonl file, or LMDB directory")
+    parser.add_argument("--format", choices=("jsonl", "lmdb"), default=None,
+                        help="Output format (default: jsonl if output ends with .jsonl, else lmdb)")
+    parser.add_argument("--fields", nargs="+", choices=FIELDS, default=list(DEFAULT_FIELDS))
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--chunksize", type=int, default=8, help="Files per task")
+    parser.add_argument("--suffix", default=".tex")
+    args = parser.parse_args()
+    output_format = args.format or ("jsonl" if args.output.endswith(".jsonl") else "lmdb")
+    results = process_sources(iter_sources(args.source, args.suffix), fields=args.fields,
+                              processes=args.processes, chunksize=args.chunksize)
+    if output_format == "jsonl":
+        counts = write_jsonl(results, args.output)
+    else:
+        counts = write_lmdb(results, args.output)
+    print("{processed} processed, {failed} failed".format(**counts), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
+
+
+__all__ = ["iter_sources", "process_source", "process_chunk", "process_sources", "write_jsonl", "write_lmdb",
+           "LatexResultsLmdbWrapper", "DEFAULT_FIELDS", "FIELDS"]
@@ -6,9 +6,12 @@ from pylatexenc.latex2text import LatexNodes2Text
 # from texoutparse import LatexLogParser
 import pipe
 import re
+import hashlib
+import contextlib
+import functools
 
 # TODO
-# unified interface for extracting paragraphs, sections, headlines, removing comments, removing cites, finding cites, test well-formed-ness
+# unified interface for extracting paragraphs, sections, headlines, removing comments, removing cites, test well-formed-ness
 
 def filter_empty(texts:list[str]):
     re_is_empty = re.compile(r"[\n\s]*", re.DOTALL)
@@ -48,12 +51,32 @@ def complement_pairs(pairs:list[tuple[int, int]], final:int) -> list[tuple[int,
     return complement
 
 
+def merge_intervals(pairs:list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """Sort intervals and merge the overlapping or nested ones.
+
+    Visitors report child nodes before their parents, e.g. a comment inside the
+    argument of \\section comes before the \\section node itself; complement_pairs
+    needs the sorted, disjoint form.
+    """
+    merged = []
+    for start, end in sorted(pairs):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+NONTEXT_MACROS = {'documentclass', 'usepackage', 'section', 'subsection', 'newcommand', 'def', 'author', 'date', 'bibliography', 'maketitle', 'document', 'newtheorem'}
+CITE_MACROS = {'cite', 'citep', 'citet', 'citealt', 'citealp', 'citeauthor', 'citeyear', 'citeyearpar', 'citenum',
+               'nocite', 'Cite', 'Citep', 'Citet', 'parencite', 'textcite', 'autocite', 'footcite', 'supercite'}
+
 class NontextVisitor(latexnodes.nodes.LatexNodesVisitor):
     def __init__(self):
         self.result = []
     def visit_macro_node(self, node, **kwargs):
-        nontext_macros = {'documentclass', 'usepackage', 'section', 'subsection', 'newcommand', 'def', 'author', 'date', 'bibliography', 'maketitle', 'document', 'newtheorem'}
-        if node.macroname in nontext_macros:
+        if node.macroname in NONTEXT_MACROS:
             self.result.append(node)
     def visit_comment_node(self, node, **kwargs):
         self.result.append(node)
@@ -70,21 +93,677 @@ class SectionVisitor(latexnodes.nodes.LatexNodesVisitor):
     def visit_macro_node(self, node, **kwargs):
         if node.macroname == 'section':
             self.result.append(node)
+
+class CiteVisitor(latexnodes.nodes.LatexNodesVisitor):
+    def __init__(self):
+        self.result = []
+    def visit_macro_node(self, node, **kwargs):
+        if node.macroname in CITE_MACROS:
+            self.result.append(node)
+
+class CombinedVisitor(latexnodes.nodes.LatexNodesVisitor):
+    """Collect in one traversal what NontextVisitor, CommentVisitor and SectionVisitor collect."""
+    def __init__(self):
+        self.results = {NontextVisitor: [], CommentVisitor: [], SectionVisitor: []}
+    def visit_macro_node(self, node, **kwargs):
+        if node.macroname in NONTEXT_MACROS:
+            self.results[NontextVisitor].append(node)
+        if node.macroname == 'section':
+            self.results[SectionVisitor].append(node)
+    def visit_comment_node(self, node, **kwargs):
+        self.results[NontextVisitor].append(node)
+        self.results[CommentVisitor].append(node)
         
+# Fast path ------------------------------------------------------------------
+# Comments and \section positions only need a linear scan of the tokens that
+# change how the rest of the text is read: escapes (\%), comments, verbatim
+# constructs, and the braces, environments and math delimiters that must be
+# balanced. Input the scanner cannot read the way the walker does (unbalanced
+# groups, which pylatexenc's tolerant parser recovers from unpredictably,
+# unterminated verbatim, \verb*) is reported as ambiguous and left to the walker.
+
+VERBATIM_ENVIRONMENTS = {'verbatim', 'lstlisting'}
+_CITE_TOKENS = {'\\' + name for name in CITE_MACROS}
+
+_re_token = re.compile(r"\\(?:[A-Za-z]+|.?)|%|\$\$?|[{}]|\n[^\S\n]*\n\s*", re.DOTALL)
+_re_space = re.compile(r"\s*")
+_re_environment_name = re.compile(r"\s*\{([^{}]*)\}")
+_re_lstlisting_comment_option = re.compile(r"\s*\[[^\]]*%")
+_OPTIONAL_STARTS = frozenset('[* \t\n')  # what may come before an optional argument
+_re_optional_token = re.compile(r"\\(?:[A-Za-z]+|.?)|%[^\n]*|[{}$\[\]]", re.DOTALL)
+_math_close = {')': '(', ']': '['}
+
+class LatexScan:
+    """Result of scan_latex: comment intervals (as reported by CommentVisitor), \\section positions,
+    the positions where a top-level block (see LatexDocument) may start, and citation macro positions."""
+    def __init__(self, comments:list[tuple[int, int]], sections:list[int], breaks:list[int], cites:list[int]):
+        self.comments = comments
+        self.sections = sections
+        self.breaks = breaks
+        self.cites = cites
+
+def _comment_end(text:str, pos:int) -> int:
+    """End of the comment starting at pos, including the line break and the
+    indentation of the next line unless a blank line (paragraph break) follows."""
+    newline = text.find('\n', pos + 1)
+    if newline == -1:
+        return len(text)
+    space_end = _re_space.match(text, newline).end()
+    if text.count('\n', newline, space_end) >= 2:
+        return newline
+    return space_end
+
+_MAX_ARGUMENTS = 8  # tokens looked back over for a macro still waiting for arguments
+
+_default_context = latexwalker.get_default_latex_context_db()  # built once: each call makes a new one
+
+@functools.lru_cache(maxsize=None)
+def _argument_kinds(name:str, environment:bool=False) -> tuple:
+    """'*', '[' or '{' (mandatory) for each argument of a macro or environment in the default pylatexenc context."""
+    spec = _default_context.get_environment_spec(name) if environment else _default_context.get_macro_spec(name)
+    kinds = []
+    for argument in (spec.arguments_spec_list or []) if spec is not None else []:
+        parser = argument if isinstance(argument, str) else argument.parser
+        kind = parser if isinstance(parser, str) else getattr(parser, 'arg_spec', '{')
+        kinds.append(kind if kind in ('*', '[') else '{')
+    return tuple(kinds)
+
+def _consumed_arguments(kinds:list, arguments:list):
+    """How many of arguments a macro taking kinds of arguments consumes, or None if a mandatory one is missing.
+
+    None too if a mandatory one would be a [...] group, which the walker does
+    not read as one argument.
+    """
+    i = 0
+    for kind in kinds:
+        if kind == '{' and i < len(arguments) and arguments[i] == '[':
+            return None
+        if i < len(arguments) and (kind == '{' or arguments[i] == kind):
+            i += 1
+        elif kind == '{':
+            return None
+    return i
+
+def _code_end(text:str, start:int, end:int) -> int:
+    """End of text[start:end] before a comment on that line."""
+    if text.find('%', start, end) == -1:
+        return end
+    for token in _re_token.finditer(text, start, end):
+        if token.group() == '%':
+            return token.start()
+    return end
+
+def _space_start(text:str, pos:int, floor:int=-1) -> int:
+    """Start of the whitespace, and the comments on earlier lines, before text[pos], not going back past floor."""
+    if pos > 0 and not text[pos - 1].isspace():
+        return pos
+    line_start = text.rfind('\n', 0, pos) + 1
+    while True:
+        while pos > line_start and pos > floor and text[pos - 1].isspace():
+            pos -= 1
+        if pos > line_start or line_start == 0 or pos <= floor:
+            return pos
+        pos = _code_end(text, max(text.rfind('\n', 0, line_start - 1) + 1, floor), line_start - 1)
+        line_start = text.rfind('\n', 0, pos) + 1
+
+def _escaped(text:str, pos:int) -> bool:
+    """Whether text[pos] follows an odd number of backslashes."""
+    start = pos
+    while start > 0 and text[start - 1] == '\\':
+        start -= 1
+    return (pos - start) % 2 == 1
+
+def _optional_closed(text:str, pos:int, final:bool):
+    """Whether an optional [...] argument starting after text[pos] is closed.
+
+    True when no '[' follows, None when the text ends before it could be told.
+    Groups, nested brackets, inline math and comments inside the brackets are
+    skipped; a \\verb there counts as not closed.
+    """
+    start = _re_space.match(text, pos).end()
+    if start < len(text) and text[start] == '*':
+        start = _re_space.match(text, start + 1).end()
+    if start >= len(text):
+        return None if not final else True
+    if text[start] != '[':
+        return True
+    depth = 0
+    brackets = 0
+    math = False
+    for match in _re_optional_token.finditer(text, start + 1):
+        token = match.group()
+        if token[0] == '%':
+            if match.end() >= len(text) and not final:
+                return None  # the comment may go on
+        elif token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth < 0:
+                return False
+        elif token == '$':
+            math = not math
+        elif token == '\\verb':
+            return False
+        elif math or depth:
+            continue
+        elif token == '[':
+            brackets += 1
+        elif token == ']':
+            if brackets == 0:
+                return True
+            brackets -= 1
+    return None if not final else False
+
+def _group_start(text:str, end:int):
+    """Start of the {...} or [...] group closed at text[end], or None if it cannot be told.
+
+    Comments inside the group are skipped line by line.
+    """
+    closing = text[end]
+    depth = 0
+    brackets = 0  # nested [...] in a [...] group
+    line_start = text.rfind('\n', 0, end) + 1
+    code_end = end
+    while True:
+        for i in range(code_end - 1, line_start - 1, -1):
+            char = text[i]
+            if char not in '{}[]' or _escaped(text, i):
+                continue  # \{, \}, but not \\[
+            if char == '}':
+                depth += 1
+            elif char == '{':
+                if depth == 0:
+                    return i if closing == '}' else None
+                depth -= 1
+            elif closing != ']' or depth:
+                continue
+            elif char == ']':
+                brackets += 1
+            elif brackets == 0:
+                return i
+            else:
+                brackets -= 1
+        if line_start == 0:
+            return None
+        line_end = line_start - 1
+        line_start = text.rfind('\n', 0, line_end) + 1
+        code_end = _code_end(text, line_start, line_end)
+
+def _takes_optional(text:str, opening) -> bool:
+    """Whether the [ at text[opening] may be read by the walker as the start of an optional argument.
+
+    Only a macro, or the arguments it has read so far, can take one there;
+    False after other text, and if opening is None.
+    """
+    if opening is None:
+        return False
+    before = _space_start(text, opening)
+    if before > 0 and text[before - 1] == '*':
+        before = _space_start(text, before - 1)
+    if before == 0:
+        return False
+    if text[before - 1] in '}]':
+        return True  # may be a macro's earlier argument
+    name_start = before - 1
+    if text[name_start].isalpha():
+        while name_start > 0 and text[name_start - 1].isalpha():
+            name_start -= 1
+    if not _escaped(text, name_start):
+        return False
+    return '[' in _argument_kinds(text[name_start:before])
+
+def _macro_argument_kinds(text:str, name:str, start:int, end:int):
+    """Argument kinds of the macro text[start:end]; for \\begin, the name group and the environment's arguments.
+
+    None if the environment name cannot be read.
+    """
+    if name == 'begin':
+        group = _re_environment_name.match(text, end)
+        if group is None:
+            return None
+        return ('{',) + _argument_kinds(group.group(1).strip(), environment=True)
+    return _argument_kinds(name)
+
+def _in_macro_arguments(text:str, start:int, floor:int=-1):
+    """Whether text[start] (a comment, \\begin, \\end, \\section or a blank line) may be read as part of a macro's mandatory arguments.
+
+    The walker reads a comment there as part of the arguments, not as a comment
+    node, and an environment there as the argument. Going back from start over
+    up to _MAX_ARGUMENTS argument-like tokens (groups, a star, macros, single
+    characters; the walker looks for arguments across blank lines too), every
+    macro found is checked against its argument spec in the default pylatexenc
+    context, with the tokens after it as its arguments. A macro may itself be an
+    argument of an earlier one, and may or may not have absorbed the tokens after
+    it, so both readings are checked. Unclear cases count as ambiguous. None
+    (no) if start is inside the content of a group, which may still turn out
+    to be an argument once it is closed. floor is the end of the last verbatim
+    text, where the scanner found no macro waiting: the look back stops there,
+    and going past it (a group around the verbatim text) is unclear.
+    """
+    separate = []   # argument kinds after the current position, every token on its own
+    collapsed = []  # the same, with each macro having absorbed the arguments it takes
+    pos = _code_end(text, max(text.rfind('\n', 0, start) + 1, floor), start)  # a blank line may follow a comment
+    while len(separate) <= _MAX_ARGUMENTS:
+        before = _space_start(text, pos, floor)
+        if before <= floor:
+            return before < floor
+        if before == 0:
+            return False
+        char = text[before - 1]
+        name_start = before - 1
+        while name_start > 0 and text[name_start - 1].isalpha():
+            name_start -= 1
+        if char.isalpha() and _escaped(text, name_start):
+            name, pos = text[name_start:before], name_start - 1
+        elif not char.isalpha() and _escaped(text, before - 1):
+            name, pos = char, before - 2
+        else:
+            name = None
+        if name is not None:
+            kinds = _macro_argument_kinds(text, name, pos, before)
+            if kinds is None:
+                return True
+            consumed = _consumed_arguments(kinds, collapsed)
+            if consumed is None or _consumed_arguments(kinds, separate) is None:
+                return True
+            separate.insert(0, '{')
+            collapsed[:consumed] = ['{']
+            continue
+        if char in '}]':
+            opening = _group_start(text, before - 1)
+            if char == ']' and not _takes_optional(text, opening):
+                kind = '{'  # a plain ] character
+                pos = before - 1
+            elif opening is None:
+                return True
+            else:
+                kind = '{' if char == '}' else '['
+                pos = opening
+        elif char == '[' and not _takes_optional(text, before - 1):
+            kind = '{'
+            pos = before - 1
+        elif char in '{[':
+            return None  # inside the content of a group
+        elif char.isalpha():
+            # a word: one single-letter argument per letter
+            letters = min(before - name_start, _MAX_ARGUMENTS + 1)
+            separate[:0] = ['{'] * letters
+            collapsed[:0] = ['{'] * letters
+            pos = name_start
+            continue
+        else:
+            kind = '*' if char == '*' else '{'
+            pos = before - 1
+        separate.insert(0, kind)
+        collapsed.insert(0, kind)
+    return False
+
+class LatexScanner:
+    """Incremental scan_latex: feed() the text in pieces, take() scanned blocks from the front.
+
+    Positions are absolute, counted from the start of the first piece. Tokens that
+    may continue in the next piece (a macro name, a comment and the whitespace
+    after it, a blank line, verbatim content) are left for the next feed().
+    After an ambiguous token, ambiguous is set and scanning stops.
+    """
+
+    def __init__(self, start:int=0):
+        """start: absolute position of the first piece (when resuming within a source)."""
+        self.buffer = ""
+        self.base = start    # absolute position of buffer[0]
+        self.offset = start  # absolute position of the first character not taken yet
+        self.pos = 0     # scan position in buffer
+        self.stack = []  # open '{', environment names and math delimiters, innermost last
+        self.comments = []
+        self.sections = []
+        self.breaks = []
+        self.cites = []
+        self.last_break = start
+        self.last_macro = -1     # absolute position of the last macro scanned
+        self.checked = start     # no macro before this position is waiting for arguments
+        self.verbatim_end = -1   # absolute end of the last \verb or verbatim environment
+        self.ambiguous = False
+        self.final = False
+
+    def feed(self, text:str, final:bool=False):
+        """Append text and scan as far as possible; final=True marks the end of the input."""
+        taken = self.offset - self.base
+        if taken:
+            self.buffer = self.buffer[taken:]
+            self.base = self.offset
+            self.pos -= taken
+        self.buffer += text
+        self.final = final
+        if not self.ambiguous:
+            self._scan()
+
+    def take(self, end:int):
+        """Remove the text before absolute position end (a break, or the end of a final scan).
+
+        Returns (start, text, comments, sections) with comments and sections relative to start.
+        """
+        start = self.offset
+        text = self.buffer[start - self.base:end - self.base]
+        self.offset = end
+        n = 0
+        while n < len(self.comments) and self.comments[n][0] < end:
+            n += 1
+        comments = [(a - start, b - start) for a, b in self.comments[:n]]
+        del self.comments[:n]
+        n = 0
+        while n < len(self.sections) and self.sections[n] < end:
+            n += 1
+        sections = [p - start for p in self.sections[:n]]
+        del self.sections[:n]
+        while self.breaks and self.breaks[0] <= end:
+            self.breaks.pop(0)
+        while self.cites and self.cites[0] < end:
+            self.cites.pop(0)
+        return start, text, comments, sections
+
+    def remaining(self) -> str:
+        """Text fed but not taken yet."""
+        return self.buffer[self.offset - self.base:]
+
+    def _scan(self):
+        text = self.buffer
+        length = len(text)
+        offset = self.base
+        final = self.final
+        comments = self.comments
+        sections = self.sections
+        breaks = self.breaks
+        cites = self.cites
+        stack = self.stack
+        def top_level():
+            # nothing open except the document environment
+            return not stack or stack == ['env:document']
+        def add_break(position):
+            position += offset
+            if self.last_break < position < offset + length:
+                breaks.append(position)
+                self.last_break = position
+        def in_arguments(position):
+            # arguments found at an earlier check stay found: only a macro
+            # scanned since then can still be waiting for one
+            if self.last_macro < self.checked:
+                return False
+            found = _in_macro_arguments(text, position, self.verbatim_end - offset)
+            if found is False:
+                self.checked = offset + position
+            return found
+        pos = self.pos
+        while True:
+            match = _re_token.search(text, pos)
+            if match is None:
+                if not final:
+                    # a blank line may start after the last line break
+                    newline = text.rfind('\n', pos)
+                    pos = newline if newline != -1 else length
+                break
+            start = match.start()
+            token = match.group()
+            if not final and match.end() >= length:
+                break
+            pos = match.end()
+            if (token[0] == '\\' and (pos == length or text[pos] in _OPTIONAL_STARTS)
+                    and token not in ('\\begin', '\\end', '\\verb') and '[' in _argument_kinds(token[1:])):
+                # the walker reads an unclosed [ up to the end of the text
+                closed = _optional_closed(text, pos, final)
+                if closed is None:
+                    pos = start
+                    break
+                if not closed:
+                    self.ambiguous = True
+                    break
+            if token == '%':
+                pos = _comment_end(text, start)
+                if not final and pos >= length:
+                    pos = start
+                    break
+                if in_arguments(start):
+                    self.ambiguous = True
+                    break
+                comments.append((offset + start, offset + pos))
+            elif token[0] == '\n':
+                if top_level():
+                    if in_arguments(start):
+                        self.ambiguous = True
+                        break
+                    add_break(pos)
+            elif token == '{':
+                stack.append('{')
+            elif token == '}':
+                if not stack or stack.pop() != '{':
+                    self.ambiguous = True
+                    break
+            elif token[0] == '$':
+                if stack and stack[-1] == token:
+                    stack.pop()
+                elif stack and stack[-1] in ('$', '$$'):
+                    self.ambiguous = True
+                    break
+                else:
+                    stack.append(token)
+            elif token in ('\\(', '\\['):
+                stack.append(token[1])
+            elif token in ('\\)', '\\]'):
+                if not stack or stack.pop() != _math_close[token[1]]:
+                    self.ambiguous = True
+                    break
+            elif token == '\\section':
+                if in_arguments(start):
+                    self.ambiguous = True
+                    break
+                sections.append(offset + start)
+                if top_level():
+                    add_break(start)
+            elif token in _CITE_TOKENS:
+                cites.append(offset + start)
+            elif token == '\\verb':
+                if in_arguments(start) is not False:
+                    # an argument of a pending macro is the bare \verb token
+                    self.ambiguous = True
+                    break
+                delimiter = _re_space.match(text, pos).end()
+                end = text.find(text[delimiter], delimiter + 1) if delimiter < length else -1
+                if end == -1 and not final:
+                    pos = start
+                    break
+                if end == -1 or text[delimiter] == '*' or text[delimiter].isalpha():
+                    self.ambiguous = True
+                    break
+                pos = end + 1
+                self.verbatim_end = offset + pos
+            elif token in ('\\begin', '\\end'):
+                name = _re_environment_name.match(text, pos)
+                if not final and (name is None and text.find('}', pos) == -1 or name is not None and name.end() >= length):
+                    pos = start
+                    break
+                if name is None or in_arguments(start):
+                    self.ambiguous = True
+                    break
+                environment = name.group(1)
+                pos = name.end()
+                if environment == 'document' and top_level():
+                    # \begin{document} and \end{document} are blocks of their own
+                    add_break(start)
+                    add_break(pos)
+                if token == '\\end':
+                    if not stack or stack.pop() != 'env:' + environment:
+                        self.ambiguous = True
+                        break
+                elif environment.rstrip('*') in VERBATIM_ENVIRONMENTS:
+                    end = text.find('\\end{' + environment + '}', pos)
+                    if end == -1 and not final:
+                        # rescan the \begin once the end marker has arrived
+                        pos = start
+                        break
+                    if end == -1 or environment.endswith('*') or _re_lstlisting_comment_option.match(text, pos):
+                        self.ambiguous = True
+                        break
+                    pos = end + len('\\end{' + environment + '}')
+                    self.verbatim_end = offset + pos
+                else:
+                    stack.append('env:' + environment)
+            if token[0] == '\\':
+                self.last_macro = offset + start
+        self.pos = pos
+        if final and stack:
+            self.ambiguous = True
+
+def scan_latex(text:str):
+    """Find comments and \\section macros in one linear scan, without parsing.
+
+    Returns a LatexScan, or None if the text is ambiguous for the scanner and
+    must go through the full LatexWalker.
+    """
+    scanner = LatexScanner()
+    scanner.feed(text, final=True)
+    if scanner.ambiguous:
+        return None
+    return LatexScan(scanner.comments, scanner.sections, scanner.breaks, scanner.cites)
+
+
+_cite_names = "|".join(sorted(CITE_MACROS, key=len, reverse=True))
+_re_cite_arguments = re.compile(r"\\(?:" + _cite_names + r")\*?\s*(?:\[[^\]]*\]\s*){0,2}\{(?P<keys>[^{}]*)\}")
+_re_key_comment = re.compile(r"(?<!\\)%[^\n]*\n?")
+
+def parse_cite(text:str, pos:int):
+    """Parse the citation command starting at pos: (end, keys), or None if it has no {keys} argument."""
+    match = _re_cite_arguments.match(text, pos)
+    if match is None:
+        return None
+    keys = [key.strip() for key in _re_key_comment.sub('', match.group('keys')).split(',')]
+    return match.end(), [key for key in keys if key and '#' not in key]  # '#1': argument of a macro definition
+
+
+# Plain text -------------------------------------------------------------------
+# get_text_chunks turns the cached node list into plain text in one traversal:
+# comments, citation commands and nontext macros render as nothing, the rest goes
+# through LatexNodes2Text node by node, and paragraph breaks in the source split
+# the output into chunks that keep the span of LaTeX they came from.
+
+DISCARDED_ENVIRONMENTS = {'thebibliography'}
+
+def _plain_text_converter():
+    from pylatexenc.latex2text import MacroTextSpec, EnvironmentTextSpec, get_default_latex_context_db
+    context = get_default_latex_context_db()
+    context.add_context_category(
+        'paper-tools-discard', prepend=True,
+        macros=[MacroTextSpec(name, discard=True) for name in CITE_MACROS | NONTEXT_MACROS | {'ref', 'eqref'}],
+        environments=[EnvironmentTextSpec(name, discard=True) for name in DISCARDED_ENVIRONMENTS],
+    )
+    return LatexNodes2Text(latex_context=context)
+
+_re_plain_space = re.compile(r"\s+")
+_re_space_before_punctuation = re.compile(r" ([.,;:!?)])")
+_re_source_break = re.compile(r"\n[^\S\n]*\n\s*")
+
+class TextChunk:
+    """Plain text of one paragraph, and the [start, end) span of the LaTeX source it was converted from."""
+    def __init__(self, start:int, end:int, text:str):
+        self.start = start
+        self.end = end
+        self.text = text
+    def __repr__(self):
+        return "TextChunk({}, {}, {!r})".format(self.start, self.end, self.text)
+    def __eq__(self, other):
+        return isinstance(other, TextChunk) and (self.start, self.end, self.text) == (other.start, other.end, other.text)
+
+def _text_chunks(nodelist, converter) -> list:
+    chunks = []
+    pieces = []  # (start, end, plain, plain is the source text) of the current paragraph
+
+    def flush():
+        text = _re_space_before_punctuation.sub(r"\1", _re_plain_space.sub(' ', ''.join(p[2] for p in pieces))).strip()
+        spans = [p for p in pieces if p[2].strip()]
+        if text and spans:
+            start, _, first, exact = spans[0]
+            if exact:
+                start += len(first) - len(first.lstrip())
+            _, end, last, exact = spans[-1]
+            if exact:
+                end -= len(last) - len(last.rstrip())
+            chunks.append(TextChunk(start, end, text))
+        pieces.clear()
+
+    def walk(nodes):
+        for node in nodes or []:
+            if node is None or node.isNodeType(latexwalker.LatexCommentNode):
+                continue
+            if node.isNodeType(latexwalker.LatexSpecialsNode) and not node.specials_chars.strip():
+                flush()  # paragraph break
+            elif node.isNodeType(latexwalker.LatexCharsNode):
+                pos = node.pos
+                for match in _re_source_break.finditer(node.chars):
+                    pieces.append((pos, node.pos + match.start(), node.chars[pos - node.pos:match.start()], True))
+                    flush()
+                    pos = node.pos + match.end()
+                pieces.append((pos, node.pos_end, node.chars[pos - node.pos:], True))
+            elif node.isNodeType(latexwalker.LatexMacroNode) and node.macroname in ('section', 'subsection', 'par'):
+                flush()  # a heading or \par ends the paragraph
+            elif node.isNodeType(latexwalker.LatexMacroNode) and node.macroname in NONTEXT_MACROS:
+                pass
+            else:
+                pieces.append((node.pos, node.pos_end, converter.node_to_text(node), False))
+                if node.isNodeType(latexwalker.LatexMacroNode) and node.macro_post_space:
+                    pieces.append((node.pos_end, node.pos_end, ' ', False))
+
+    # Only the body of a full tex file
+    documents = [node for node in nodelist or [] if node is not None
+                 and node.isNodeType(latexwalker.LatexEnvironmentNode) and node.environmentname == 'document']
+    walk(documents[0].nodelist if documents else nodelist)
+    flush()
+    return chunks
+
+
 class LatexSnippet:
-    """Handles a piece of LaTeX code. Could be an entire tex file or just a snippet."""
+    """Handles a piece of LaTeX code. Could be an entire tex file or just a snippet.
+
+    The code is parsed at most once, on first use; the node list and the nodes
+    collected by the visitors above are cached. Comment removal, paragraphs and
+    sections use scan_latex instead of the parse unless the text is ambiguous
+    for the scanner or fast is False.
+    """
     
-    def __init__(self, text:str):
+    def __init__(self, text:str, fast:bool=True):
         """Initialize the class with the LaTeX code input."""
         self.text = text
         self.walker = latexwalker.LatexWalker(text)
+        self.fast = fast
+        self._parsed = None
+        self._visited = None
+        self._scanned = None
+
+    def scan(self):
+        """Return the cached LatexScan of the snippet, or None if the walker has to be used."""
+        if not self.fast:
+            return None
+        if self._scanned is None:
+            self._scanned = (scan_latex(self.text),)
+        return self._scanned[0]
+
+    def parse(self):
+        """Return the node list of the snippet, parsing on the first call. Raises if parsing failed."""
+        if self._parsed is None:
+            try:
+                nodelist, parsing_state_delta = self.walker.parse_content(
+                    latexnodes.parsers.LatexGeneralNodesParser()
+                )
+                self._parsed = (nodelist, None)
+            except Exception as e:
+                self._parsed = (None, e)
+        nodelist, error = self._parsed
+        if error is not None:
+            raise error
+        return nodelist
         
     def is_well_formed(self):
         """Return true if the snippet is well-formed LaTeX code."""
         try:
-            nodelist, parsing_state_delta = self.walker.parse_content(
-                latexnodes.parsers.LatexGeneralNodesParser()
-            )
+            nodelist = self.parse()
             if nodelist is None:
                 return False
             is_well_formed = True
@@ -93,29 +772,38 @@ class LatexSnippet:
         
         return is_well_formed
 
+    def visited_nodes(self, visitor_class):
+        """Nodes collected by visitor_class over the cached node list.
+
+        NontextVisitor, CommentVisitor and SectionVisitor share one traversal.
+        """
+        nodelist = self.parse()
+        if nodelist is None:
+            return []
+        if self._visited is None:
+            visitor = CombinedVisitor()
+            visitor.start(nodelist)
+            self._visited = visitor.results
+        if visitor_class in self._visited:
+            return self._visited[visitor_class]
+        visitor = visitor_class()
+        visitor.start(nodelist)
+        return visitor.result
+
     def get_intervals(self, visitor_class, reverse=False):
         """Extract start and end positions of the LaTeX code given a visitor class.
 
         Extract start and end positions of the LaTeX code that is visited by visitor.
         Complement the intervals if reverse is set to True.
         """
-        nodelist, parsing_state_delta = self.walker.parse_content(
-            latexnodes.parsers.LatexGeneralNodesParser()
-        )
+        nodelist = self.parse()
 
         if nodelist is None:
             return [] if not reverse else [(0, len(self.text))]
 
-        npos = nodelist.pos
-        nlen = nodelist.len
-        # print("npos = {}, nlen = {}, len(text) = {}".format(npos, nlen, len(self.text)))
-
-        visitor = visitor_class()
-        visitor.start(nodelist)
-
-        result = list(visitor.result | pipe.select(lambda n: (n.pos, n.pos_end)))
+        result = list(self.visited_nodes(visitor_class) | pipe.select(lambda n: (n.pos, n.pos_end)))
         if reverse:
-            result = complement_pairs(result, len(self.text))
+            result = complement_pairs(merge_intervals(result), len(self.text))
         
         return result
 
@@ -128,7 +816,11 @@ class LatexSnippet:
         return [self.walker.s[p[0]:p[1]] for p in intervals]
 
     def comments_removed(self):
-        intervals = self.get_intervals(CommentVisitor, reverse=True)
+        scan = self.scan()
+        if scan is not None:
+            intervals = complement_pairs(scan.comments, len(self.text))
+        else:
+            intervals = self.get_intervals(CommentVisitor, reverse=True)
         return self.get_subtext(intervals)
 
     def nontext_removed(self):
@@ -147,35 +839,350 @@ class LatexSnippet:
         return filter_empty(paragraphs)
 
     def get_sections(self):
-        nodelist, parsing_state_delta = self.walker.parse_content(
-            latexnodes.parsers.LatexGeneralNodesParser()
-        )
-        if nodelist is None:
-            return []
-        npos = nodelist.pos
-        nlen = nodelist.len
-        
-        visitor = SectionVisitor()
-        visitor.start(nodelist)
-    
-        section_pos = list(visitor.result | pipe.select(lambda node: node.pos))
+        scan = self.scan()
+        if scan is not None:
+            section_pos = scan.sections
+        else:
+            section_pos = list(self.visited_nodes(SectionVisitor) | pipe.select(lambda node: node.pos))
         needed_sections = [(section_pos[i], section_pos[i+1]) for i in range(len(section_pos)-1)]
         sections = [self.walker.s[p[0]:p[1]] for p in needed_sections]
     
         return sections
 
+    def get_cites(self):
+        """(start, end, keys) of every citation command (\\cite, \\citep, ... see CITE_MACROS), in text order.
+
+        Commands inside comments and verbatim are ignored.
+        """
+        scan = self.scan()
+        if scan is not None:
+            positions = scan.cites
+        else:
+            positions = sorted(self.visited_nodes(CiteVisitor) | pipe.select(lambda node: node.pos))
+        result = []
+        for pos in positions:
+            parsed = parse_cite(self.text, pos)
+            if parsed is not None:
+                result.append((pos, parsed[0], parsed[1]))
+        return result
+
+    def get_cite_keys(self):
+        """Cited keys in order of first citation, without duplicates."""
+        return list(dict.fromkeys(key for _, _, keys in self.get_cites() for key in keys))
+
+    _converter = None
+    def get_text_chunks(self):
+        """Plain text as one TextChunk per paragraph, ready to embed (only the body of a full tex file).
+
+        Comments, citation commands, \\ref and nontext macros (with their arguments)
+        are dropped, and the rest is converted with LatexNodes2Text during a single
+        traversal of the cached parse; \\section and blank lines start a new chunk.
+        """
+        nodelist = self.parse()
+        if LatexSnippet._converter is None:
+            LatexSnippet._converter = _plain_text_converter()
+        return _text_chunks(nodelist, LatexSnippet._converter)
+
     def get_maintext(self):
-        """Extract the main text of a full tex file."""
-        cleaned = self.comments_removed()
-        cleaned_snippet = LatexSnippet(cleaned)
-        nontext = cleaned_snippet.nontext_removed()
-        return nontext
+        """Extract the main text of a full tex file.
+
+        Comments and nontext macros are removed in one pass over the original
+        text, using the cached parse (NontextVisitor also collects comments).
+        A nontext macro directly followed by a comment parses differently once the
+        comment is gone (e.g. whitespace it absorbed becomes part of a paragraph
+        break); then the comment-free text is parsed again, like
+        comments_removed() followed by nontext_removed().
+        """
+        if _macro_before_comment(self):
+            return LatexSnippet(self.comments_removed(), fast=self.fast).nontext_removed()
+        return self.get_subtext(self.get_intervals(NontextVisitor, reverse=True))
+
+def _macro_before_comment(snippet) -> bool:
+    """Whether a nontext macro ends where a comment starts (see LatexSnippet.get_maintext)."""
+    comment_starts = set(start for start, _ in snippet.get_intervals(CommentVisitor))
+    return any(end in comment_starts for start, end in snippet.get_intervals(NontextVisitor)
+               if start not in comment_starts)
+
+# Incremental documents --------------------------------------------------------
+# A LatexDocument is split at top-level paragraph breaks and \section macros
+# (scan_latex breaks), and every block is parsed on its own. Blocks are cached
+# by content hash, so after an edit only the blocks whose text changed are parsed
+# again; positions are kept relative to the block and shifted on use.
+
+_BUILTIN_VISITORS = (NontextVisitor, CommentVisitor, SectionVisitor)
+_re_document_marker = re.compile(r"\s*\\(?:begin|end)\s*\{document\}\s*")
+
+class LatexBlock:
+    """Walker results for one block of a LatexDocument, with positions relative to the block."""
+    def __init__(self, text:str):
+        self.length = len(text)
+        self.error = None
+        self.intervals = {visitor_class: [] for visitor_class in _BUILTIN_VISITORS}
+        if _re_document_marker.fullmatch(text):
+            # \begin{document} / \end{document} alone: nothing to collect, and an
+            # unmatched environment would confuse the walker
+            self.well_formed = True
+            return
+        snippet = LatexSnippet(text)
+        self.well_formed = snippet.is_well_formed()
+        try:
+            for visitor_class in _BUILTIN_VISITORS:
+                self.intervals[visitor_class] = snippet.get_intervals(visitor_class)
+        except Exception as e:
+            self.error = e
+
+def block_key(text:str) -> bytes:
+    """Content hash identifying a block in the LatexDocument cache."""
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+class LatexDocument:
+    """LaTeX source kept as independently parsed top-level blocks, for repeated checks of a draft.
+
+    update(text) re-splits the source and parses only the blocks not seen in the
+    previous version. The extraction methods mirror LatexSnippet's and give the
+    same results, from the cached per-block intervals.
+    """
+
+    def __init__(self, text:str=""):
+        self.text = ""
+        self.blocks = []  # (start, key) in text order
+        self._cache = dict()  # key -> LatexBlock
+        self._maintext = None  # (text, get_maintext result) when it needed a full parse
+        self.update(text)
+
+    @staticmethod
+    def split_blocks(text:str) -> list[tuple[int, int]]:
+        """(start, end) of the top-level blocks of text; the whole text if scan_latex finds it ambiguous."""
+        scan = scan_latex(text)
+        starts = [0] + (scan.breaks if scan is not None else [])
+        return [(starts[i], starts[i+1] if i+1 < len(starts) else len(text)) for i in range(len(starts))]
+
+    def update(self, text:str) -> int:
+        """Replace the source with text. Returns the number of blocks that had to be parsed."""
+        blocks = []
+        cache = dict()
+        parsed = 0
+        for start, end in self.split_blocks(text):
+            block_text = text[start:end]
+            key = block_key(block_text)
+            if key not in cache:
+                block = self._cache.get(key)
+                if block is None:
+                    block = LatexBlock(block_text)
+                    parsed += 1
+                cache[key] = block
+            blocks.append((start, key))
+        self.text = text
+        self.blocks = blocks
+        self._cache = cache
+        return parsed
+
+    def is_well_formed(self):
+        """Return true if every block is well-formed LaTeX code."""
+        return all(self._cache[key].well_formed for _, key in self.blocks)
+
+    def get_intervals(self, visitor_class, reverse=False):
+        """Like LatexSnippet.get_intervals; only the built-in visitors are served from the block cache."""
+        if visitor_class not in _BUILTIN_VISITORS:
+            return LatexSnippet(self.text).get_intervals(visitor_class, reverse)
+        result = []
+        for start, key in self.blocks:
+            block = self._cache[key]
+            if block.error is not None:
+                raise block.error
+            result.extend((start + a, start + b) for a, b in block.intervals[visitor_class])
+        if reverse:
+            result = complement_pairs(merge_intervals(result), len(self.text))
+        return result
+
+    def get_subtext(self, intervals:list[tuple[int,int]]):
+        """Extract text corresponding to the intervals (start and end positions)."""
+        return "".join([self.text[p[0]:p[1]] for p in intervals])
+
+    def comments_removed(self):
+        return self.get_subtext(self.get_intervals(CommentVisitor, reverse=True))
+
+    def nontext_removed(self):
+        return self.get_subtext(self.get_intervals(NontextVisitor, reverse=True))
+
+    def get_maintext(self):
+        """Like LatexSnippet.get_maintext; when a nontext macro precedes a comment, the
+        comment-free text is parsed as a whole, and the result kept until the text changes."""
+        if not _macro_before_comment(self):
+            return self.nontext_removed()
+        if self._maintext == None or self._maintext[0] != self.text:
+            self._maintext = (self.text, LatexSnippet(self.comments_removed()).nontext_removed())
+        return self._maintext[1]
+
+    def get_paragraphs(self):
+        """Extract the paragraphs of a full tex file."""
+        return filter_empty(split_to_paragraphs(self.comments_removed()))
+
+    def get_sections(self):
+        section_pos = [p[0] for p in self.get_intervals(SectionVisitor)]
+        return [self.text[section_pos[i]:section_pos[i+1]] for i in range(len(section_pos)-1)]
+
+
+# Streaming --------------------------------------------------------------------
+# Very large sources are read in chunks through a LatexScanner and handed out in
+# the blocks LatexDocument uses, so only the current block, paragraph or section
+# is held in memory. After an ambiguous token the walker parses a bounded
+# lookahead instead, the block ends at the first blank line outside every node
+# it found, and scanning resumes there; only when no such blank line turns up within
+# max_lookahead characters is the rest of the source parsed as one block.
+
+class StreamBlock:
+    """One top-level block of a streamed source.
+
+    start is the offset of the block in the source; comments (intervals) and
+    sections (\\section positions) are relative to start.
+    """
+    def __init__(self, start:int, text:str, comments:list[tuple[int, int]], sections:list[int]):
+        self.start = start
+        self.text = text
+        self.comments = comments
+        self.sections = sections
+
+    def comments_removed(self):
+        intervals = complement_pairs(merge_intervals(self.comments), len(self.text))
+        return "".join([self.text[p[0]:p[1]] for p in intervals])
+
+def _open_source(source):
+    if isinstance(source, str):
+        return open(source)
+    return contextlib.nullcontext(source)
+
+def _node_spans(nodelist) -> list[tuple[int, int]]:
+    """(pos, pos_end) of the top-level nodes other than text, looking inside the document environment."""
+    spans = []
+    for node in nodelist:
+        if node is None or node.isNodeType(latexwalker.LatexCharsNode):
+            continue
+        if node.isNodeType(latexwalker.LatexEnvironmentNode) and node.environmentname == 'document':
+            spans.extend(_node_spans(node.nodelist))
+        else:
+            spans.append((node.pos, node.pos_end))
+    return spans
+
+def _walker_block(start:int, text:str, final:bool):
+    """The leading block of text (from an ambiguous token on) that the walker reads on its own.
+
+    text is parsed up to its last line break, so that no token is cut off; the
+    block ends at the first blank line that no node other than text spans, with
+    more text after it, so that nothing in the block looks past its end. The
+    whole of text if final. None if there is no such blank line.
+    """
+    if final:
+        snippet = LatexSnippet(text, fast=False)
+        end = len(text)
+    else:
+        snippet = LatexSnippet(text[:text.rfind('\n') + 1], fast=False)
+        try:
+            spans = _node_spans(snippet.parse())
+        except Exception:
+            return None  # parse errors are raised by the block that contains them
+        for match in _re_source_break.finditer(snippet.text):
+            if match.end() < len(snippet.text) and all(not a < match.end() < b for a, b in spans):
+                end = match.end()
+                break
+        else:
+            return None
+    comments = [(a, b) for a, b in snippet.get_intervals(CommentVisitor) if a < end]
+    sections = [node.pos for node in snippet.visited_nodes(SectionVisitor) if node.pos < end]
+    return StreamBlock(start, text[:end], comments, sections)
+
+def iter_blocks(source, chunk_size:int=1<<16, max_lookahead:int=1<<22):
+    """Yield the StreamBlocks of a LaTeX source (a path or a text file object), reading chunk_size characters at a time.
+
+    After an ambiguous token up to max_lookahead characters are read ahead for the
+    walker before the rest of the source is parsed as one block.
+    """
+    with _open_source(source) as f:
+        scanner = LatexScanner()
+        while True:
+            while not scanner.final and not scanner.ambiguous:
+                piece = f.read(chunk_size)
+                scanner.feed(piece, final=(piece == ""))
+                while scanner.breaks and not scanner.ambiguous:
+                    yield StreamBlock(*scanner.take(scanner.breaks[0]))
+            text = scanner.remaining()
+            if not scanner.ambiguous:
+                if text:
+                    yield StreamBlock(*scanner.take(scanner.offset + len(text)))
+                return
+            start = scanner.offset
+            final = scanner.final
+            checked = 0
+            block = None
+            while block is None:
+                if final or len(text) >= 2 * checked:
+                    # parse again only once the lookahead has doubled
+                    block = _walker_block(start, text, final)
+                    checked = len(text)
+                if block is None and len(text) > max_lookahead:
+                    text += f.read()
+                    final = True
+                elif block is None:
+                    piece = f.read(chunk_size)
+                    final = piece == ""
+                    text += piece
+            yield block
+            if len(block.text) == len(text) and final:
+                return
+            scanner = LatexScanner(start + len(block.text))
+            scanner.feed(text[len(block.text):], final=final)
+            while scanner.breaks and not scanner.ambiguous:
+                yield StreamBlock(*scanner.take(scanner.breaks[0]))
+
+def iter_paragraphs(source, chunk_size:int=1<<16):
+    """Yield the paragraphs of a LaTeX source one at a time; the same paragraphs as LatexSnippet.get_paragraphs."""
+    pending = ""
+    for block in iter_blocks(source, chunk_size):
+        parts = (pending + block.comments_removed()).split('\n\n')
+        pending = parts.pop()
+        for part in parts:
+            part = part.strip()
+            if part:
+                yield part
+    pending = pending.strip()
+    if pending:
+        yield pending
+
+def iter_section_spans(source, chunk_size:int=1<<16):
+    """Yield (start, end) offsets of the text between consecutive \\section macros, without copying it."""
+    previous = None
+    for block in iter_blocks(source, chunk_size):
+        for position in block.sections:
+            if previous is not None:
+                yield (previous, block.start + position)
+            previous = block.start + position
+
+def iter_sections(source, chunk_size:int=1<<16):
+    """Yield the sections of a LaTeX source one at a time; the same sections as LatexSnippet.get_sections."""
+    parts = None
+    for block in iter_blocks(source, chunk_size):
+        last = 0
+        for position in block.sections:
+            if parts is not None:
+                parts.append(block.text[last:position])
+                yield "".join(parts)
+            parts = []
+            last = position
+        if parts is not None:
+            parts.append(block.text[last:])
+
 
 def is_latex_well_formed(text:str):
     return LatexSnippet(text).is_well_formed()
 
 def extract_sections(text: str):
     return LatexSnippet(text).get_sections()
+
+def extract_cite_keys(text: str):
+    return LatexSnippet(text).get_cite_keys()
+
+def extract_text_chunks(text: str):
+    return LatexSnippet(text).get_text_chunks()
     
     
-__all__ = ["LatexSnippet", "NontextVisitor", "CommentVisitor", "SectionVisitor", "filter_empty", "split_to_paragraphs", "is_latex_well_formed", "extract_sections", "extract_head_lines"]
+__all__ = ["LatexSnippet", "NontextVisitor", "CommentVisitor", "SectionVisitor", "CiteVisitor", "CombinedVisitor", "NONTEXT_MACROS", "merge_intervals", "LatexScan", "LatexScanner", "scan_latex", "LatexDocument", "LatexBlock", "block_key", "StreamBlock", "iter_blocks", "iter_paragraphs", "iter_sections", "iter_section_spans", "VERBATIM_ENVIRONMENTS", "filter_empty", "split_to_paragraphs", "is_latex_well_formed", "extract_sections", "extract_cite_keys", "CITE_MACROS", "parse_cite", "extract_text_chunks", "TextChunk", "DISCARDED_ENVIRONMENTS", "extract_head_lines"]
@@ -0,0 +1,130 @@
+import re
+import math
+import heapq
+import struct
+import msgpack
+from collections import Counter
+from typing import List, Dict, Tuple
+import paper_tools.lmdb_wrapper as lmdb_wrapper
+
+# Persistent BM25 inverted index stored in LMDB.
+# Postings are kept in a dupsort table (term -> doc_id + tf), so documents can
+# be added, replaced and removed one at a time without rewriting posting lists.
+
+_re_token = re.compile(r"[a-z0-9]+")
+_TF = struct.Struct('>I')
+_COUNT = struct.Struct('>Q')
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase alphanumeric tokens of text"""
+    return _re_token.findall(text.lower())
+
+
+class BM25Index(lmdb_wrapper.LmdbTablesBase):
+    """Incrementally updatable BM25 index over {doc_id: text} documents."""
+
+    TABLES = {
+        'postings': {'dupsort': True},  # term -> doc_id \0 tf
+        'terms': {},                    # doc_id -> msgpack {term: tf}
+        'doclen': {},                   # doc_id -> token count
+        'meta': {},                     # 'N', 'total_len'
+    }
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75, **kwargs):
+        super().__init__(path, **kwargs)
+        self.k1 = k1
+        self.b = b
+
+    def __len__(self):
+        with self.env.begin() as txn:
+            return self._get_count(txn, b'N')
+
+    def __contains__(self, doc_id) -> bool:
+        with self.env.begin() as txn:
+            return txn.get(doc_id.encode(), db=self.tables['doclen']) != None
+
+    def _get_count(self, txn, name: bytes) -> int:
+        packed = txn.get(name, db=self.tables['meta'])
+        return _COUNT.unpack(packed)[0] if packed != None else 0
+
+    def _add_count(self, txn, name: bytes, delta: int):
+        txn.put(name, _COUNT.pack(self._get_count(txn, name) + delta), db=self.tables['meta'])
+
+    def _remove(self, txn, doc_key: bytes):
+        packed = txn.get(doc_key, db=self.tables['terms'])
+        if packed == None:
+            return
+        for term, tf in msgpack.unpackb(packed).items():
+            txn.delete(term.encode(), doc_key + b'\0' + _TF.pack(tf), db=self.tables['postings'])
+        length = _TF.unpack(txn.get(doc_key, db=self.tables['doclen']))[0]
+        txn.delete(doc_key, db=self.tables['terms'])
+        txn.delete(doc_key, db=self.tables['doclen'])
+        self._add_count(txn, b'N', -1)
+        self._add_count(txn, b'total_len', -length)
+
+    def add_documents(self, documents: Dict[str, str]):
+        """Index (or re-index) a {doc_id: text} collection in one write transaction."""
+        with self.env.begin(write=True) as txn:
+            for doc_id, text in documents.items():
+                doc_key = doc_id.encode()
+                self._remove(txn, doc_key)
+                tokens = tokenize(text)
+                counts = Counter(tokens)
+                for term, tf in counts.items():
+                    txn.put(term.encode(), doc_key + b'\0' + _TF.pack(tf), db=self.tables['postings'])
+                txn.put(doc_key, msgpack.packb(dict(counts)), db=self.tables['terms'])
+                txn.put(doc_key, _TF.pack(len(tokens)), db=self.tables['doclen'])
+                self._add_count(txn, b'N', 1)
+                self._add_count(txn, b'total_len', len(tokens))
+
+    def remove_documents(self, doc_ids: List[str]):
+        """Remove documents from the index. Unknown IDs are ignored."""
+        with self.env.begin(write=True) as txn:
+            for doc_id in doc_ids:
+                self._remove(txn, doc_id.encode())
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        """Return the top k (doc_id, BM25 score) pairs for query, best first."""
+        scores = dict()
+        with self.env.begin() as txn:
+            n_docs = self._get_count(txn, b'N')
+            if n_docs == 0:
+                return []
+            avg_len = self._get_count(txn, b'total_len') / n_docs
+            cursor = txn.cursor(db=self.tables['postings'])
+            doclen = dict()
+            for term in set(tokenize(query)):
+                if not cursor.set_key(term.encode()):
+                    continue
+                df = cursor.count()
+                idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+                for value in cursor.iternext_dup(keys=False, values=True):
+                    doc_key, tf = value[:-5], _TF.unpack(value[-4:])[0]
+                    length = doclen.get(doc_key)
+                    if length == None:
+                        length = _TF.unpack(txn.get(doc_key, db=self.tables['doclen']))[0]
+                        doclen[doc_key] = length
+                    norm = tf + self.k1 * (1.0 - self.b + self.b * length / avg_len)
+                    scores[doc_key] = scores.get(doc_key, 0.0) + idf * tf * (self.k1 + 1.0) / norm
+
+        top = heapq.nlargest(k, scores.items(), key=lambda x: x[1])
+        return [(doc_key.decode(), score) for doc_key, score in top]
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60, weights: List[float] = None) -> List[Tuple[str, float]]:
+    """Fuse several ranked ID lists into one (id, score) list, best first.
+
+    Each list contributes weight / (k + rank) for every ID it contains.
+    """
+    if weights == None:
+        weights = [1.0] * len(rankings)
+    scores = dict()
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking):
+            if doc_id == None:
+                continue
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (k + rank + 1)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+
+__all__ = ["BM25Index", "tokenize", "reciprocal_rank_fusion"]
@@ -1,7 +1,55 @@
+import os
+import sys
 import lmdb
 import msgpack
+import argparse
+import threading
+import contextlib
 from typing import Generator, Any, Union
 
+# Optional value compression --------------------------------------------------
+# A store can keep its values as zstd frames, compressed with a dictionary trained
+# on a sample of its own values (see LmdbWrapperBase.enable_compression). The
+# dictionaries and the current setting live in a small metadata environment next
+# to the data (METADATA_NAME inside the store directory), not in a named database,
+# which would show up as a key of the main database. Every frame carries the ID
+# of its dictionary, so values written with older dictionaries, or uncompressed,
+# stay readable. A store hosted as a named database of a shared environment (see
+# LmdbWrapperBase) keeps the same entries in a '<name>.meta' named database instead.
+#
+#   python -m paper_tools.lmdb_wrapper compress path/to/record.lmdb
+
+METADATA_NAME = 'meta.mdb'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_dictionaries = dict()  # dictionary ID -> bytes, for every compressed store opened in this process
+_local = threading.local()  # per-thread decompressors (zstandard objects are not thread-safe)
+
+def decompress(packed):
+    """Return what pack_value produced for a stored value: zstd frames are decompressed, other values returned as they are.
+
+    Only for values of a store with compression enabled, where every value
+    starting with ZSTD_MAGIC is a frame; see LmdbWrapperBase.decompress_value.
+    """
+    if packed is None or bytes(packed[:4]) != ZSTD_MAGIC:
+        return packed
+    import zstandard
+    dict_id = zstandard.get_frame_parameters(packed).dict_id
+    decompressors = _local.__dict__.setdefault('decompressors', dict())
+    decompressor = decompressors.get(dict_id)
+    if decompressor is None:
+        if dict_id != 0 and dict_id not in _dictionaries:
+            raise KeyError("zstd dictionary {} is not loaded; open the store it belongs to first".format(dict_id))
+        dictionary = zstandard.ZstdCompressionDict(_dictionaries[dict_id]) if dict_id != 0 else None
+        decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+        decompressors[dict_id] = decompressor
+    return decompressor.decompress(packed)
+
+def has_db(env, name: str) -> bool:
+    """Whether env has a named database called name (named databases are keys of the main database)."""
+    with env.begin() as txn:
+        return txn.get(name.encode()) != None
+
+
 class LmdbWrapperBase:
     """LMDB database wrapper for Pythonic iteration and access."""
     
@@ -9,7 +57,9 @@ class LmdbWrapperBase:
                  path: str,
                  map_size: int = 10737418240,  # Default 10GB
                  readonly: bool = True,
-                 key_encoding: str = 'utf-8'):
+                 key_encoding: str = 'utf-8',
+                 env=None,
+                 name: str = None):
         """
         Initialize LMDB interface.
         
@@ -17,25 +67,61 @@ class LmdbWrapperBase:
         :param map_size: Maximum database size in bytes
         :param readonly: Open in read-only mode
         :param key_encoding: Encoding for converting string keys to/from bytes
+        :param env: Open environment to host the store in, as the named database name,
+            instead of opening path (map_size and readonly are then those of env).
+            The environment needs max_dbs for every store it hosts, and is not closed by the store.
+        :param name: Name of the store's database in env
         """
-        self.env = lmdb.open(
-            path,
-            map_size=map_size,
-            readonly=readonly,
-            lock=not readonly,  # Disable lock in read-only mode
-            metasync=False
-        )
+        if env != None:
+            readonly = env.flags()['readonly']
+            self.env = env
+            self.db = env.open_db(name.encode(), create=not readonly)
+        else:
+            self.env = lmdb.open(
+                path,
+                map_size=map_size,
+                readonly=readonly,
+                lock=not readonly,  # Disable lock in read-only mode
+                metasync=False
+            )
+            self.db = None  # the main database
+        self.owns_env = env == None
         self.key_encoding = key_encoding
+        self.write_hooks = []
+        self.path = path
+        self.name = name
+        self.readonly = readonly
+        self.meta_env = None
+        self.meta_db = None
+        self.compressor = None
+        self.compressed = False  # whether values may be zstd frames, read from the metadata on opening
+        if has_db(env, name + '.meta') if env != None else os.path.exists(os.path.join(path, METADATA_NAME)):
+            self._open_metadata()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.env.close()
+        if self.owns_env:
+            self.env.close()
+            if self.meta_env != None:
+                self.meta_env.close()
 
     def __len__(self):
-        return self.env.stat()['entries']
-        
+        if self.db == None:
+            return self.env.stat()['entries']
+        with self.env.begin() as txn:
+            return txn.stat(self.db)['entries']
+
+    @contextlib.contextmanager
+    def _txn(self, txn=None, write: bool = False):
+        """txn if given (a transaction on self.env, e.g. one shared with other stores), else a new one."""
+        if txn != None:
+            yield txn
+        else:
+            with self.env.begin(write=write) as own_txn:
+                yield own_txn
+
     def encode_key(self, key: Union[str, bytes]) -> bytes:
         """Convert key to bytes for LMDB storage."""
         if isinstance(key, str):
@@ -56,14 +142,42 @@ class LmdbWrapperBase:
         """Convert bytes value to original format."""
         return value
 
+    def unpack_lazy(self, value: bytes) -> Any:
+        """Like unpack_value, for readers that only touch part of the value.
+
+        Subclasses whose values can be decoded partially return a view that decodes on access.
+        """
+        return self.unpack_value(value)
+
     def __getitem__(self, key: Union[str, bytes]) -> Any:
         """Get a record by key."""
         with self.env.begin() as txn:
-            packed = txn.get(self.encode_key(key))
+            packed = txn.get(self.encode_key(key), db=self.db)
             if packed is None:
                 raise KeyError(f"Key {key!r} not found")
             #return msgpack.unpackb(packed)
-            return self.unpack_value(packed)
+            return self._unpack(packed)
+
+    def get(self, key: Union[str, bytes], default: Any = None, txn=None) -> Any:
+        """Get a record by key, or default if missing; reads in txn if given."""
+        with self._txn(txn) as rtxn:
+            packed = rtxn.get(self.encode_key(key), db=self.db)
+            return self._unpack(packed) if packed is not None else default
+
+    def add_write_hook(self, hook):
+        """Register hook(env, txn, items), called inside every write transaction.
+
+        items is the {key: value} dict being written and txn the open write
+        transaction on env. Derived indexes use this to stay in sync with the store;
+        an exception raised by a hook aborts the write. When the store is a named
+        database of a shared environment, txn is the transaction of the whole
+        write, so indexes hosted in the same environment are updated atomically with it.
+        """
+        self.write_hooks.append(hook)
+
+    def _run_write_hooks(self, txn, items: dict):
+        for hook in self.write_hooks:
+            hook(self.env, txn, items)
 
     def __setitem__(self, key: Union[str, bytes], value: Any):
         """Set a record by key."""
@@ -71,55 +185,308 @@ class LmdbWrapperBase:
             txn.put(
                 self.encode_key(key),
                 #msgpack.packb(value),
-                self.pack_value(value),
-                overwrite=True
+                self._pack(value),
+                overwrite=True,
+                db=self.db
             )
+            self._run_write_hooks(txn, {key: value})
 
     def __iter__(self) -> Generator[Union[str, bytes], None, None]:
         """Iterate over all keys in the database."""
         with self.env.begin() as txn:
-            cursor = txn.cursor()
+            cursor = txn.cursor(db=self.db)
             for key in cursor.iternext(keys=True, values=False):
                 yield self.decode_key(key)
 
     def __contains__(self, item) -> bool:
         """Iterate over all keys in the database."""
         with self.env.begin() as txn:
-            result = txn.get(self.encode_key(item)) != None
+            result = txn.get(self.encode_key(item), db=self.db) != None
             return result
 
     def keys(self) -> Generator[Union[str, bytes], None, None]:
         """Alias for key iteration."""
         return self.__iter__()
 
-    def values(self) -> Generator[Any, None, None]:
-        """Iterate over all values in the database."""
+    def values(self, lazy: bool = False) -> Generator[Any, None, None]:
+        """Iterate over all values in the database (see unpack_lazy for lazy)."""
+        unpack = self._unpack_lazy if lazy else self._unpack
         with self.env.begin() as txn:
-            cursor = txn.cursor()
+            cursor = txn.cursor(db=self.db)
             for _, value in cursor:
                 #yield msgpack.unpackb(value)
-                yield self.unpack_value(value)
+                yield unpack(value)
 
-    def items(self) -> Generator[tuple, None, None]:
-        """Iterate over all (key, value) pairs in the database."""
-        with self.env.begin() as txn:
-            cursor = txn.cursor()
+    def items(self, lazy: bool = False, txn=None) -> Generator[tuple, None, None]:
+        """Iterate over all (key, value) pairs in the database (see unpack_lazy for lazy); reads in txn if given."""
+        unpack = self._unpack_lazy if lazy else self._unpack
+        with self._txn(txn) as rtxn:
+            cursor = rtxn.cursor(db=self.db)
             for key, value in cursor:
                 yield (
                     self.decode_key(key),
                     #msgpack.unpackb(value)
-                    self.unpack_value(value)
+                    unpack(value)
                 )
 
-    def setitem_batched(self, items: dict):
-        """Set a collection of records from a {key: value} dict."""
-        with self.env.begin(write=True) as txn:
+    def raw_items(self) -> Generator[tuple, None, None]:
+        """Iterate over all (key, packed bytes) pairs, without unpack_value (decompressed if the store is compressed)."""
+        with self.env.begin() as txn:
+            cursor = txn.cursor(db=self.db)
+            for key, value in cursor:
+                yield (self.decode_key(key), self.decompress_value(value))
+
+    def setitem_batched(self, items: dict, txn=None):
+        """Set a collection of records from a {key: value} dict.
+
+        With txn (a write transaction on self.env), the records are written in it and
+        are committed, or discarded, together with everything else written in txn.
+        """
+        with self._txn(txn, write=True) as wtxn:
             for key, value in items.items():
-                txn.put(
+                wtxn.put(
                     self.encode_key(key),
-                    self.pack_value(value),
-                    overwrite=True
+                    self._pack(value),
+                    overwrite=True,
+                    db=self.db
                 )
+            self._run_write_hooks(wtxn, items)
+
+    def getitem_batched(self, keys, project=None, lazy: bool = False, txn=None) -> dict:
+        """Get a collection of records in a single read transaction (txn if given).
+
+        Returns a {key: value} dict; missing keys are skipped.
+        If project is given, it is applied to each unpacked value; with lazy,
+        values are unpacked with unpack_lazy, so project only decodes what it reads.
+        """
+        unpack = self._unpack_lazy if lazy else self._unpack
+        result = dict()
+        with self._txn(txn) as rtxn:
+            for key in keys:
+                packed = rtxn.get(self.encode_key(key), db=self.db)
+                if packed is None:
+                    continue
+                value = unpack(packed)
+                result[key] = project(value) if project else value
+        return result
+
+    def _open_metadata(self):
+        if self.owns_env:
+            self.meta_env = lmdb.open(os.path.join(self.path, METADATA_NAME), subdir=False, map_size=2**26,
+                                      readonly=self.readonly, lock=not self.readonly, metasync=False)
+        else:
+            self.meta_env = self.env
+            self.meta_db = self.env.open_db((self.name + '.meta').encode(), create=not self.readonly)
+        self._load_compression()
+
+    def _load_compression(self):
+        import zstandard
+        with self.meta_env.begin() as txn:
+            for key, value in txn.cursor(db=self.meta_db):
+                if key.startswith(b'dict:'):
+                    _dictionaries[int(key[5:])] = bytes(value)
+            setting = txn.get(b'compression', db=self.meta_db)
+        self.compressor = None
+        self.compressed = setting != None
+        if setting != None:
+            setting = msgpack.unpackb(setting)
+            dict_id = setting['dict_id']
+            dictionary = zstandard.ZstdCompressionDict(_dictionaries[dict_id]) if dict_id != 0 else None
+            self.compressor = zstandard.ZstdCompressor(level=setting['level'], dict_data=dictionary)
+            self.compressor_lock = threading.Lock()
+
+    def compression_info(self) -> dict:
+        """{'dict_id': current dictionary ID (0: none), 'level': ..., 'dictionaries': [IDs]}, or None if uncompressed."""
+        if self.meta_env == None:
+            return None
+        with self.meta_env.begin() as txn:
+            setting = txn.get(b'compression', db=self.meta_db)
+            ids = [int(key[5:]) for key, _ in txn.cursor(db=self.meta_db) if key.startswith(b'dict:')]
+        if setting == None:
+            return None
+        info = msgpack.unpackb(setting)
+        info['dictionaries'] = ids
+        return info
+
+    def _compress(self, packed: bytes) -> bytes:
+        if self.compressor != None:
+            with self.compressor_lock:
+                return self.compressor.compress(packed)
+        return packed
+
+    def _pack(self, value: Any) -> bytes:
+        return self._compress(self.pack_value(value))
+
+    def decompress_value(self, packed: bytes) -> bytes:
+        """The pack_value bytes of a value read from the store with txn.get.
+
+        Values are only decompressed when the store has compression enabled; in
+        other stores a value that happens to start with ZSTD_MAGIC is returned as it is.
+        """
+        return decompress(packed) if self.compressed else packed
+
+    def _unpack(self, packed: bytes) -> Any:
+        return self.unpack_value(self.decompress_value(packed))
+
+    def _unpack_lazy(self, packed: bytes) -> Any:
+        return self.unpack_lazy(self.decompress_value(packed))
+
+    def enable_compression(self, level: int = 3, dict_size: int = 1 << 17, samples: int = 5000,
+                           batch_size: int = 1000):
+        """Train a zstd dictionary on up to `samples` stored values and rewrite every value with it.
+
+        The dictionary is stored in the metadata environment under its ID and becomes
+        the one new writes use; older dictionaries are kept. With dict_size=0, or too
+        few values to train on, values are compressed without a dictionary. Write
+        hooks are not run, since the values themselves do not change.
+        """
+        import zstandard
+        if self.readonly:
+            raise Exception("Store was opened in readonly mode, cannot change compression.")
+        dict_id = 0
+        if dict_size > 0:
+            step = max(1, len(self) // samples)
+            sample = [packed for i, (_, packed) in enumerate(self.raw_items()) if i % step == 0][:samples]
+            try:
+                dictionary = zstandard.train_dictionary(dict_size, sample, level=level)
+                dict_id = dictionary.dict_id()
+            except zstandard.ZstdError:
+                dict_id = 0  # not enough data to train on
+        compressed = self.compressed
+        if self.meta_env == None:
+            self._open_metadata()
+        with self.meta_env.begin(write=True) as txn:
+            if dict_id != 0:
+                txn.put(b'dict:%d' % dict_id, dictionary.as_bytes(), db=self.meta_db)
+            txn.put(b'compression', msgpack.packb({'dict_id': dict_id, 'level': level}), db=self.meta_db)
+        self._load_compression()
+        self._rewrite_values(batch_size, compressed)
+
+    def disable_compression(self, batch_size: int = 1000):
+        """Rewrite every value uncompressed; new writes are no longer compressed."""
+        if self.readonly:
+            raise Exception("Store was opened in readonly mode, cannot change compression.")
+        if self.meta_env == None:
+            return
+        # values are rewritten before the setting is dropped, so that an interrupted
+        # rewrite leaves a store whose remaining frames are still decompressed
+        self.compressor = None
+        self._rewrite_values(batch_size, self.compressed)
+        with self.meta_env.begin(write=True) as txn:
+            txn.delete(b'compression', db=self.meta_db)
+        self._load_compression()
+
+    def _rewrite_values(self, batch_size: int, compressed: bool):
+        # compressed: whether the values read back may be zstd frames
+        last = None
+        while True:
+            with self.env.begin(write=True) as txn:
+                cursor = txn.cursor(db=self.db)
+                found = cursor.set_range(last) if last != None else cursor.first()
+                if found and last != None and cursor.key() == last:
+                    found = cursor.next()
+                count = 0
+                while found and count < batch_size:
+                    last = cursor.key()
+                    value = cursor.value()
+                    cursor.put(last, self._compress(decompress(value) if compressed else value))
+                    found = cursor.next()
+                    count += 1
+            if not found:
+                return
+
+
+class LmdbTablesBase:
+    """LMDB environment holding several named sub-databases ("tables").
+
+    Subclasses list their tables in TABLES as {name: open_db keyword arguments}.
+    """
+
+    TABLES = {}
+
+    def __init__(self,
+                 path: str,
+                 map_size: int = 10737418240,  # Default 10GB
+                 readonly: bool = True,
+                 env=None,
+                 prefix: str = ''):
+        """
+        Open the environment and all tables.
+
+        :param path: Path to LMDB database directory
+        :param map_size: Maximum database size in bytes
+        :param readonly: Open in read-only mode
+        :param env: Open environment to host the tables in instead of opening path
+            (map_size and readonly are then those of env); it is not closed by this object
+        :param prefix: Prepended to the table names, to keep them apart from other tables in env
+        """
+        if env != None:
+            readonly = env.flags()['readonly']
+            self.env = env
+        else:
+            self.env = lmdb.open(
+                path,
+                map_size=map_size,
+                readonly=readonly,
+                lock=not readonly,
+                metasync=False,
+                max_dbs=len(self.TABLES)
+            )
+        self.owns_env = env == None
+        self.readonly = readonly
+        self.tables = {
+            name: self.env.open_db((prefix + name).encode(), create=not readonly, **flags)
+            for name, flags in self.TABLES.items()
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.owns_env:
+            self.env.close()
+
+    @contextlib.contextmanager
+    def write_txn(self, env=None, txn=None):
+        """Write transaction on this environment.
+
+        Reuses txn when it is a transaction on the same environment (env), e.g.
+        one passed to a write hook; otherwise opens and commits a new one.
+        """
+        if txn != None and env is self.env:
+            yield txn
+        else:
+            with self.env.begin(write=True) as own_txn:
+                yield own_txn
+
+
+def _used_bytes(env) -> int:
+    stat = env.stat()
+    return stat['psize'] * (stat['branch_pages'] + stat['leaf_pages'] + stat['overflow_pages'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Compress or decompress the values of LMDB stores in place.")
+    parser.add_argument("command", choices=("compress", "decompress", "info"))
+    parser.add_argument("paths", nargs="+", help="Store directories, e.g. data/record.lmdb data/bibtex.lmdb")
+    parser.add_argument("--level", type=int, default=3, help="zstd compression level")
+    parser.add_argument("--dict-size", type=int, default=1 << 17, help="Dictionary size in bytes (0: no dictionary)")
+    parser.add_argument("--samples", type=int, default=5000, help="Values to train the dictionary on")
+    parser.add_argument("--map-size", type=int, default=100737418240)
+    args = parser.parse_args()
+    for path in args.paths:
+        with LmdbWrapperBase(path, map_size=args.map_size, readonly=args.command == "info") as store:
+            before = _used_bytes(store.env)
+            if args.command == "compress":
+                store.enable_compression(level=args.level, dict_size=args.dict_size, samples=args.samples)
+            elif args.command == "decompress":
+                store.disable_compression()
+            print("{}: {} values, {:.1f} MB -> {:.1f} MB used, compression: {}".format(
+                path, len(store), before / 1e6, _used_bytes(store.env) / 1e6, store.compression_info()),
+                file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
 
 
 """
@@ -2,6 +2,7 @@ from pipe import Pipe #, where, select, sort, dedup, map
 import pipe
 import warnings
 import datetime
+from paper_tools.record_query import RecordQuery
 
 # Custom pipe operators --------------------------------------------------------
 
@@ -40,26 +41,37 @@ def print_all(iterable):
     for item in iterable:
         print(item)
     
+# The filters and sort_by_citations below extend the plan when applied to a
+# RecordQuery (e.g. db.query()), and stream over (id, record) pairs otherwise.
+
 @Pipe
 def filter_by_year(records, year):
     """Filter records by publication year"""
+    if isinstance(records, RecordQuery):
+        return records.filter_by_year(year)
     return records | pipe.where(lambda r: datetime.datetime.fromisoformat(r[1].get('created')).year == year)
 
 @Pipe
 def filter_after(records, year, month, day):
     """Filter records by publication year"""
     dt = datetime.datetime(year, month, day, tzinfo=datetime.timezone.utc)
+    if isinstance(records, RecordQuery):
+        return records.filter_after(dt)
     return records | pipe.where(lambda r: datetime.datetime.fromisoformat(r[1].get('created')) >= dt)
 
 @Pipe
 def filter_before(records, year, month, day):
     """Filter records by publication year"""
     dt = datetime.datetime(year, month, day, tzinfo=datetime.timezone.utc)
+    if isinstance(records, RecordQuery):
+        return records.filter_before(dt)
     return records | pipe.where(lambda r: datetime.datetime.fromisoformat(r[1].get('created')) <= dt)
 
 @Pipe
 def filter_by_author(records, author_name):
     """Filter records by author name (case-insensitive)"""
+    if isinstance(records, RecordQuery):
+        return records.filter_by_author(author_name)
     return records | pipe.where(lambda r: any(
         author_name.lower() in author['full_name'].lower()
         for author in r[1]['metadata'].get('authors', [])
@@ -68,6 +80,8 @@ def filter_by_author(records, author_name):
 @Pipe
 def filter_by_title(records, keyword):
     """Filter records by title keyword"""
+    if isinstance(records, RecordQuery):
+        return records.filter_by_title(keyword)
     return records | pipe.where(lambda r: any(
         keyword.lower() in title['title'].lower()
         for title in r[1]['metadata'].get('titles', [])
@@ -76,6 +90,8 @@ def filter_by_title(records, keyword):
 @Pipe
 def filter_by_abstract(records, keyword):
     """Filter records by abstract keyword"""
+    if isinstance(records, RecordQuery):
+        return records.filter_by_abstract(keyword)
     return records | pipe.where(lambda r: any(
         keyword.lower() in abstract['value'].lower()
         for abstract in r[1]['metadata'].get('abstracts', [])
@@ -84,8 +100,25 @@ def filter_by_abstract(records, keyword):
 @Pipe
 def sort_by_citations(records, descending=True):
     """Sort records by citation count"""
+    if isinstance(records, RecordQuery):
+        return records.sort_by_citations(descending)
     return records | pipe.sort(key=lambda r: r[1]['metadata'].get('citation_count', 0), reverse=descending)
 
+@Pipe
+def filter_by_type(records, document_type):
+    """Filter records by document type (e.g. 'article')"""
+    if isinstance(records, RecordQuery):
+        return records.filter_by_type(document_type)
+    return records | pipe.where(lambda r: document_type in r[1]['metadata'].get('document_type', []))
+
+@Pipe
+def filter_by_citations(records, minimum=None, maximum=None):
+    """Filter records by citation count range (inclusive, either bound optional)"""
+    if isinstance(records, RecordQuery):
+        return records.filter_by_citations(minimum, maximum)
+    return records | pipe.where(lambda r: (minimum == None or r[1]['metadata'].get('citation_count', 0) >= minimum)
+                                and (maximum == None or r[1]['metadata'].get('citation_count', 0) <= maximum))
+
 @Pipe
 def extract_fields(records, fields):
     """Extract specific fields from records"""
@@ -106,21 +139,22 @@ def as_list(iterable):
 #     """Limit to first N results"""
 #     return records | select(lambda x: x) | dedup | select(lambda x: x)[:n]
 
-# Example usage
-list(wrapper.items() | filter_by_abstract('quasinormal mode') | filter_by_abstract('ringdown') | sort_by_citations() | pipe.take(5) | get_title)
+# Example usage ----------------------------------------------------------------
+if __name__ == "__main__":
+    from paper_tools.config import get_data_dir
+    from paper_tools.inspirehep_tools import InspireHEPDatabase
+
+    db = InspireHEPDatabase(str(get_data_dir()), readonly=True)
+    wrapper = db.record
 
-list(wrapper.items() | filter_by_abstract('quasinormal mode') | filter_by_abstract('ringdown') | sort_by_citations() | pipe.take(5) | extract_fields(['titles']))
+    print(list(wrapper.items() | filter_by_abstract('quasinormal mode') | filter_by_abstract('ringdown') | sort_by_citations() | pipe.take(5) | get_title))
 
-len(list(wrapper.items() | filter_before(2020,1,1) | filter_after(2015,1,1) | get_id))
+    print(list(wrapper.items() | filter_by_abstract('quasinormal mode') | filter_by_abstract('ringdown') | sort_by_citations() | pipe.take(5) | extract_fields(['titles'])))
 
-# Example usage ----------------------------------------------------------------
-#if __name__ == "__main__":
-if True:
-    # Convert dict to list of records for piping
-    records = list(inspire_records.values())
+    print(len(list(wrapper.items() | filter_before(2020,1,1) | filter_after(2015,1,1) | get_id)))
 
     # Example 1: Basic search pipeline
-    results = (records
+    results = (wrapper.items()
         | filter_by_year(2020)
         | filter_by_title("dark matter")
         | extract_fields(['titles', 'citation_count'])
@@ -130,38 +164,29 @@ if True:
         print(f"- {r['titles'][0]['title']} ({r['citation_count']} citations)")
 
     # Example 2: Complex query with sorting and limiting
-    top_papers = (records
-        | filter_by_year(2012)
-        | sort_by_citations(descending=True)
-        | limit_results(5)
-        | extract_fields(['titles', 'citation_count', 'arxiv_eprints'])
-    )
-    
+    top_papers = (wrapper.items()
+                  | filter_by_year(2012)
+                  | sort_by_citations(descending=True)
+                  | pipe.take(5)
+                  | extract_fields(['titles', 'citation_count', 'arxiv_eprints'])
+                  )
+
     print("\nTop cited papers from 2012:")
     for paper in top_papers:
         arxiv_id = paper['arxiv_eprints'][0]['value'] if paper.get('arxiv_eprints') else 'N/A'
         print(f"- {arxiv_id}: {paper['titles'][0]['title']}")
 
+    # Same query on the columnar metadata store: no record is decoded
+    columns = db.open_column_store()
+    if columns != None:
+        table = columns.columns()
+        for row in table.top_by_citations(table.year_mask(2012), n=5):
+            print(f"- {table.ids[row]}: {table.title[row]} ({table.citation_count[row]} citations)")
+
     # Example 3: Author search with multiple filters
-    einstein_papers = (records
+    einstein_papers = list(wrapper.items()
         | filter_by_author("Einstein")
         | filter_by_year(2020)
         | sort_by_citations()
         | extract_fields(['titles', 'publication_info'])
     )
-
-
-records = list(inspire_records.values())
-
-# Example 2: Complex query with sorting and limiting
-top_papers = (records
-              | filter_by_year(2012)
-              | sort_by_citations(descending=True)
-              #| limit_results(5)
-              | extract_fields(['titles', 'citation_count', 'arxiv_eprints'])
-              )
-    
-print("\nTop cited papers from 2012:")
-for paper in top_papers:
-    arxiv_id = paper['arxiv_eprints'][0]['value'] if paper.get('arxiv_eprints') else 'N/A'
-    print(f"- {arxiv_id}: {paper['titles'][0]['title']}")
@@ -0,0 +1,176 @@
+import re
+import struct
+import datetime
+import msgpack
+from typing import List, Dict
+import paper_tools.lmdb_wrapper as lmdb_wrapper
+import paper_tools.column_store as column_store
+
+# Secondary indexes on an InspireHEP record store: creation date, author name,
+# texkey and arXiv eprint, each a dupsort table mapping the key to record IDs.
+# LMDB keeps keys sorted, so point lookups and date ranges are B-tree seeks
+# instead of scans over decoded records.
+
+_DATE = struct.Struct('>Q')
+_DATE_OFFSET = 2**63  # shifts signed epoch seconds so byte order matches time order
+_re_arxiv_prefix = re.compile(r'^arxiv:', re.IGNORECASE)
+_re_arxiv_version = re.compile(r'v[0-9]+$')
+
+def normalize_arxiv_id(eprint: str) -> str:
+    """arXiv identifier without 'arXiv:' prefix and version suffix, e.g. 'arXiv:1602.03837v2' -> '1602.03837'"""
+    return _re_arxiv_version.sub('', _re_arxiv_prefix.sub('', eprint.strip())).lower()
+
+def _date_key(seconds: int) -> bytes:
+    return _DATE.pack(seconds + _DATE_OFFSET)
+
+def _to_seconds(dt) -> int:
+    if isinstance(dt, datetime.datetime):
+        dt = dt.isoformat()
+    return column_store.epoch_seconds(dt)
+
+def index_keys(record: dict) -> dict:
+    """Keys under which a record is indexed, per table."""
+    metadata = record.get('metadata', {})
+    seconds = column_store.epoch_seconds(record.get('created'))
+    return {
+        'date': [_date_key(seconds)] if seconds != column_store.NO_DATE else [],
+        'author': list(dict.fromkeys(a['full_name'].lower().encode() for a in metadata.get('authors') or [])),
+        'texkey': list(dict.fromkeys(t.encode() for t in metadata.get('texkeys') or [])),
+        'arxiv': list(dict.fromkeys(normalize_arxiv_id(e['value']).encode() for e in metadata.get('arxiv_eprints') or [])),
+    }
+
+_INDEXED_FIELDS = ('authors', 'texkeys', 'arxiv_eprints')
+
+
+class RecordIndex(lmdb_wrapper.LmdbTablesBase):
+    """Date, author, texkey and arXiv ID indexes over a record store, kept in sync on writes."""
+
+    TABLES = {
+        'date': {'dupsort': True},    # big-endian shifted epoch seconds -> id
+        'author': {'dupsort': True},  # lowercased full name -> id
+        'texkey': {'dupsort': True},  # texkey -> id
+        'arxiv': {'dupsort': True},   # normalized arXiv id -> id
+        'keys': {},                   # id -> msgpack {table: [keys]}, to drop stale entries
+    }
+    INDEXES = ('date', 'author', 'texkey', 'arxiv')
+
+    def __len__(self):
+        """Number of indexed records."""
+        with self.env.begin() as txn:
+            return txn.stat(self.tables['keys'])['entries']
+
+    def on_write(self, env, txn, items: dict):
+        """Write hook keeping the indexes in sync with a record store (see LmdbWrapperBase.add_write_hook)."""
+        self.update(items, env=env, txn=txn)
+
+    def update(self, records: Dict[str, dict], env=None, txn=None):
+        """Index (or re-index) a {id: record} collection."""
+        with self.write_txn(env, txn) as wtxn:
+            for rec_id, record in records.items():
+                self._set_keys(wtxn, rec_id, index_keys(record))
+
+    def remove(self, rec_ids: List[str]):
+        with self.env.begin(write=True) as txn:
+            for rec_id in rec_ids:
+                self._set_keys(txn, rec_id, None)
+
+    def _set_keys(self, txn, rec_id: str, keys):
+        value = rec_id.encode()
+        packed = txn.get(value, db=self.tables['keys'])
+        old = msgpack.unpackb(packed) if packed != None else {}
+        for name in self.INDEXES:
+            old_keys = set(old.get(name, []))
+            new_keys = set(keys[name]) if keys != None else set()
+            for key in old_keys - new_keys:
+                txn.delete(key, value, db=self.tables[name])
+            for key in new_keys - old_keys:
+                txn.put(key, value, db=self.tables[name])
+        if keys == None:
+            txn.delete(value, db=self.tables['keys'])
+        else:
+            txn.put(value, msgpack.packb(keys), db=self.tables['keys'])
+
+    def rebuild(self, records):
+        """Clear the indexes and index every record of a record store (anything with items()).
+
+        Record stores providing raw_items() are read decoding only the indexed fields.
+        """
+        with self.env.begin(write=True) as txn:
+            for name in self.TABLES:
+                txn.drop(self.tables[name], delete=False)
+        if hasattr(records, 'raw_items'):
+            pairs = ((rec_id, column_store.packed_fields(packed, ('created',), _INDEXED_FIELDS))
+                     for rec_id, packed in records.raw_items())
+        else:
+            pairs = iter(records.items())
+        batch = dict()
+        for rec_id, record in pairs:
+            batch[rec_id] = record
+            if len(batch) >= 1000:
+                self.update(batch)
+                batch = dict()
+        self.update(batch)
+
+    def _lookup(self, txn, name: str, key: bytes) -> List[str]:
+        cursor = txn.cursor(db=self.tables[name])
+        if not cursor.set_key(key):
+            return []
+        return [v.decode() for v in cursor.iternext_dup()]
+
+    def created_between(self, after=None, before=None) -> List[str]:
+        """IDs of records created in [after, before] (datetimes or ISO strings, either optional), oldest first."""
+        result = []
+        with self.env.begin() as txn:
+            cursor = txn.cursor(db=self.tables['date'])
+            found = cursor.set_range(_date_key(_to_seconds(after))) if after != None else cursor.first()
+            end = _date_key(_to_seconds(before)) if before != None else None
+            while found:
+                key, value = cursor.item()
+                if end != None and key > end:
+                    break
+                result.append(value.decode())
+                found = cursor.next()
+        return result
+
+    def by_author(self, name: str, prefix: bool = False) -> List[str]:
+        """IDs of records with an author whose full name equals name (case-insensitive).
+
+        With prefix=True, full names starting with name match, e.g. 'einstein' matches 'Einstein, A.'.
+        """
+        key = name.lower().encode()
+        with self.env.begin() as txn:
+            if not prefix:
+                return self._lookup(txn, 'author', key)
+            result = []
+            cursor = txn.cursor(db=self.tables['author'])
+            found = cursor.set_range(key)
+            while found:
+                full_name, value = cursor.item()
+                if not full_name.startswith(key):
+                    break
+                result.append(value.decode())
+                found = cursor.next()
+            return list(dict.fromkeys(result))
+
+    def by_texkey(self, texkeys: List[str]) -> Dict[str, str]:
+        """{texkey: id} for the texkeys present in the index."""
+        result = dict()
+        with self.env.begin() as txn:
+            for texkey in texkeys:
+                ids = self._lookup(txn, 'texkey', texkey.encode())
+                if ids:
+                    result[texkey] = ids[0]
+        return result
+
+    def by_arxiv(self, eprints: List[str]) -> Dict[str, str]:
+        """{eprint: id} for the arXiv IDs present in the index (prefix and version ignored)."""
+        result = dict()
+        with self.env.begin() as txn:
+            for eprint in eprints:
+                ids = self._lookup(txn, 'arxiv', normalize_arxiv_id(eprint).encode())
+                if ids:
+                    result[eprint] = ids[0]
+        return result
+
+
+__all__ = ["RecordIndex", "index_keys", "normalize_arxiv_id"]
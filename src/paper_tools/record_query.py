@@ -0,0 +1,217 @@
+import heapq
+import datetime
+import numpy as np
+from typing import List
+import paper_tools.column_store as column_store
+
+# Lazy query plans over an InspireHEP record store.
+# A RecordQuery collects filters and an optional citation sort, and only runs
+# when iterated. Predicates that the column store can answer are evaluated as
+# array masks first; substring predicates on fields outside the column store
+# then run on the surviving records only, decoding just the fields they need.
+# Sorted results come out of a heap one at a time, so `| pipe.take(k)` costs
+# O(n + k log n) instead of a full sort. Iteration yields (id, record) pairs,
+# like wrapper.items(), so the pipe_usage operators can follow.
+
+def _as_utc(dt: datetime.datetime) -> datetime.datetime:
+    return dt if dt.tzinfo != None else dt.replace(tzinfo=datetime.timezone.utc)
+
+def _created(record: dict):
+    return datetime.datetime.fromisoformat(record.get('created'))
+
+
+class Predicate:
+    """One filter of a query plan.
+
+    test(record) decides a (possibly partial) record; mask(columns), if given,
+    decides all rows of a RecordColumns at once. fields lists the metadata
+    fields test reads (None: the whole record).
+    """
+
+    # Evaluation order: column masks, then partial decodes, then full decodes
+    COLUMN, PARTIAL, FULL = 0, 1, 2
+
+    def __init__(self, name: str, test, mask=None, fields=None):
+        self.name = name
+        self.test = test
+        self.mask = mask
+        self.fields = fields
+
+    @property
+    def cost(self) -> int:
+        if self.mask != None:
+            return self.COLUMN
+        return self.PARTIAL if self.fields != None else self.FULL
+
+    def __repr__(self):
+        return "Predicate({})".format(self.name)
+
+
+class RecordQuery:
+    """Lazy, chainable query over a record store (anything with items() and __getitem__).
+
+    With a ColumnStore, cheap predicates and the citation sort run on its arrays.
+    Each filter method returns a new query; the plan runs when the query is iterated.
+    """
+
+    def __init__(self, records, columns: column_store.ColumnStore = None, predicates=(), order=None):
+        self.records = records
+        self.columns = columns
+        self.predicates = list(predicates)
+        self.order = order  # None, or True / False for descending / ascending citation count
+
+    def _with(self, predicate: Predicate = None, order=None) -> 'RecordQuery':
+        predicates = self.predicates + [predicate] if predicate != None else self.predicates
+        return RecordQuery(self.records, self.columns, predicates, order if order != None else self.order)
+
+    def where(self, test, name: str = "where") -> 'RecordQuery':
+        """Keep records for which test(record) is true (always evaluated on full records)."""
+        return self._with(Predicate(name, test))
+
+    def filter_by_year(self, year: int) -> 'RecordQuery':
+        return self._with(Predicate("year == {}".format(year),
+                                    lambda r: _created(r).year == year,
+                                    mask=lambda c: c.year_mask(year)))
+
+    def filter_after(self, dt: datetime.datetime) -> 'RecordQuery':
+        dt = _as_utc(dt)
+        return self._with(Predicate("created >= {}".format(dt.isoformat()),
+                                    lambda r: _created(r) >= dt,
+                                    mask=lambda c: c.created_mask(after=dt)))
+
+    def filter_before(self, dt: datetime.datetime) -> 'RecordQuery':
+        dt = _as_utc(dt)
+        return self._with(Predicate("created <= {}".format(dt.isoformat()),
+                                    lambda r: _created(r) <= dt,
+                                    mask=lambda c: c.created_mask(before=dt)))
+
+    def filter_by_type(self, document_type: str) -> 'RecordQuery':
+        return self._with(Predicate("document_type == {!r}".format(document_type),
+                                    lambda r: document_type in r['metadata'].get('document_type', []),
+                                    mask=lambda c: c.document_type_mask(document_type)))
+
+    def filter_by_citations(self, minimum: int = None, maximum: int = None) -> 'RecordQuery':
+        """Keep records with minimum <= citation_count <= maximum (either bound optional)."""
+        def in_range(count):
+            return (minimum == None or count >= minimum) & (maximum == None or count <= maximum)
+        return self._with(Predicate("citation_count in [{}, {}]".format(minimum, maximum),
+                                    lambda r: in_range(r['metadata'].get('citation_count', 0)),
+                                    mask=lambda c: in_range(c.citation_count)))
+
+    def filter_by_author(self, author_name: str) -> 'RecordQuery':
+        needle = author_name.lower()
+        return self._with(Predicate("author ~ {!r}".format(author_name),
+                                    lambda r: any(needle in a['full_name'].lower()
+                                                  for a in r['metadata'].get('authors', [])),
+                                    mask=lambda c: c.author_mask(author_name)))
+
+    def filter_by_title(self, keyword: str) -> 'RecordQuery':
+        needle = keyword.lower()
+        return self._with(Predicate("title ~ {!r}".format(keyword),
+                                    lambda r: any(needle in t['title'].lower()
+                                                  for t in r['metadata'].get('titles', [])),
+                                    mask=lambda c: c.title_mask(keyword)))
+
+    def filter_by_abstract(self, keyword: str) -> 'RecordQuery':
+        needle = keyword.lower()
+        return self._with(Predicate("abstract ~ {!r}".format(keyword),
+                                    lambda r: any(needle in a['value'].lower()
+                                                  for a in r['metadata'].get('abstracts', [])),
+                                    fields=('abstracts',)))
+
+    def sort_by_citations(self, descending: bool = True) -> 'RecordQuery':
+        return self._with(order=bool(descending))
+
+    def plan(self) -> List[Predicate]:
+        """Predicates in evaluation order (stable within each cost class)."""
+        return sorted(self.predicates, key=lambda p: p.cost)
+
+    def __repr__(self):
+        steps = [repr(p) for p in self.plan()]
+        if self.order != None:
+            steps.append("top by citations ({})".format("descending" if self.order else "ascending"))
+        return "RecordQuery({})".format(" -> ".join(steps) or "all")
+
+    def __iter__(self):
+        if self.columns != None:
+            return self._run_columnar()
+        return self._run_streaming()
+
+    def ids(self) -> List[str]:
+        """IDs of the matching records, in result order, without decoding records for sorting."""
+        if self.columns != None:
+            return [rec_id for rec_id, _ in self._ordered_ids()]
+        return [rec_id for rec_id, _ in self]
+
+    def _matching_rows(self, table: column_store.RecordColumns) -> np.ndarray:
+        mask = np.ones(len(table), dtype=bool)
+        record_predicates = []
+        for predicate in self.plan():
+            if predicate.mask != None:
+                mask &= predicate.mask(table)
+            else:
+                record_predicates.append(predicate)
+        rows = np.flatnonzero(mask)
+        if len(record_predicates) == 0 or len(rows) == 0:
+            return rows
+        metadata_keys = set()
+        for predicate in record_predicates:
+            if predicate.fields != None:
+                metadata_keys.update(predicate.fields)
+        full = any(p.fields == None for p in record_predicates)
+        keep = np.zeros(len(rows), dtype=bool)
+        with self.records.env.begin() as txn:
+            for i, rec_id in enumerate(table.ids[rows].tolist()):
+                packed = self.records.decompress_value(txn.get(rec_id.encode(), db=self.records.db))
+                if packed == None:
+                    continue
+                partial = column_store.packed_fields(packed, ('created',), metadata_keys)
+                partial.setdefault('metadata', dict())
+                keep[i] = all(p.test(partial) for p in record_predicates if p.fields != None)
+                if keep[i] and full:
+                    record = self.records.unpack_lazy(packed)
+                    keep[i] = all(p.test(record) for p in record_predicates if p.fields == None)
+        return rows[keep]
+
+    def _ordered_ids(self):
+        table = self.columns.columns()
+        rows = self._matching_rows(table)
+        if self.order == None:
+            for row in rows.tolist():
+                yield table.ids[row], row
+            return
+        counts = table.citation_count[rows]
+        keys = -counts if self.order else counts
+        heap = list(zip(keys.tolist(), rows.tolist()))
+        heapq.heapify(heap)
+        while heap:
+            _, row = heapq.heappop(heap)
+            yield table.ids[row], row
+
+    def _run_columnar(self):
+        for rec_id, _ in self._ordered_ids():
+            yield rec_id, self.records[rec_id]
+
+    def _run_streaming(self):
+        predicates = self.plan()
+        if hasattr(self.records, 'unpack_lazy'):
+            # Test predicates on lazy views and decode only the matching records
+            matches = ((rec_id, record.decode() if isinstance(record, column_store.LazyRecord) else record)
+                       for rec_id, record in self.records.items(lazy=True)
+                       if all(p.test(record) for p in predicates))
+        else:
+            matches = ((rec_id, record) for rec_id, record in self.records.items()
+                       if all(p.test(record) for p in predicates))
+        if self.order == None:
+            yield from matches
+            return
+        sign = -1 if self.order else 1
+        heap = [(sign * record['metadata'].get('citation_count', 0), n, rec_id, record)
+                for n, (rec_id, record) in enumerate(matches)]
+        heapq.heapify(heap)
+        while heap:
+            _, _, rec_id, record = heapq.heappop(heap)
+            yield rec_id, record
+
+
+__all__ = ["RecordQuery", "Predicate"]
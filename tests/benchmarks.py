@@ -0,0 +1,447 @@
+"""
+Micro-benchmarks for paper-tools.
+
+Not collected by pytest. Run with: python3 tests/benchmarks.py [name ...]
+"""
+
+import sys
+import os
+import time
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+
+def bench_import_time(repeat=5):
+    """Wall time of a fresh interpreter importing paper_tools.inspirehep_tools."""
+    env = dict(os.environ, PYTHONPATH=SRC)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import paper_tools.inspirehep_tools"],
+                       env=env, check=True)
+        timings.append(time.perf_counter() - start)
+    baseline = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], env=env, check=True)
+        baseline.append(time.perf_counter() - start)
+    print("import paper_tools.inspirehep_tools: {:.3f} s (interpreter startup {:.3f} s)".format(
+        min(timings), min(baseline)))
+
+
+def _synthetic_abstracts(n, seed=0):
+    import random
+    rng = random.Random(seed)
+    vocab = ["axion", "inflation", "black", "hole", "ringdown", "quasinormal", "mode", "dark",
+             "matter", "gravitational", "wave", "lattice", "qcd", "neutrino", "string"]
+    vocab += ["w{}".format(i) for i in range(5000)]
+    return {str(i): " ".join(rng.choice(vocab) for _ in range(120)) for i in range(n)}
+
+
+def bench_lexical_search(n=20000):
+    """BM25 keyword query against a linear lowercase substring scan."""
+    import tempfile
+    import shutil
+    import paper_tools.lexical_index as lexical_index
+    docs = _synthetic_abstracts(n)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        index = lexical_index.BM25Index(os.path.join(tmpdir, "lex.lmdb"), map_size=2**32, readonly=False)
+        start = time.perf_counter()
+        index.add_documents(docs)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        hits = index.search("ringdown w17", k=10)
+        bm25 = time.perf_counter() - start
+
+        start = time.perf_counter()
+        scan = [i for i, text in docs.items() if "w17" in text.lower() and "ringdown" in text.lower()]
+        linear = time.perf_counter() - start
+        print("lexical search over {} docs: build {:.2f} s, BM25 query {:.1f} ms, linear scan {:.1f} ms".format(
+            n, build, bm25 * 1e3, linear * 1e3))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _random_citation_edges(n, refs_per_node, seed=0):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    sources = np.repeat(np.arange(n), refs_per_node)
+    targets = rng.integers(0, n, size=n * refs_per_node)
+    return sources, targets
+
+
+def bench_pagerank(n=1000000, refs_per_node=10, nx_n=50000):
+    """CSR power-iteration PageRank on a random citation graph, and networkx on a smaller one."""
+    import networkx as nx
+    import paper_tools.analytic as analytic
+    sources, targets = _random_citation_edges(n, refs_per_node)
+    start = time.perf_counter()
+    graph = analytic.CitationGraph.from_edges([str(i) for i in range(n)], sources, targets)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    analytic.pagerank(graph.adjacency)
+    rank = time.perf_counter() - start
+    print("CSR PageRank, {} nodes / {} edges: build {:.2f} s, pagerank {:.2f} s".format(
+        n, graph.num_edges, build, rank))
+
+    sources, targets = _random_citation_edges(nx_n, refs_per_node)
+    start = time.perf_counter()
+    G = nx.DiGraph()
+    G.add_edges_from(zip(sources.tolist(), targets.tolist()))
+    nx.pagerank(G)
+    print("networkx PageRank, {} nodes: {:.2f} s".format(nx_n, time.perf_counter() - start))
+
+
+def bench_personalized_pagerank(n=1000000, refs_per_node=10, queries=10, seeds_per_query=20):
+    """Per-query latency of push-based personalized PageRank on a random citation graph."""
+    import numpy as np
+    import paper_tools.analytic as analytic
+    sources, targets = _random_citation_edges(n, refs_per_node)
+    graph = analytic.CitationGraph.from_edges([str(i) for i in range(n)], sources, targets)
+    rng = np.random.default_rng(1)
+    timings = []
+    for _ in range(queries):
+        seeds = rng.integers(0, n, size=seeds_per_query)
+        start = time.perf_counter()
+        analytic.personalized_pagerank_push(graph.adjacency, seeds, epsilon=1e-4)
+        timings.append(time.perf_counter() - start)
+    print("personalized PageRank (push, eps=1e-4), {} nodes: median {:.1f} ms per query".format(
+        n, 1e3 * sorted(timings)[len(timings) // 2]))
+
+
+def bench_graph_report(n=1000000, refs_per_node=10, processes=4):
+    """Full analytics report (PageRank, HITS, k-core, components, degrees), serial vs process pool."""
+    import paper_tools.analytic as analytic
+    sources, targets = _random_citation_edges(n, refs_per_node)
+    graph = analytic.CitationGraph.from_edges([str(i) for i in range(n)], sources, targets)
+    for procs in (None, processes):
+        start = time.perf_counter()
+        analytic.graph_report(graph, processes=procs)
+        print("graph report, {} nodes, processes={}: {:.2f} s".format(n, procs, time.perf_counter() - start))
+
+
+def _synthetic_records(n, refs_per_record=40, seed=0):
+    import random
+    rng = random.Random(seed)
+    abstracts = _synthetic_abstracts(n, seed)
+    records = dict()
+    for i in range(n):
+        records[str(i)] = {
+            "id": str(i),
+            "created": "{}-{:02d}-01T00:00:00+00:00".format(rng.randint(1990, 2024), rng.randint(1, 12)),
+            "metadata": {
+                "titles": [{"title": "Paper {} on {}".format(i, abstracts[str(i)][:40])}],
+                "authors": [{"full_name": "Author{}, A.".format(rng.randint(0, 5000)),
+                             "affiliations": [{"value": "Institute"}]} for _ in range(rng.randint(1, 8))],
+                "abstracts": [{"value": abstracts[str(i)], "source": "arXiv"}],
+                "citation_count": rng.randint(0, 500),
+                "document_type": ["article"],
+                "references": [{"record": {"$ref": "https://inspirehep.net/api/literature/{}".format(rng.randint(0, n))},
+                                "reference": {"title": {"title": "Referenced paper"}}}
+                               for _ in range(refs_per_record)],
+            },
+        }
+    return records
+
+
+def bench_column_store(n=20000):
+    """Year filter + citation sort: pipe over decoded records vs the columnar side-store."""
+    import tempfile
+    import shutil
+    import pipe
+    import paper_tools.inspirehep_tools as inspirehep_tools
+    import paper_tools.pipe_usage as pipe_usage
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = inspirehep_tools.InspireHEPDatabase(tmpdir, map_size=2**32, readonly=False, track_citations=False)
+        db.record.setitem_batched(_synthetic_records(n))
+
+        start = time.perf_counter()
+        expected = list(db.record.items() | pipe_usage.filter_by_year(2012) | pipe_usage.sort_by_citations()
+                        | pipe.take(10) | pipe_usage.get_id)
+        piped = time.perf_counter() - start
+
+        start = time.perf_counter()
+        table = db.columns.columns()
+        load = time.perf_counter() - start
+        start = time.perf_counter()
+        top = table.ids[table.top_by_citations(table.year_mask(2012), n=10)].tolist()
+        scan = time.perf_counter() - start
+        assert [table.citation_count[table.row_of_id[i]] for i in top] == \
+            [db.record[i]["metadata"]["citation_count"] for i in expected]
+        print("year filter + citation top-10 over {} records: pipe {:.1f} ms, columns {:.2f} ms (load {:.1f} ms)".format(
+            n, piped * 1e3, scan * 1e3, load * 1e3))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def bench_record_compression(n=20000):
+    """record.lmdb size and full decode time, raw msgpack vs zstd with a trained dictionary."""
+    import tempfile
+    import shutil
+    import paper_tools.inspirehep_tools as inspirehep_tools
+    import paper_tools.lmdb_wrapper as lmdb_wrapper
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = inspirehep_tools.InspireHEPDatabase(tmpdir, map_size=2**32, readonly=False, track_citations=False,
+                                                 track_columns=False, track_indexes=False)
+        db.record.setitem_batched(_synthetic_records(n))
+        for label in ("raw", "zstd"):
+            if label == "zstd":
+                start = time.perf_counter()
+                db.record.enable_compression()
+                print("  enable_compression: {:.2f} s".format(time.perf_counter() - start))
+            start = time.perf_counter()
+            count = sum(1 for _ in db.record.values())
+            print("{} records {}: {:.1f} MB used, decode all {:.2f} s".format(
+                count, label, lmdb_wrapper._used_bytes(db.record.env) / 1e6, time.perf_counter() - start))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def bench_lazy_records(n=20000):
+    """Projecting a few fields / filtering by year: full msgpack decode vs LazyRecord views."""
+    import tempfile
+    import shutil
+    import paper_tools.inspirehep_tools as inspirehep_tools
+    import paper_tools.pipe_usage as pu
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = inspirehep_tools.InspireHEPDatabase(tmpdir, map_size=2**32, readonly=False, track_citations=False,
+                                                 track_columns=False, track_indexes=False)
+        records = _synthetic_records(n)
+        db.record.setitem_batched(records)
+        for lazy in (False, True):
+            start = time.perf_counter()
+            db.record.getitem_batched(records, lazy=lazy,
+                                      project=lambda r: inspirehep_tools.project_record(r, ('title', 'date', 'citation_count')))
+            project = time.perf_counter() - start
+            start = time.perf_counter()
+            list(db.record.items(lazy=lazy) | pu.filter_by_year(2012) | pu.get_title)
+            print("{} records ({}): project 3 fields {:.2f} s, year filter pipe {:.2f} s".format(
+                n, "lazy" if lazy else "full decode", project, time.perf_counter() - start))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def bench_shared_env(n=20000, batch=500):
+    """Ingesting records with all indexes: one environment per store vs named databases of a shared one."""
+    import tempfile
+    import shutil
+    import paper_tools.inspirehep_tools as inspirehep_tools
+    records = _synthetic_records(n)
+    for shared in (False, True):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = inspirehep_tools.InspireHEPDatabase(tmpdir, map_size=2**32, readonly=False, shared_env=shared)
+            ids = list(records)
+            start = time.perf_counter()
+            for i in range(0, n, batch):
+                db.record.setitem_batched({rec_id: records[rec_id] for rec_id in ids[i:i + batch]})
+            print("{} records ({}): ingest with indexes {:.2f} s, {} file(s)".format(
+                n, "shared environment" if shared else "separate environments", time.perf_counter() - start,
+                len(os.listdir(tmpdir))))
+            db.close()
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def bench_record_query(n=20000):
+    """abstract filter + citation sort + take(5): streaming pipes vs a planned RecordQuery."""
+    import tempfile
+    import shutil
+    import pipe
+    import paper_tools.inspirehep_tools as inspirehep_tools
+    import paper_tools.pipe_usage as pu
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = inspirehep_tools.InspireHEPDatabase(tmpdir, map_size=2**32, readonly=False, track_citations=False)
+        db.record.setitem_batched(_synthetic_records(n))
+        db.columns.columns()
+
+        def chain(src):
+            return list(src | pu.filter_by_year(2012) | pu.filter_by_abstract("ringdown")
+                        | pu.sort_by_citations() | pipe.take(5) | pu.get_id)
+        start = time.perf_counter()
+        expected = chain(db.record.items())
+        piped = time.perf_counter() - start
+        start = time.perf_counter()
+        planned = chain(db.query())
+        query = time.perf_counter() - start
+        assert planned == expected
+        print("year + abstract filter, citation top-5 over {} records: pipes {:.1f} ms, query {:.1f} ms".format(
+            n, piped * 1e3, query * 1e3))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def bench_record_index(n=20000):
+    """Date range and texkey lookups: secondary indexes vs scanning decoded records."""
+    import tempfile
+    import shutil
+    import datetime
+    import paper_tools.inspirehep_tools as inspirehep_tools
+    import paper_tools.pipe_usage as pu
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = inspirehep_tools.InspireHEPDatabase(tmpdir, map_size=2**32, readonly=False, track_citations=False)
+        records = _synthetic_records(n)
+        for rec_id, record in records.items():
+            record["metadata"]["texkeys"] = ["Author:{}x".format(rec_id)]
+        db.record.setitem_batched(records)
+
+        start = time.perf_counter()
+        scanned = set(db.record.items() | pu.filter_after(2020, 1, 1) | pu.filter_before(2020, 3, 1) | pu.get_id)
+        scan = time.perf_counter() - start
+        start = time.perf_counter()
+        indexed = db.indexes.created_between(datetime.datetime(2020, 1, 1), datetime.datetime(2020, 3, 1))
+        ranged = time.perf_counter() - start
+        assert set(indexed) == scanned
+
+        texkeys = ["Author:{}x".format(i) for i in range(0, n, n // 100)]
+        start = time.perf_counter()
+        found = db.indexes.by_texkey(texkeys)
+        lookup = time.perf_counter() - start
+        assert len(found) == len(texkeys)
+        print("{} records: date range scan {:.1f} ms, indexed {:.2f} ms; {} texkey lookups {:.2f} ms".format(
+            n, scan * 1e3, ranged * 1e3, len(texkeys), lookup * 1e3))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def bench_latex_snippet(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.tex")):
+    """Full-document cleanup of one manuscript: well-formedness, paragraphs, sections and main text."""
+    import paper_tools.latex_tools as latex_tools
+    with open(path) as f:
+        text = f.read()
+    start = time.perf_counter()
+    snippet = latex_tools.LatexSnippet(text)
+    snippet.is_well_formed()
+    snippet.get_paragraphs()
+    snippet.get_sections()
+    snippet.get_maintext()
+    print("LatexSnippet cleanup of {} ({} chars): {:.2f} s".format(
+        os.path.basename(path), len(text), time.perf_counter() - start))
+    for fast in (False, True):
+        start = time.perf_counter()
+        snippet = latex_tools.LatexSnippet(text, fast=fast)
+        snippet.get_paragraphs()
+        snippet.get_sections()
+        print("  paragraphs + sections ({}): {:.4f} s".format(
+            "scan_latex" if fast else "walker", time.perf_counter() - start))
+
+
+def bench_latex_text_chunks(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.tex")):
+    """Embedding-ready paragraph text: chained cleanup and per-paragraph LatexNodes2Text vs get_text_chunks."""
+    import re
+    from pylatexenc.latex2text import LatexNodes2Text
+    import paper_tools.latex_tools as latex_tools
+    with open(path) as f:
+        text = f.read()
+    start = time.perf_counter()
+    maintext = latex_tools.LatexSnippet(text).get_maintext()
+    maintext = re.sub(r"\\cite[pt]?(\[[^\]]*\])*\{[^}]*\}", "", maintext)
+    chained = [LatexNodes2Text().latex_to_text(p) for p in latex_tools.split_to_paragraphs(maintext)]
+    print("maintext + cite regex + LatexNodes2Text per paragraph: {:.2f} s ({} paragraphs)".format(
+        time.perf_counter() - start, len(chained)))
+    start = time.perf_counter()
+    chunks = latex_tools.LatexSnippet(text).get_text_chunks()
+    print("get_text_chunks: {:.2f} s ({} chunks)".format(time.perf_counter() - start, len(chunks)))
+
+
+def bench_latex_document(edits=20, path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.tex")):
+    """Re-checking a manuscript after small edits: full LatexSnippet parse vs incremental LatexDocument."""
+    import random
+    import paper_tools.latex_tools as latex_tools
+    with open(path) as f:
+        text = f.read()
+    rng = random.Random(0)
+    versions = []
+    for _ in range(edits):
+        i = text.find(" ", rng.randrange(len(text)))
+        text = text[:i] + " edited" + text[i:]
+        versions.append(text)
+    def check(snippet):
+        snippet.is_well_formed()
+        snippet.get_maintext()
+        snippet.get_paragraphs()
+        snippet.get_sections()
+    start = time.perf_counter()
+    for version in versions[:3]:
+        check(latex_tools.LatexSnippet(version))
+    print("LatexSnippet per check: {:.3f} s".format((time.perf_counter() - start) / 3))
+    document = latex_tools.LatexDocument(versions[0])
+    start = time.perf_counter()
+    for version in versions[1:]:
+        document.update(version)
+        check(document)
+    print("LatexDocument per check after an edit: {:.3f} s".format((time.perf_counter() - start) / (edits - 1)))
+
+
+def bench_latex_stream(copies=100, path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.tex")):
+    """Paragraphs of a large concatenated source: LatexSnippet on the whole text vs iter_paragraphs on the file."""
+    import tempfile
+    import tracemalloc
+    import paper_tools.latex_tools as latex_tools
+    with open(path) as f:
+        text = f.read()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        big = os.path.join(tmpdir, "big.tex")
+        with open(big, "w") as f:
+            for _ in range(copies):
+                f.write(text)
+        for name, run in (("LatexSnippet", lambda: latex_tools.LatexSnippet(open(big).read()).get_paragraphs()),
+                          ("iter_paragraphs", lambda: list(latex_tools.iter_paragraphs(big)))):
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            for _ in (latex_tools.iter_paragraphs(big) if name == "iter_paragraphs" else [run()]):
+                pass
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("{} on {:.1f} MB: {:.2f} s, peak {:.1f} MB".format(
+                name, os.path.getsize(big) / 1e6, elapsed, peak / 1e6))
+
+
+def bench_latex_batch(copies=16, path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.tex")):
+    """Paragraphs, sections and main text of many manuscripts: one process vs a process pool."""
+    import paper_tools.latex_batch as latex_batch
+    with open(path) as f:
+        text = f.read()
+    sources = [("copy{}.tex".format(i), text) for i in range(copies)]
+    for processes in (1, os.cpu_count() or 1):
+        start = time.perf_counter()
+        results = list(latex_batch.process_sources(sources, fields=("paragraphs", "sections", "maintext"),
+                                                   processes=processes, chunksize=1))
+        print("{} files, {} process(es): {:.2f} s".format(len(results), processes, time.perf_counter() - start))
+
+
+BENCHMARKS = {
+    "import_time": bench_import_time,
+    "lexical_search": bench_lexical_search,
+    "pagerank": bench_pagerank,
+    "personalized_pagerank": bench_personalized_pagerank,
+    "graph_report": bench_graph_report,
+    "column_store": bench_column_store,
+    "record_query": bench_record_query,
+    "record_compression": bench_record_compression,
+    "lazy_records": bench_lazy_records,
+    "shared_env": bench_shared_env,
+    "record_index": bench_record_index,
+    "latex_snippet": bench_latex_snippet,
+    "latex_text_chunks": bench_latex_text_chunks,
+    "latex_document": bench_latex_document,
+    "latex_stream": bench_latex_stream,
+    "latex_batch": bench_latex_batch,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -97,6 +97,12 @@ Some text here.
         self.assertNotIn(r"\newcommand", cleaned)
         self.assertIn("Some text here", cleaned)
 
+    def test_nontext_removed_comment_in_section(self):
+        # the comment node nested in the \section node used to put "\section{A " back
+        tex = "Intro text.\n\\section{A % c\n}\nBody % d\nmore.\n"
+        self.assertEqual(latex_tools.LatexSnippet(tex).nontext_removed(), "Intro text.\n\nBody more.\n")
+        self.assertEqual(latex_tools.LatexDocument(tex).nontext_removed(), "Intro text.\n\nBody more.\n")
+
     def test_get_maintext(self):
         tex = r"""
 \documentclass{article}
@@ -225,6 +231,63 @@ More text.
         s = latex_tools.LatexSnippet(tex)
         self.assertTrue(s.is_well_formed())
 
+    def test_parses_once(self):
+        tex = r"""
+\documentclass{article}
+\begin{document}
+\section{One}
+First % comment
+paragraph.
+
+\section{Two}
+Second paragraph.
+\section{Three}
+\end{document}
+"""
+        s = latex_tools.LatexSnippet(tex)
+        parse_content = s.walker.parse_content
+        depth = [0]
+        top_level = []
+        def counting_parse(*args, **kwargs):
+            # pylatexenc calls parse_content recursively; count the outermost calls only
+            if depth[0] == 0:
+                top_level.append(args)
+            depth[0] += 1
+            try:
+                return parse_content(*args, **kwargs)
+            finally:
+                depth[0] -= 1
+        with patch.object(s.walker, 'parse_content', side_effect=counting_parse):
+            self.assertTrue(s.is_well_formed())
+            s.get_paragraphs()
+            self.assertEqual(len(s.get_sections()), 2)
+            main = s.get_maintext()
+            s.nontext_removed()
+            s.get_intervals(latex_tools.SectionVisitor)
+        self.assertEqual(len(top_level), 1)
+        self.assertEqual(main, latex_tools.LatexSnippet(s.comments_removed()).nontext_removed())
+
+    def test_maintext_comment_inside_nontext_macro(self):
+        # The comment node is visited before the enclosing \section node
+        tex = "Before.\n\\section{Intro % note\n}\nAfter.\n"
+        s = latex_tools.LatexSnippet(tex)
+        self.assertEqual(s.get_maintext(), "Before.\n\nAfter.\n")
+
+    def test_maintext_macro_before_comment(self):
+        # Parsed with the comment, \maketitle absorbs the newline; without it, that newline is part of a paragraph break
+        for tex in ("\\end{abstract}\n\\maketitle\n% \\flushbottom\n\n\nText.\n", "\\maketitle% c\ntext \n\n"):
+            s = latex_tools.LatexSnippet(tex)
+            self.assertEqual(s.get_maintext(), latex_tools.LatexSnippet(s.comments_removed()).nontext_removed())
+
+    def test_maintext_matches_baseline_on_sample(self):
+        import hashlib
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.tex")) as f:
+            main = latex_tools.LatexSnippet(f.read()).get_maintext()
+        # Output of the two-pass get_maintext (comments_removed, then nontext_removed on a new snippet)
+        self.assertEqual(len(main), 96640)
+        self.assertEqual(hashlib.sha256(main.encode()).hexdigest(),
+                         "d0a6de4bdfdbb3bbae61ceaf2b3a10c1dcef103a0665baff810163a3631b370f")
+
 
 class TestLatexHelpers(unittest.TestCase):
     """Tests for module-level helper functions."""
@@ -244,6 +307,11 @@ class TestLatexHelpers(unittest.TestCase):
         result = latex_tools.filter_empty(texts)
         self.assertEqual(result, [])
 
+    def test_merge_intervals(self):
+        self.assertEqual(latex_tools.merge_intervals([(10, 12), (0, 5), (2, 3), (4, 8), (12, 13)]),
+                         [(0, 8), (10, 13)])
+        self.assertEqual(latex_tools.merge_intervals([]), [])
+
     def test_split_to_paragraphs(self):
         text = "Para 1.\n\nPara 2.\n\n\nPara 3."
         result = latex_tools.split_to_paragraphs(text)
@@ -312,10 +380,496 @@ Content two.
         self.assertEqual(result, [])
 
 
+class TestLatexScan(unittest.TestCase):
+    """The scan_latex fast path must agree with the CommentVisitor / SectionVisitor walker."""
+
+    DOCUMENTS = [
+        "Hello % inline comment\nworld.\n% Another comment\n",
+        "a % c\n  b",
+        "a % c\n\n b",
+        "a %c\r\nb",
+        "%end",
+        "50\\% of the data % but not this\nrest",
+        "line \\\\% comment after a line break\nnext",
+        "$x % c\n y$ and \\[ a %d\n \\] and \\(b\\)",
+        "\\section{Intro % note\n}\nText.\n\\section*{Two}\n",
+        "x\\begin{verbatim}%no\n\\section{no}\n\\end{verbatim} %yes\n",
+        "\\begin {verbatim}%no\n\\end{verbatim}%yes\n",
+        "\\begin{lstlisting}[language=C]\n%x {\n\\end{lstlisting}%c\n",
+        "\\verb|%x| %y\nz \\verb !{%! \\verb{%{ %w\n",
+        "\\url{a%b\n}c \\textbf{a}%c\nx \\\\[2pt]%c\n",
+        "\\begin{itemize}\n\\item a % c\n\\item[b] d\n\\end{itemize}\n\\sectionx \\section{End}",
+        "\\begin{comment}%q\n\\end{comment}\\begin{Verbatim}%a\n\\end{Verbatim}",
+        "$$a %b\n$$ $\\text{$x$ %c\n}$",
+    ]
+
+    def assertMatchesWalker(self, text):
+        scan = latex_tools.scan_latex(text)
+        self.assertIsNotNone(scan, text)
+        walker = latex_tools.LatexSnippet(text, fast=False)
+        self.assertEqual(scan.comments, walker.get_intervals(latex_tools.CommentVisitor), text)
+        self.assertEqual(scan.sections, [n.pos for n in walker.visited_nodes(latex_tools.SectionVisitor)], text)
+
+    def test_documents(self):
+        for text in self.DOCUMENTS:
+            self.assertMatchesWalker(text)
+
+    def test_sample_files(self):
+        for name in ("sample.tex", "main_text.tex"):
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name)) as f:
+                text = f.read()
+            self.assertMatchesWalker(text)
+            fast = latex_tools.LatexSnippet(text)
+            walker = latex_tools.LatexSnippet(text, fast=False)
+            self.assertEqual(fast.get_paragraphs(), walker.get_paragraphs())
+            self.assertEqual(fast.get_sections(), walker.get_sections())
+            self.assertIsNone(fast._parsed)  # no parse needed
+
+    def test_random_documents(self):
+        import random
+        fragments = ["a", " ", "\n", "\n\n", "\t", "%c", "% x y", "\\%", "\\\\", "{", "}", "$", "$$",
+                     "\\(", "\\)", "\\[", "\\]", "\\section{Intro}", "\\section*{A %c\n}", "\\verb|%|",
+                     "\\verb!a{!", "\\begin{verbatim}%v\n\\end{verbatim}", "\\begin{lstlisting}\n%x\n\\end{lstlisting}",
+                     "\\begin{itemize}", "\\end{itemize}", "\\item a", "\\frac{1}{2}", "\\emph{e}", "\\\\[2pt]",
+                     "\\url{a%b}", "\\foo", "a[", "]", "\\sectionx"]
+        rng = random.Random(0)
+        checked = 0
+        for _ in range(1500):
+            text = "".join(rng.choice(fragments) for _ in range(rng.randint(1, 12)))
+            if latex_tools.scan_latex(text) is None:
+                continue
+            self.assertMatchesWalker(text)
+            checked += 1
+        self.assertGreater(checked, 100)
+
+    def test_ambiguous_falls_back(self):
+        for text in ["{a %c\nb", "a } %c\n b", "$a % c\nb", "\\(a %c\n", "\\begin{itemize} %c\n",
+                     "\\end{itemize} %c\n", "\\begin{verbatim}%a", "\\verb|%", "\\verb", "\\verb*|%|%c\nq",
+                     "\\begin{verbatim*}%c\n\\end{verbatim*}", "\\begin{lstlisting}[a=%]\n%x\n\\end{lstlisting}",
+                     "\\url{a%b}c"]:
+            self.assertIsNone(latex_tools.scan_latex(text), text)
+        text = "\\url{a%b}c % d\n"
+        self.assertEqual(latex_tools.LatexSnippet(text).comments_removed(),
+                         latex_tools.LatexSnippet(text, fast=False).comments_removed())
+
+    def test_comment_between_macro_arguments(self):
+        # the walker reads these comments as part of the arguments, not as comment nodes
+        import io
+        for text in ["\\newcommand{\\foo}% c\n{bar}\nText here.\n", "\\section% c\n{Intro}\nText.\n",
+                     "\\frac1% c\n2 and more.\n", "\\frac\\item % c\n{b}\n",
+                     "\\section\\begin{itemize}1\\end{itemize}% c\n", "\\begin{tabular}\\end{tabular}%\n\\textbf{b}\n",
+                     "\\frac\n\n  % d\n  \n1", "\\frac{a % c\n}\n\nb", "\\newcommand{\\foo}\\section%\n"]:
+            self.assertIsNone(latex_tools.scan_latex(text), text)
+            fast = latex_tools.LatexSnippet(text)
+            walker = latex_tools.LatexSnippet(text, fast=False)
+            self.assertEqual(fast.comments_removed(), walker.comments_removed(), text)
+            self.assertEqual(fast.get_paragraphs(), walker.get_paragraphs(), text)
+            for chunk_size in (1, 3, 7):
+                self.assertEqual(list(latex_tools.iter_paragraphs(io.StringIO(text), chunk_size)),
+                                 walker.get_paragraphs(), text)
+        for text in ["\\section{A}% c\n[b]\n", "\\maketitle\n% \\flushbottom\n", "\\usepackage{physics} % c\n",
+                     "x \\\\[2pt]%c\n"]:
+            self.assertMatchesWalker(text)
+
+    def test_verb_argument_and_open_bracket(self):
+        # a \verb read as a macro argument, and a [ after \\ running to the end of the text
+        import io
+        for text in ["\\frac\\verb|%|", "\\def\\x{y}\\\\[\\section{Intro}\\textbf{b}",
+                     "\\emph\\verb|%|*\\section*{A}\\\\[2pt]", "\\item[x\n\n\\section{A}",
+                     "a \\verb|%|\\emph\\verb|%|", "\\frac[\\verb|%|a ", "\\frac[% c\n]",
+                     "\\item[2pt]]\n\n\\frac]% c\n\\verb|%|\\section{A}"]:
+            self.assertIsNone(latex_tools.scan_latex(text), text)
+            fast = latex_tools.LatexSnippet(text)
+            walker = latex_tools.LatexSnippet(text, fast=False)
+            self.assertEqual(fast.comments_removed(), walker.comments_removed(), text)
+            self.assertEqual(fast.get_sections(), walker.get_sections(), text)
+            self.assertEqual(fast.get_paragraphs(), walker.get_paragraphs(), text)
+            for chunk_size in (1, 3, 7):
+                self.assertEqual(list(latex_tools.iter_paragraphs(io.StringIO(text), chunk_size)),
+                                 walker.get_paragraphs(), text)
+        for text in ["a\\\\[2pt]\\section{A}", "a\\\\[{]}]\\section{A} % c\n", "\\item[$]$] b % c\n",
+                     "\\verb|%| b % c\n", "\\newcommand{\\foo}[1]{#1} % c\n"]:
+            self.assertMatchesWalker(text)
+
+    def test_verbatim_kept(self):
+        text = "A % gone\n\\begin{verbatim}\n% kept\n\\end{verbatim}\n\\verb|%kept| 100\\% kept"
+        cleaned = latex_tools.LatexSnippet(text).comments_removed()
+        self.assertNotIn("gone", cleaned)
+        self.assertEqual(cleaned.count("kept"), 3)
+
+
+class TestLatexDocument(unittest.TestCase):
+    """Tests for the incremental LatexDocument model."""
+
+    TEX = r"""\documentclass{article}
+\usepackage{amsmath} % math
+\begin{document}
+\section{Intro}
+First paragraph % with a comment
+continues here.
+
+Second paragraph with $x^2$ and
+\begin{equation}
+  a = b % inside
+
+  \label{eq}
+\end{equation}
+
+\section{Methods}
+Third paragraph.
+\begin{verbatim}
+% not a comment
+
+\end{verbatim}
+\section{End}
+\end{document}
+"""
+
+    def assertSameAsSnippet(self, document, text):
+        snippet = latex_tools.LatexSnippet(text, fast=False)
+        self.assertEqual(document.is_well_formed(), snippet.is_well_formed())
+        self.assertEqual(document.comments_removed(), snippet.comments_removed())
+        self.assertEqual(document.get_maintext(), snippet.get_maintext())
+        self.assertEqual(document.get_paragraphs(), snippet.get_paragraphs())
+        self.assertEqual(document.get_sections(), snippet.get_sections())
+        for visitor_class in (latex_tools.NontextVisitor, latex_tools.CommentVisitor, latex_tools.SectionVisitor):
+            self.assertEqual(sorted(document.get_intervals(visitor_class)), sorted(snippet.get_intervals(visitor_class)))
+
+    def test_blocks(self):
+        blocks = [self.TEX[a:b] for a, b in latex_tools.LatexDocument.split_blocks(self.TEX)]
+        self.assertEqual("".join(blocks), self.TEX)
+        self.assertIn("\\begin{document}", blocks)
+        self.assertIn("\\end{document}", blocks)
+        # no split inside environments or verbatim
+        self.assertTrue(any(b.startswith("Second paragraph") and b.rstrip().endswith("\\end{equation}") for b in blocks))
+        self.assertTrue(any("\\begin{verbatim}" in b and "\\end{verbatim}" in b for b in blocks))
+
+    def test_matches_snippet(self):
+        self.assertSameAsSnippet(latex_tools.LatexDocument(self.TEX), self.TEX)
+
+    def test_matches_snippet_sample(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.tex")) as f:
+            text = f.read()
+        document = latex_tools.LatexDocument(text)
+        self.assertGreater(len(document.blocks), 50)
+        self.assertSameAsSnippet(document, text)
+
+    def test_update_parses_changed_blocks_only(self):
+        document = latex_tools.LatexDocument(self.TEX)
+        self.assertEqual(document.update(self.TEX), 0)
+        edited = self.TEX.replace("Third paragraph.", "Third paragraph, % edited\nrewritten.")
+        self.assertEqual(document.update(edited), 1)
+        self.assertSameAsSnippet(document, edited)
+        inserted = edited.replace("\\section{Methods}", "A new paragraph.\n\n\\section{Methods}")
+        self.assertEqual(document.update(inserted), 1)
+        self.assertSameAsSnippet(document, inserted)
+        self.assertEqual(document.update(self.TEX), 1)  # only the current blocks stay cached
+        self.assertSameAsSnippet(document, self.TEX)
+
+    def test_ambiguous_text_is_one_block(self):
+        text = "A {unclosed % c\n\nB"
+        self.assertEqual(latex_tools.LatexDocument.split_blocks(text), [(0, len(text))])
+        self.assertSameAsSnippet(latex_tools.LatexDocument(text), text)
+
+    def test_parse_error_raised_on_use(self):
+        document = latex_tools.LatexDocument("\\verb")
+        self.assertFalse(document.is_well_formed())
+        with self.assertRaises(Exception):
+            document.comments_removed()
+
+
+class TestLatexStream(unittest.TestCase):
+    """Tests for chunked scanning and the streaming extractors."""
+
+    def setUp(self):
+        self.path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.tex")
+        with open(self.path) as f:
+            self.text = f.read()
+
+    def test_scanner_is_chunk_invariant(self):
+        expected = latex_tools.scan_latex(self.text)
+        for chunk_size in (1, 7, 4096):
+            scanner = latex_tools.LatexScanner()
+            for i in range(0, len(self.text), chunk_size):
+                scanner.feed(self.text[i:i+chunk_size])
+            scanner.feed("", final=True)
+            self.assertFalse(scanner.ambiguous)
+            self.assertEqual(scanner.comments, expected.comments)
+            self.assertEqual(scanner.sections, expected.sections)
+            self.assertEqual(scanner.breaks, expected.breaks)
+
+    def test_blocks(self):
+        import io
+        blocks = list(latex_tools.iter_blocks(io.StringIO(self.text), chunk_size=7))
+        self.assertEqual("".join(b.text for b in blocks), self.text)
+        self.assertEqual([(b.start, b.start + len(b.text)) for b in blocks],
+                         latex_tools.LatexDocument.split_blocks(self.text))
+        self.assertEqual([(b.start + x, b.start + y) for b in blocks for x, y in b.comments],
+                         latex_tools.scan_latex(self.text).comments)
+
+    def test_paragraphs_and_sections(self):
+        import io
+        snippet = latex_tools.LatexSnippet(self.text)
+        for chunk_size in (7, 1 << 16):
+            self.assertEqual(list(latex_tools.iter_paragraphs(io.StringIO(self.text), chunk_size)),
+                             snippet.get_paragraphs())
+            self.assertEqual(list(latex_tools.iter_sections(io.StringIO(self.text), chunk_size)),
+                             snippet.get_sections())
+        spans = list(latex_tools.iter_section_spans(self.path))
+        self.assertEqual([self.text[a:b] for a, b in spans], snippet.get_sections())
+
+    def test_ambiguous_tail_uses_walker(self):
+        import io
+        text = "Para one. % c\n\nA {unclosed % d\n\nB"
+        blocks = list(latex_tools.iter_blocks(io.StringIO(text), chunk_size=4))
+        self.assertEqual([b.text for b in blocks], ["Para one. % c\n\n", "A {unclosed % d\n\nB"])
+        tail = latex_tools.LatexSnippet(blocks[1].text, fast=False)
+        self.assertEqual(blocks[1].comments, tail.get_intervals(latex_tools.CommentVisitor))
+        self.assertEqual(list(latex_tools.iter_paragraphs(io.StringIO(text)))[0], "Para one.")
+
+    def test_ambiguous_block_reads_bounded_lookahead(self):
+        import io
+        class CountingSource(io.StringIO):
+            def read(self, size=-1):
+                piece = super().read(size)
+                self.consumed = self.tell()
+                return piece
+        head = "\\newcommand{\\foo}% c\n{bar}\nText here.\n\n"
+        text = head + "".join("Para {}. % c\n\n".format(i) for i in range(2000))
+        source = CountingSource(text)
+        blocks = latex_tools.iter_blocks(source, chunk_size=256)
+        first = next(blocks)
+        self.assertEqual(first.text, head)
+        self.assertLess(source.consumed, 1024)
+        rest = list(blocks)
+        self.assertEqual(len(rest), 2000)
+        walker = latex_tools.LatexSnippet(text, fast=False)
+        self.assertEqual([(b.start + x, b.start + y) for b in [first] + rest for x, y in b.comments],
+                         walker.get_intervals(latex_tools.CommentVisitor))
+        self.assertEqual(list(latex_tools.iter_paragraphs(io.StringIO(text), chunk_size=256)),
+                         walker.get_paragraphs())
+        # no blank line outside the unclosed group within max_lookahead: the rest is one block
+        text = "A {unclosed % d\n\n" + "Para. % c\n\n" * 200
+        blocks = list(latex_tools.iter_blocks(io.StringIO(text), chunk_size=64, max_lookahead=512))
+        self.assertEqual([b.text for b in blocks], [text])
+
+    def test_bounded_memory(self):
+        import tracemalloc
+        class GeneratedSource:
+            # ~300 kB of LaTeX produced on demand, never held at once
+            def __init__(self, n):
+                self.n = n
+                self.buffer = ""
+            def read(self, size):
+                while len(self.buffer) < size and self.n > 0:
+                    self.n -= 1
+                    self.buffer += "\\section{S}\nText % comment\nmore $x^2$.\n\nSecond paragraph.\n\n"
+                piece, self.buffer = self.buffer[:size], self.buffer[size:]
+                return piece
+        tracemalloc.start()
+        try:
+            count = sum(1 for _ in latex_tools.iter_paragraphs(GeneratedSource(5000), chunk_size=1 << 12))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(count, 10000)
+        self.assertLess(peak, 1 << 17)
+
+
+import paper_tools.latex_batch as latex_batch
+
+
+_process_source = latex_batch.process_source
+
+def _process_source_or_exit(name, text, fields=latex_batch.DEFAULT_FIELDS):
+    # stands in for latex_batch.process_source in pool workers: kills the worker on crash.tex
+    if name == "crash.tex":
+        os._exit(1)
+    return _process_source(name, text, fields)
+
+
+class TestLatexBatch(unittest.TestCase):
+    """Tests for batch processing of LaTeX sources."""
+
+    SOURCES = {
+        "a.tex": "\\section{One}\nFirst % comment\nparagraph.\n\n\\section{Two}\nSecond.\n\\section{Three}\n",
+        "sub/b.tex": "Only one paragraph.\n",
+        "broken.tex": "\\verb",  # pylatexenc raises on this
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmpdir, "sources")
+        for name, text in self.SOURCES.items():
+            path = os.path.join(self.source_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text)
+        with open(os.path.join(self.source_dir, "notes.txt"), "w") as f:
+            f.write("not a source")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_iter_sources_directory_and_tarball(self):
+        from_dir = dict(latex_batch.iter_sources(self.source_dir))
+        self.assertEqual(from_dir, self.SOURCES)
+        import tarfile
+        tar_path = os.path.join(self.tmpdir, "sources.tar.gz")
+        with tarfile.open(tar_path, "w:gz") as tar:
+            tar.add(self.source_dir, arcname="src")
+        from_tar = dict(latex_batch.iter_sources(tar_path))
+        self.assertEqual(from_tar, {"src/" + name: text for name, text in self.SOURCES.items()})
+        with self.assertRaises(ValueError):
+            list(latex_batch.iter_sources(os.path.join(self.source_dir, "a.tex")))
+
+    def test_process_source(self):
+        result = latex_batch.process_source("a.tex", self.SOURCES["a.tex"])
+        self.assertEqual(result["name"], "a.tex")
+        self.assertTrue(result["well_formed"])
+        self.assertEqual(result["sections"], latex_tools.LatexSnippet(self.SOURCES["a.tex"]).get_sections())
+        self.assertNotIn("comment", " ".join(result["paragraphs"]))
+        self.assertIn("error", latex_batch.process_source("broken.tex", self.SOURCES["broken.tex"]))
+
+    def test_failures_are_isolated(self):
+        for processes in (1, 2):
+            results = {r["name"]: r for r in latex_batch.process_sources(
+                latex_batch.iter_sources(self.source_dir), fields=("paragraphs", "maintext"),
+                processes=processes, chunksize=1)}
+            self.assertEqual(set(results), set(self.SOURCES))
+            self.assertIn("error", results["broken.tex"])
+            self.assertEqual(results["sub/b.tex"], {"name": "sub/b.tex", "paragraphs": ["Only one paragraph."],
+                                                    "maintext": "Only one paragraph.\n"})
+
+    def test_pool_matches_serial(self):
+        sources = [("doc{}.tex".format(i), "Text {} % c\n\n\\section{{S}}\nMore.\n".format(i)) for i in range(20)]
+        serial = list(latex_batch.process_sources(sources, processes=1))
+        pooled = list(latex_batch.process_sources(sources, processes=2, chunksize=3))
+        self.assertEqual(sorted(pooled, key=lambda r: r["name"]), sorted(serial, key=lambda r: r["name"]))
+
+    def test_dead_worker_is_isolated(self):
+        sources = [("doc{}.tex".format(i), "Text {}.\n".format(i)) for i in range(12)]
+        sources.insert(5, ("crash.tex", "Text.\n"))
+        with patch.object(latex_batch, "process_source", _process_source_or_exit):
+            results = {r["name"]: r for r in latex_batch.process_sources(sources, processes=2, chunksize=2)}
+        self.assertEqual(set(results), {name for name, _ in sources})
+        self.assertIn("BrokenProcessPool", results.pop("crash.tex")["error"])
+        for name, text in sources:
+            if name in results:
+                self.assertEqual(results[name], _process_source(name, text))
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            list(latex_batch.process_sources([("a.tex", "")], fields=("title",), processes=1))
+
+    def test_write_jsonl_and_lmdb(self):
+        import json
+        results = list(latex_batch.process_sources(latex_batch.iter_sources(self.source_dir), processes=1))
+        jsonl_path = os.path.join(self.tmpdir, "out.jsonl")
+        counts = latex_batch.write_jsonl(iter(results), jsonl_path)
+        self.assertEqual(counts, {"processed": 2, "failed": 1})
+        with open(jsonl_path) as f:
+            self.assertEqual([json.loads(line) for line in f], results)
+        lmdb_path = os.path.join(self.tmpdir, "out.lmdb")
+        counts = latex_batch.write_lmdb(iter(results), lmdb_path, batch_size=2)
+        self.assertEqual(counts, {"processed": 2, "failed": 1})
+        with latex_batch.LatexResultsLmdbWrapper(lmdb_path) as db:
+            self.assertEqual(dict(db.items()), {r["name"]: r for r in results})
+
+    def test_cli(self):
+        output = os.path.join(self.tmpdir, "cli.jsonl")
+        argv = ["latex_batch", self.source_dir, output, "--processes", "1", "--fields", "sections"]
+        with patch.object(sys, "argv", argv), patch("sys.stderr") as stderr:
+            latex_batch.main()
+        with open(output) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+
+class TestLatexCites(unittest.TestCase):
+    """Tests for citation key extraction."""
+
+    TEXT = (r"See \cite{a,b} and \citep[see][p.~2]{c}, \cite*{d} \citet {e}\nocite{f}." "\n"
+            r"% \cite{commented}" "\n"
+            r"\begin{verbatim}\cite{verbatim}\end{verbatim} \cite{g,% comment" "\n"
+            r" a} \citex{notacite} \newcommand{\mycite}[1]{\cite{#1}}")
+
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(os.path.dirname(__file__), "sample.tex")) as f:
+            cls.sample = f.read()
+
+    def test_get_cites(self):
+        snippet = latex_tools.LatexSnippet(self.TEXT)
+        cites = snippet.get_cites()
+        self.assertEqual([keys for _, _, keys in cites], [["a", "b"], ["c"], ["d"], ["e"], ["f"], ["g", "a"], []])
+        start, end, _ = cites[1]
+        self.assertEqual(self.TEXT[start:end], r"\citep[see][p.~2]{c}")
+        self.assertEqual(snippet.get_cite_keys(), ["a", "b", "c", "d", "e", "f", "g"])
+
+    def test_walker_fallback_agrees(self):
+        fast = latex_tools.LatexSnippet(self.TEXT)
+        walker = latex_tools.LatexSnippet(self.TEXT, fast=False)
+        self.assertIsNotNone(fast.scan())
+        self.assertEqual(fast.get_cites(), walker.get_cites())
+
+    def test_extract_cite_keys_sample(self):
+        keys = latex_tools.extract_cite_keys(self.sample)
+        self.assertIn("Berti:2015itd", keys)
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertFalse(any('#' in key for key in keys))
+
+
+class TestLatexTextChunks(unittest.TestCase):
+    """Tests for plain-text paragraph chunks."""
+
+    TEXT = (r"\documentclass{article}" "\n"
+            r"\newtheorem{theorem}{Theorem}" "\n"
+            r"\begin{document}" "\n"
+            r"\section{Intro}" "\n"
+            r"Black holes \cite{a} are \emph{very} dense % comment" "\n"
+            r"objects~\citep[e.g.][]{b}, with $M = 10^6$." "\n\n"
+            r"% only a comment" "\n\n"
+            r"Second \textbf{paragraph}." "\n"
+            r"\section{Two}" "\n"
+            r"Third." "\n"
+            r"\begin{thebibliography}{9}\bibitem{a} A. Author\end{thebibliography}" "\n"
+            r"\end{document}")
+
+    def test_chunks(self):
+        chunks = latex_tools.extract_text_chunks(self.TEXT)
+        self.assertEqual([c.text for c in chunks],
+                         ["Black holes are very dense objects, with M = 10^6.", "Second paragraph.", "Third."])
+        self.assertTrue(self.TEXT[chunks[0].start:chunks[0].end].startswith(r"Black holes \cite{a}"))
+        self.assertTrue(self.TEXT[chunks[0].start:chunks[0].end].endswith("$M = 10^6$."))
+        self.assertEqual(self.TEXT[chunks[1].start:chunks[1].end], r"Second \textbf{paragraph}.")
+        self.assertEqual(self.TEXT[chunks[2].start:chunks[2].end], "Third.")
+
+    def test_fragment_without_document(self):
+        chunks = latex_tools.LatexSnippet("One \\cite{x}.\n\nTwo.").get_text_chunks()
+        self.assertEqual(chunks, [latex_tools.TextChunk(0, 13, "One."), latex_tools.TextChunk(15, 19, "Two.")])
+
+    def test_par_splits_chunks(self):
+        text = r"First sentence here.\par Second sentence there."
+        chunks = latex_tools.LatexSnippet(text).get_text_chunks()
+        self.assertEqual([c.text for c in chunks], ["First sentence here.", "Second sentence there."])
+        self.assertEqual([text[c.start:c.end] for c in chunks], ["First sentence here.", "Second sentence there."])
+
+    def test_sample_has_no_cites_or_comments(self):
+        with open(os.path.join(os.path.dirname(__file__), "sample.tex")) as f:
+            text = f.read()
+        chunks = latex_tools.extract_text_chunks(text)
+        self.assertGreater(len(chunks), 10)
+        for chunk in chunks:
+            self.assertNotIn("<cit.>", chunk.text)
+            self.assertNotIn("%", text[chunk.start:chunk.start + 1])
+            self.assertLess(chunk.start, chunk.end)
+
+
 # ============================================================================
 # lmdb_wrapper tests
 # ============================================================================
 
+import lmdb
 import paper_tools.lmdb_wrapper as lmdb_wrapper
 
 
@@ -447,6 +1001,171 @@ class TestLmdbWrapper(unittest.TestCase):
         db.env.close()
 
 
+class TestLmdbCompression(unittest.TestCase):
+    """Tests for zstd value compression with trained dictionaries."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmpdir, "test.lmdb")
+        self.values = {"k{:04d}".format(i): '{{"title": "Paper {}", "abstract": "black hole ringdown {} quasinormal"}}'.format(
+            i, "mode " * (i % 7)).encode() for i in range(1000)}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def raw_values(self, db):
+        with db.env.begin() as txn:
+            return dict(txn.cursor())
+
+    def test_enable_and_disable(self):
+        with lmdb_wrapper.LmdbWrapperBase(self.db_path, readonly=False) as db:
+            db.setitem_batched(self.values)
+            self.assertIsNone(db.compression_info())
+            db.enable_compression(dict_size=4096, samples=500, batch_size=300)
+            info = db.compression_info()
+            self.assertNotEqual(info['dict_id'], 0)
+            self.assertEqual(info['dictionaries'], [info['dict_id']])
+            raw = self.raw_values(db)
+            self.assertTrue(all(v.startswith(lmdb_wrapper.ZSTD_MAGIC) for v in raw.values()))
+            self.assertLess(sum(map(len, raw.values())), sum(map(len, self.values.values())) / 3)
+            self.assertEqual(dict(db.items()), self.values)
+            self.assertEqual(dict(db.raw_items()), self.values)
+            db["new"] = b"written after"
+            self.assertTrue(self.raw_values(db)[b"new"].startswith(lmdb_wrapper.ZSTD_MAGIC))
+            self.assertEqual(db.getitem_batched(["new", "k0001"]), {"new": b"written after", "k0001": self.values["k0001"]})
+
+            db.disable_compression()
+            self.assertIsNone(db.compression_info())
+            self.assertEqual(self.raw_values(db)[b"k0002"], self.values["k0002"])
+            self.assertEqual(len(db), len(self.values) + 1)
+
+    def test_readonly_reopen_and_old_dictionaries(self):
+        with lmdb_wrapper.LmdbWrapperBase(self.db_path, readonly=False) as db:
+            db.setitem_batched(self.values)
+            db.enable_compression(dict_size=4096, samples=500)
+            first = db.compression_info()['dict_id']
+            old_frame = db._compress(b"old value")
+            db.setitem_batched({"k{:04d}".format(i): b"retrain " * 20 for i in range(500)})
+            db.enable_compression(dict_size=4096, samples=500)
+            self.assertIn(first, db.compression_info()['dictionaries'])
+            self.assertNotEqual(db.compression_info()['dict_id'], first)
+            # A value still compressed with the first dictionary stays readable
+            with db.env.begin(write=True) as txn:
+                txn.put(b"old", old_frame)
+        lmdb_wrapper._dictionaries.clear()
+        lmdb_wrapper._local.__dict__.clear()
+        with lmdb_wrapper.LmdbWrapperBase(self.db_path, readonly=True) as db:
+            self.assertEqual(db["old"], b"old value")
+            self.assertEqual(db["k0999"], self.values["k0999"])
+            self.assertEqual(db["k0000"], b"retrain " * 20)
+            self.assertEqual(len(db), len(self.values) + 1)
+
+    def test_without_dictionary(self):
+        with lmdb_wrapper.LmdbWrapperBase(self.db_path, readonly=False) as db:
+            db["only"] = b"x" * 1000
+            db.enable_compression()  # too few values to train on
+            self.assertEqual(db.compression_info()['dict_id'], 0)
+            self.assertLess(len(self.raw_values(db)[b"only"]), 100)
+            self.assertEqual(db["only"], b"x" * 1000)
+        self.assertEqual(lmdb_wrapper.decompress(b"plain"), b"plain")
+
+    def test_magic_prefix_without_compression(self):
+        # a raw value that happens to start like a zstd frame is not decompressed
+        value = lmdb_wrapper.ZSTD_MAGIC + b"not a frame"
+        with lmdb_wrapper.LmdbWrapperBase(self.db_path, readonly=False) as db:
+            db["magic"] = value
+            self.assertEqual(db["magic"], value)
+            self.assertEqual(dict(db.raw_items()), {"magic": value})
+            db.enable_compression()
+            self.assertEqual(db["magic"], value)
+            db.disable_compression()
+            self.assertEqual(self.raw_values(db)[b"magic"], value)
+            self.assertEqual(db["magic"], value)
+            db["magic"] = value
+            self.assertEqual(db.getitem_batched(["magic"]), {"magic": value})
+
+    def test_compressed_record_store(self):
+        import pipe
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        import paper_tools.pipe_usage as pu
+        db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False,
+                                                 track_columns=True, track_indexes=True)
+        records = {str(i): make_sample_record(i, year=2000 + i % 20, refs=[str(i + 1)], citation_count=i,
+                                              abstract="ringdown {}".format(i)) for i in range(200)}
+        db.record.setitem_batched(records)
+        db.record.enable_compression(dict_size=4096, samples=200)
+        db.record["500"] = make_sample_record(500, year=2010, citation_count=1000, abstract="late ringdown",
+                                              texkeys=["Late:2010ab"])
+        self.assertEqual(db.record["7"], records["7"])
+        self.assertEqual(db.indexes.by_texkey(["Late:2010ab"]), {"Late:2010ab": "500"})
+        self.assertEqual(db.columns.abstracts(db.record, ["500", "3"]), {"500": "late ringdown", "3": "ringdown 3"})
+        top = list(db.query() | pu.filter_by_year(2010) | pu.filter_by_abstract("late") | pipe.take(1) | pu.get_id)
+        self.assertEqual(top, ["500"])
+        self.assertEqual(dict(db.record.reference_arrays())["5"].tolist(), [6])
+
+
+class TestLmdbSharedEnvironment(unittest.TestCase):
+    """Tests for stores and tables hosted as named databases of one environment."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.env = lmdb.open(os.path.join(self.tmpdir, "shared.lmdb"), map_size=2**26, max_dbs=8)
+
+    def tearDown(self):
+        self.env.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_stores_are_isolated(self):
+        a = lmdb_wrapper.LmdbWrapperBase(None, env=self.env, name="a")
+        b = lmdb_wrapper.LmdbWrapperBase(None, env=self.env, name="b")
+        a.setitem_batched({"x": b"1", "y": b"2"})
+        b["x"] = b"3"
+        self.assertEqual((len(a), len(b)), (2, 1))
+        self.assertEqual(dict(a.items()), {"x": b"1", "y": b"2"})
+        self.assertEqual(list(b.keys()), ["x"])
+        self.assertEqual(b.get("y", b"none"), b"none")
+        self.assertTrue(lmdb_wrapper.has_db(self.env, "a"))
+        self.assertFalse(lmdb_wrapper.has_db(self.env, "c"))
+        a.__exit__(None, None, None)  # does not close the shared environment
+        self.assertEqual(b["x"], b"3")
+
+    def test_shared_write_transaction(self):
+        a = lmdb_wrapper.LmdbWrapperBase(None, env=self.env, name="a")
+        b = lmdb_wrapper.LmdbWrapperBase(None, env=self.env, name="b")
+        with self.env.begin(write=True) as txn:
+            a.setitem_batched({"x": b"1"}, txn=txn)
+            b.setitem_batched({"x": b"2"}, txn=txn)
+        with self.assertRaises(RuntimeError):
+            with self.env.begin(write=True) as txn:
+                a.setitem_batched({"y": b"1"}, txn=txn)
+                b.setitem_batched({"y": b"2"}, txn=txn)
+                raise RuntimeError("abort")
+        self.assertEqual((list(a.keys()), list(b.keys())), (["x"], ["x"]))
+
+    def test_read_snapshot(self):
+        a = lmdb_wrapper.LmdbWrapperBase(None, env=self.env, name="a")
+        b = lmdb_wrapper.LmdbWrapperBase(None, env=self.env, name="b")
+        a["x"], b["x"] = b"1", b"1"
+        with self.env.begin() as txn:
+            with self.env.begin(write=True) as wtxn:
+                a.setitem_batched({"x": b"2"}, txn=wtxn)
+                b.setitem_batched({"x": b"2"}, txn=wtxn)
+            self.assertEqual((a.get("x", txn=txn), b.getitem_batched(["x"], txn=txn)), (b"1", {"x": b"1"}))
+            self.assertEqual(dict(b.items(txn=txn)), {"x": b"1"})
+        self.assertEqual((a["x"], b["x"]), (b"2", b"2"))
+
+    def test_compression_metadata_in_named_database(self):
+        values = {"k{}".format(i): "ringdown quasinormal mode {}".format(i).encode() for i in range(300)}
+        a = lmdb_wrapper.LmdbWrapperBase(None, env=self.env, name="a")
+        a.setitem_batched(values)
+        a.enable_compression(dict_size=0)
+        self.assertTrue(lmdb_wrapper.has_db(self.env, "a.meta"))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "shared.lmdb", lmdb_wrapper.METADATA_NAME)))
+        reopened = lmdb_wrapper.LmdbWrapperBase(None, env=self.env, name="a")
+        self.assertEqual(reopened.compression_info()['dict_id'], 0)
+        self.assertEqual(dict(reopened.items()), values)
+
+
 # ============================================================================
 # config tests
 # ============================================================================
@@ -616,6 +1335,7 @@ class TestInspireHEPToolsMocked(unittest.TestCase):
 
 
 import json
+import numpy as np
 
 
 class TestInspireHEPLmdbWrappers(unittest.TestCase):
@@ -657,6 +1377,1281 @@ class TestInspireHEPLmdbWrappers(unittest.TestCase):
         db.env.close()
 
 
+class TestInspireHEPImportCost(unittest.TestCase):
+    """Importing inspirehep_tools must not load the ML stack."""
+
+    HEAVY_MODULES = ["faiss", "FlagEmbedding", "torch", "transformers"]
+
+    def test_heavy_modules_not_imported(self):
+        import subprocess
+        src = os.path.join(os.path.dirname(__file__), '..', 'src')
+        code = (
+            "import sys, json\n"
+            "import paper_tools.inspirehep_tools\n"
+            "print(json.dumps([m for m in {!r} if m in sys.modules]))\n"
+        ).format(self.HEAVY_MODULES)
+        env = dict(os.environ, PYTHONPATH=src)
+        out = subprocess.run([sys.executable, "-c", code], env=env,
+                             capture_output=True, text=True, check=True)
+        self.assertEqual(json.loads(out.stdout), [])
+
+
+class FakeEncoderModel:
+    """Stand-in for a FlagEmbedding model: deterministic 8-dim vectors, records batch sizes."""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def encode_queries(self, queries):
+        import numpy as np
+        self.batch_sizes.append(len(queries))
+        return np.array([[len(q) + i for i in range(8)] for q in queries], dtype=np.float32)
+
+
+class TestEmbeddingServer(unittest.TestCase):
+    """Tests for model warm-up and the shared embedding server."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_batching_encoder_coalesces_concurrent_calls(self):
+        import threading
+        import paper_tools.embedding_server as embedding_server
+        model = FakeEncoderModel()
+        encoder = embedding_server.BatchingEncoder(model, batch_window_s=0.2)
+        results = {}
+
+        def worker(i):
+            results[i] = encoder.encode_queries(["x" * i, "y"])
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(1, 9)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        encoder.close()
+        self.assertEqual(sum(model.batch_sizes), 16)
+        self.assertLess(len(model.batch_sizes), 8)
+        for i in range(1, 9):
+            self.assertEqual(results[i].shape, (2, 8))
+            self.assertEqual(results[i][0, 0], i)
+            self.assertEqual(results[i][1, 0], 1)
+
+    def test_batching_encoder_propagates_errors(self):
+        import paper_tools.embedding_server as embedding_server
+
+        class BrokenModel:
+            def encode_queries(self, queries):
+                raise ValueError("broken")
+
+        encoder = embedding_server.BatchingEncoder(BrokenModel())
+        with self.assertRaises(ValueError):
+            encoder.encode_queries(["q"])
+        encoder.close()
+
+    def test_database_uses_shared_server_with_warmup(self):
+        import multiprocessing
+        import time
+        import paper_tools.embedding_server as embedding_server
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        address = os.path.join(self.tmpdir, "model.sock")
+        ctx = multiprocessing.get_context("fork")
+        server = ctx.Process(target=embedding_server.serve_embedding_model,
+                             args=(address,), kwargs={"model_factory": FakeEncoderModel},
+                             daemon=True)
+        server.start()
+        try:
+            for _ in range(100):
+                if os.path.exists(address):
+                    break
+                time.sleep(0.05)
+            db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, readonly=False,
+                                                     warmup_model=True, model_address=address)
+            db.warmup_thread.join()
+            self.assertIsNotNone(db.model)
+            embeddings = db.model.encode_queries(["abc"])
+            self.assertEqual(embeddings.shape, (1, 8))
+            self.assertEqual(embeddings[0, 0], 3)
+        finally:
+            server.terminate()
+            server.join()
+
+    def test_authkey_generated_for_unix_socket_only(self):
+        import stat
+        import paper_tools.embedding_server as embedding_server
+        address = os.path.join(self.tmpdir, "model.sock")
+        authkey = embedding_server._server_authkey(address)
+        self.assertEqual(len(authkey), 32)
+        self.assertEqual(stat.S_IMODE(os.stat(embedding_server.authkey_path(address)).st_mode), 0o600)
+        self.assertEqual(embedding_server._client_authkey(address), authkey)
+        self.assertNotEqual(embedding_server._server_authkey(address), authkey)
+        self.assertEqual(embedding_server._server_authkey(("0.0.0.0", 5000), b"secret"), b"secret")
+        with self.assertRaises(ValueError):
+            embedding_server.serve_embedding_model(("0.0.0.0", 5000), model_factory=FakeEncoderModel)
+        with self.assertRaises(ValueError):
+            embedding_server.connect_encoder(("127.0.0.1", 5000))
+
+
+def make_sample_record(rec_id, year=2020, refs=(), citation_count=0, authors=("A. Author",),
+                       title=None, abstract=None, document_type=("article",), texkeys=None,
+                       eprint=None):
+    """Build a minimal InspireHEP-shaped literature record."""
+    metadata = {
+        "titles": [{"title": title or "Paper {}".format(rec_id)}],
+        "authors": [{"full_name": a} for a in authors],
+        "citation_count": citation_count,
+        "document_type": list(document_type),
+        "texkeys": texkeys if texkeys is not None else ["Author:{}ab{}".format(year, rec_id)],
+        "references": [{"record": {"$ref": "https://inspirehep.net/api/literature/{}".format(r)}}
+                       for r in refs],
+    }
+    if abstract is not None:
+        metadata["abstracts"] = [{"value": abstract}]
+    if eprint is not None:
+        metadata["arxiv_eprints"] = [{"value": eprint}]
+    return {"id": str(rec_id), "created": "{}-06-01T00:00:00+00:00".format(year), "metadata": metadata}
+
+
+class LookupEncoderModel:
+    """Stand-in model mapping known query strings to fixed vectors."""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def encode_queries(self, queries):
+        import numpy as np
+        return np.array([self.vectors[q] for q in queries], dtype=np.float32)
+
+
+class TestSearchAbstractRecords(unittest.TestCase):
+    """Tests for array-backed ID mapping and batched hydration of search hits."""
+
+    def setUp(self):
+        import numpy as np
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False)
+        self.vectors = {}
+        for i in range(4):
+            rec_id = str(100 + i)
+            vec = np.zeros(8, dtype=np.float16)
+            vec[i] = 1.0
+            self.vectors["q{}".format(i)] = vec.astype(np.float32)
+            self.db.record[rec_id] = make_sample_record(rec_id, abstract="Abstract {}".format(i),
+                                                        authors=("X. One", "Y. Two"))
+            self.db.embedding[rec_id] = vec
+        self.db.model = LookupEncoderModel(self.vectors)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_embed_texts_batches_by_length(self):
+        import numpy as np
+        calls = []
+        class RecordingModel(LookupEncoderModel):
+            def encode_queries(self, queries):
+                calls.append(list(queries))
+                return super().encode_queries(queries)
+        vectors = {"x" * n: np.full(4, n, dtype=np.float32) for n in (5, 1, 4, 2, 3)}
+        self.db.model = RecordingModel(vectors)
+        embeddings = self.db.embed_texts(list(vectors), batch_size=2)
+        self.assertEqual(embeddings[:, 0].tolist(), [5, 1, 4, 2, 3])
+        self.assertEqual([[len(q) for q in call] for call in calls], [[1, 2], [3, 4], [5]])
+        self.assertEqual(self.db.embed_texts([]).shape[0], 0)
+
+    def test_search_abstract_ids(self):
+        D, ids = self.db.search_abstract(["q2", "q0"], k=1)
+        self.assertEqual(ids, [["102"], ["100"]])
+        self.assertAlmostEqual(float(D[0][0]), 1.0)
+
+    def test_search_abstract_more_than_indexed(self):
+        D, ids = self.db.search_abstract(["q1"], k=6)
+        self.assertEqual(ids[0][0], "101")
+        self.assertEqual(ids[0][4:], [None, None])
+
+    def test_search_abstract_records(self):
+        results = self.db.search_abstract_records(["q3", "q1"], k=2, fields=("title", "authors"))
+        self.assertEqual(len(results), 2)
+        top = results[0][0]
+        self.assertEqual(top["id"], "103")
+        self.assertEqual(top["title"], "Paper 103")
+        self.assertEqual(top["authors"], ["X. One", "Y. Two"])
+        self.assertNotIn("abstract", top)
+        self.assertEqual(results[1][0]["id"], "101")
+
+    def test_getitem_batched(self):
+        got = self.db.record.getitem_batched(["100", "missing", "101"],
+                                             project=lambda r: r["id"])
+        self.assertEqual(got, {"100": "100", "101": "101"})
+
+
+class TestLexicalSearch(unittest.TestCase):
+    """Tests for the BM25 index and hybrid ranking."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def make_index(self):
+        import paper_tools.lexical_index as lexical_index
+        return lexical_index.BM25Index(os.path.join(self.tmpdir, "lex.lmdb"),
+                                       map_size=2**26, readonly=False)
+
+    def test_bm25_ranking(self):
+        index = self.make_index()
+        index.add_documents({
+            "1": "Quasinormal modes of black holes",
+            "2": "Ringdown and quasinormal mode spectroscopy of quasinormal modes",
+            "3": "Dark matter direct detection",
+        })
+        self.assertEqual(len(index), 3)
+        hits = index.search("ringdown quasinormal", k=10)
+        self.assertEqual([h[0] for h in hits], ["2", "1"])
+        self.assertGreater(hits[0][1], hits[1][1])
+        self.assertEqual(index.search("nothing matches", k=5), [])
+
+    def test_bm25_matches_reference_scores(self):
+        import math
+        docs = {"a": "x y y z", "b": "x x", "c": "z"}
+        index = self.make_index()
+        index.add_documents(docs)
+        k1, b = 1.2, 0.75
+        avg = sum(len(d.split()) for d in docs.values()) / len(docs)
+        df = {"x": 2, "y": 1}
+        expected = {}
+        for doc_id, text in docs.items():
+            tokens = text.split()
+            score = 0.0
+            for term in ("x", "y"):
+                tf = tokens.count(term)
+                if tf:
+                    idf = math.log(1 + (3 - df[term] + 0.5) / (df[term] + 0.5))
+                    score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(tokens) / avg))
+            if score:
+                expected[doc_id] = score
+        got = dict(index.search("x y", k=10))
+        self.assertEqual(set(got), set(expected))
+        for doc_id in expected:
+            self.assertAlmostEqual(got[doc_id], expected[doc_id])
+
+    def test_bm25_incremental_update_and_remove(self):
+        index = self.make_index()
+        index.add_documents({"1": "inflation", "2": "axion dark matter"})
+        index.add_documents({"1": "axion inflation"})
+        self.assertEqual(len(index), 2)
+        self.assertEqual(set(h[0] for h in index.search("axion", k=5)), {"1", "2"})
+        index.remove_documents(["2", "unknown"])
+        self.assertEqual(len(index), 1)
+        self.assertNotIn("2", index)
+        self.assertEqual([h[0] for h in index.search("axion", k=5)], ["1"])
+
+    def test_reciprocal_rank_fusion(self):
+        import paper_tools.lexical_index as lexical_index
+        fused = lexical_index.reciprocal_rank_fusion([["a", "b", "c"], ["b", "d", None]])
+        self.assertEqual(fused[0][0], "b")
+        self.assertEqual(set(x[0] for x in fused), {"a", "b", "c", "d"})
+
+    def test_database_hybrid_search(self):
+        import numpy as np
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False)
+        abstracts = {"1": "axion dark matter", "2": "black hole ringdown", "3": "axion star"}
+        vectors = {}
+        for i, (rec_id, text) in enumerate(abstracts.items()):
+            db.record[rec_id] = make_sample_record(rec_id, abstract=text)
+            vec = np.zeros(4, dtype=np.float32)
+            vec[i] = 1.0
+            vectors[text] = vec
+        vectors["axion"] = np.array([0, 0, 1, 0], dtype=np.float32)
+        db.model = LookupEncoderModel(vectors)
+
+        db.update_embedding()
+        self.assertEqual(len(db.embedding), 3)
+        db.update_lexical_index()
+        self.assertEqual([h[0] for h in db.search_lexical("ringdown", k=3)], ["2"])
+
+        fused = db.search_hybrid(["axion"], k=2, candidates=3)[0]
+        self.assertEqual(fused[0][0], "3")
+        self.assertEqual(set(x[0] for x in fused), {"1", "3"})
+
+        # Incremental: a new record is embedded and appended to the live faiss index
+        db.record["4"] = make_sample_record("4", abstract="axion")
+        db.update_embedding(["4"])
+        db.update_lexical_index(["4"])
+        self.assertIn(db.search_abstract(["axion"], k=1)[1][0][0], ("3", "4"))
+        self.assertEqual(len(db.id_list), 4)
+        self.assertIn("4", [h[0] for h in db.search_lexical("axion", k=5)])
+
+
+class TestFilteredBatchSearch(unittest.TestCase):
+    """Tests for search_batch with per-query metadata filters."""
+
+    def setUp(self):
+        import numpy as np
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False)
+        rng = np.random.default_rng(0)
+        self.n = 40
+        for i in range(self.n):
+            rec_id = str(i)
+            self.db.record[rec_id] = make_sample_record(
+                rec_id, year=2000 + i % 10,
+                document_type=("article",) if i % 2 == 0 else ("conference paper",),
+                authors=("Siyang Ling",) if i % 5 == 0 else ("Other Person",))
+            vec = rng.normal(size=16).astype(np.float16)
+            self.db.embedding[rec_id] = vec
+        self.query_vec = rng.normal(size=16).astype(np.float32)
+        self.db.model = LookupEncoderModel({"q": self.query_vec, "r": -self.query_vec})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def expected(self, predicate, k, vec=None):
+        import numpy as np
+        vec = self.query_vec if vec is None else vec
+        scores = []
+        for i in range(self.n):
+            rec = self.db.record[str(i)]
+            if predicate(rec):
+                emb = self.db.embedding[str(i)].astype(np.float32)
+                scores.append((str(i), float(emb @ vec)))
+        scores.sort(key=lambda x: x[1], reverse=True)
+        return [x[0] for x in scores[:k]]
+
+    def test_unfiltered_matches_search_abstract(self):
+        results = self.db.search_batch(["q"], k=5)
+        D, ids = self.db.search_abstract(["q"], k=5)
+        self.assertEqual([x[0] for x in results[0]], ids[0])
+
+    def test_per_query_filters(self):
+        filters = [
+            {"year": 2003},
+            {"year": (2002, 2005), "document_type": "article"},
+            {"author": "ling"},
+            None,
+        ]
+        results = self.db.search_batch(["q", "q", "r", "q"], k=3, filters=filters)
+        self.assertEqual([x[0] for x in results[0]],
+                         self.expected(lambda r: r["created"].startswith("2003"), 3))
+        self.assertEqual([x[0] for x in results[1]],
+                         self.expected(lambda r: 2002 <= int(r["created"][:4]) <= 2005
+                                       and "article" in r["metadata"]["document_type"], 3))
+        self.assertEqual([x[0] for x in results[2]],
+                         self.expected(lambda r: r["metadata"]["authors"][0]["full_name"] == "Siyang Ling",
+                                       3, vec=-self.query_vec))
+        self.assertEqual(len(results[3]), 3)
+
+    def test_faiss_selector_path(self):
+        self.db.BRUTE_FORCE_ROWS = 0
+        results = self.db.search_batch(["q"], k=4, filters={"document_type": "conference paper"})
+        self.assertEqual([x[0] for x in results[0]],
+                         self.expected(lambda r: "conference paper" in r["metadata"]["document_type"], 4))
+
+    def test_empty_and_id_filters(self):
+        results = self.db.search_batch(["q", "q"], k=3,
+                                       filters=[{"document_type": "thesis"}, {"ids": ["7", "8"]}])
+        self.assertEqual(results[0], [])
+        self.assertEqual(set(x[0] for x in results[1]), {"7", "8"})
+
+    def test_numpy_year_filter(self):
+        # years taken from a NumPy array, e.g. the column store's year column
+        expected = self.db.filter_mask({"year": 2003}).tolist()
+        self.assertEqual(self.db.filter_mask({"year": np.int64(2003)}).tolist(), expected)
+        self.assertEqual(self.db.filter_mask({"year": np.int32(2003)}).tolist(), expected)
+        self.assertTrue(any(expected))
+
+    def test_author_filter_without_column_store(self):
+        import paper_tools.column_store as column_store
+        expected = self.db.filter_mask({"author": "LING"})
+        self.assertEqual(int(expected.sum()), 8)
+        self.assertIsInstance(self.db.row_metadata['authors'], column_store.TextColumn)
+        self.db.row_metadata = None
+        self.db.columns = None
+        with patch.object(self.db, 'open_column_store', return_value=None):
+            self.assertEqual(self.db.filter_mask({"author": "LING"}).tolist(), expected.tolist())
+            self.assertEqual(int(self.db.filter_mask({"author": "ling\nx"}).sum()), 0)
+
+
+# ============================================================================
+# analytic tests
+# ============================================================================
+
+def make_sample_collection(n=30, seed=1, max_refs=4):
+    """Random citation collection {id: record}; references may point outside the collection."""
+    import random
+    rng = random.Random(seed)
+    collection = {}
+    for i in range(n):
+        refs = rng.sample(range(n + 5), rng.randint(0, max_refs))
+        collection[str(i)] = make_sample_record(i, refs=refs)
+    return collection
+
+
+class TestCitationPageRank(unittest.TestCase):
+    """Tests for the CSR citation graph and power-iteration PageRank."""
+
+    def test_compact_graph(self):
+        import paper_tools.analytic as analytic
+        graph = analytic.CitationGraph.from_adjacency({"a": ["b", "c", "b", "zz"], "b": ["c"], "c": []})
+        self.assertEqual(len(graph), 3)
+        self.assertEqual(graph.num_edges, 3)
+        self.assertEqual(graph.out_degree().tolist(), [2, 1, 0])
+        self.assertEqual(graph.in_degree().tolist(), [0, 1, 2])
+        self.assertEqual(graph.symmetrized().num_edges, 6)
+
+    def test_pagerank_matches_networkx(self):
+        import networkx as nx
+        import paper_tools.analytic as analytic
+        collection = make_sample_collection()
+        analytics = analytic.InspireHEPAnalytics(collection, graph_mode="symmetric")
+        result = analytics.compute_pagerank(tol=1e-10, max_iter=500)
+
+        G = nx.DiGraph()
+        G.add_nodes_from(collection)
+        for lit_id, refs in analytics.make_citation_graph().items():
+            for cite_id in refs:
+                if cite_id in collection:
+                    G.add_edge(lit_id, cite_id)
+                    G.add_edge(cite_id, lit_id)
+        expected = nx.pagerank(G, alpha=0.85, tol=1e-10, max_iter=500)
+        self.assertEqual(set(result), set(expected))
+        for key in expected:
+            self.assertAlmostEqual(result[key], expected[key], places=8)
+        self.assertAlmostEqual(sum(result.values()), 1.0)
+
+    def test_pagerank_warm_start(self):
+        import paper_tools.analytic as analytic
+        collection = make_sample_collection()
+        graph = analytic.CitationGraph.from_adjacency(
+            analytic.InspireHEPAnalytics(collection).make_citation_graph())
+        cold = analytic.pagerank(graph.adjacency, tol=1e-10, max_iter=500)
+        warm = analytic.pagerank(graph.adjacency, tol=1e-10, max_iter=2, x0=cold)
+        self.assertTrue(np.allclose(cold, warm, atol=1e-9))
+        with self.assertRaises(RuntimeError):
+            analytic.pagerank(graph.adjacency, tol=1e-14, max_iter=2)
+
+        analytics = analytic.InspireHEPAnalytics(collection)
+        first = analytics.compute_pagerank(tol=1e-10, max_iter=500)
+        again = analytics.compute_pagerank(tol=1e-10, max_iter=3, warm_start=True)
+        for key in first:
+            self.assertAlmostEqual(first[key], again[key], places=8)
+
+    def test_citation_graph_skips_unparsed_refs(self):
+        import paper_tools.analytic as analytic
+        references = [{'record': {'$ref': 'https://inspirehep.net/api/literature/2'}},
+                      {'record': {'$ref': 'https://inspirehep.net/api/literature/draft'}}, {'reference': {}}]
+        collection = {'1': {'metadata': {'references': references}}, '2': {'metadata': {}}}
+        self.assertEqual(analytic.InspireHEPAnalytics(collection).make_citation_graph(), {'1': ['2'], '2': []})
+
+
+class TestCitationGraphModes(unittest.TestCase):
+    """Tests for directed / reverse / symmetric PageRank and dangling-node weights."""
+
+    def networkx_graph(self, analytics, collection, reverse=False):
+        import networkx as nx
+        G = nx.DiGraph()
+        G.add_nodes_from(collection)
+        for lit_id, refs in analytics.make_citation_graph().items():
+            for cite_id in refs:
+                if cite_id in collection:
+                    G.add_edge(*((cite_id, lit_id) if reverse else (lit_id, cite_id)))
+        return G
+
+    def assert_close(self, result, expected):
+        self.assertEqual(set(result), set(expected))
+        for key in expected:
+            self.assertAlmostEqual(result[key], expected[key], places=8)
+
+    def test_directed_is_default_and_matches_networkx(self):
+        import networkx as nx
+        import paper_tools.analytic as analytic
+        collection = make_sample_collection(seed=3)
+        analytics = analytic.InspireHEPAnalytics(collection)
+        self.assertEqual(analytics.graph_mode, "directed")
+        symmetric_edges = analytics.make_compact_graph("symmetric").num_edges
+        self.assertLess(analytics.make_compact_graph().num_edges, symmetric_edges)
+        result = analytics.compute_pagerank(tol=1e-10, max_iter=500)
+        expected = nx.pagerank(self.networkx_graph(analytics, collection), tol=1e-10, max_iter=500)
+        self.assert_close(result, expected)
+
+    def test_reverse_mode(self):
+        import networkx as nx
+        import paper_tools.analytic as analytic
+        collection = make_sample_collection(seed=4)
+        analytics = analytic.InspireHEPAnalytics(collection, graph_mode="reverse")
+        result = analytics.compute_pagerank(tol=1e-10, max_iter=500)
+        expected = nx.pagerank(self.networkx_graph(analytics, collection, reverse=True),
+                               tol=1e-10, max_iter=500)
+        self.assert_close(result, expected)
+
+    def test_dangling_weights(self):
+        import networkx as nx
+        import paper_tools.analytic as analytic
+        collection = make_sample_collection(seed=5)
+        analytics = analytic.InspireHEPAnalytics(collection)
+        dangling = {"0": 1.0, "1": 3.0}
+        result = analytics.compute_pagerank(tol=1e-10, max_iter=500, dangling=dangling)
+        G = self.networkx_graph(analytics, collection)
+        full_dangling = {n: dangling.get(n, 0.0) for n in G}
+        expected = nx.pagerank(G, tol=1e-10, max_iter=500, dangling=full_dangling)
+        self.assert_close(result, expected)
+
+    def test_invalid_mode(self):
+        import paper_tools.analytic as analytic
+        with self.assertRaises(ValueError):
+            analytic.InspireHEPAnalytics({}, graph_mode="sideways")
+
+
+class TestPersonalizedPageRank(unittest.TestCase):
+    """Tests for push-based personalized PageRank and recommendations."""
+
+    def setUp(self):
+        import paper_tools.analytic as analytic
+        self.collection = make_sample_collection(n=60, seed=11)
+        self.analytics = analytic.InspireHEPAnalytics(self.collection)
+
+    def test_push_matches_networkx(self):
+        import networkx as nx
+        graph = self.analytics.get_graph("symmetric")
+        G = nx.DiGraph()
+        G.add_nodes_from(graph.ids.tolist())
+        rows, cols = graph.adjacency.nonzero()
+        G.add_edges_from(zip(graph.ids[rows].tolist(), graph.ids[cols].tolist()))
+        seeds = {"3": 1.0, "10": 2.0}
+        expected = nx.pagerank(G, personalization=seeds, tol=1e-12, max_iter=1000)
+        result = self.analytics.personalized_pagerank(seeds, epsilon=1e-9, graph_mode="symmetric")
+        for key, value in expected.items():
+            self.assertAlmostEqual(result.get(key, 0.0), value, places=5)
+
+    def test_push_matches_power_iteration_directed(self):
+        import paper_tools.analytic as analytic
+        graph = self.analytics.get_graph()
+        seeds = [graph.index_of["0"], graph.index_of["5"]]
+        personalization = np.zeros(len(graph))
+        personalization[seeds] = 1.0
+        exact = analytic.pagerank(graph.adjacency, tol=1e-13, max_iter=1000,
+                                  personalization=personalization)
+        approx = analytic.personalized_pagerank_push(graph.adjacency, seeds, epsilon=1e-10)
+        self.assertTrue(np.allclose(exact, approx, atol=1e-6))
+
+    def test_recommend(self):
+        seeds = ["1", "2"]
+        recs = self.analytics.recommend(seeds, top_n=5)
+        self.assertLessEqual(len(recs), 5)
+        self.assertTrue(all(rec_id not in seeds for rec_id, _ in recs))
+        scores = [score for _, score in recs]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        # The cached graph is reused across queries
+        graph = self.analytics.get_graph("symmetric")
+        self.analytics.recommend(["4"], top_n=3)
+        self.assertIs(self.analytics.get_graph("symmetric"), graph)
+
+    def test_unknown_seeds(self):
+        with self.assertRaises(ValueError):
+            self.analytics.recommend(["not-a-paper"])
+
+
+class TestSimilarityIndex(unittest.TestCase):
+    """Tests for co-citation and bibliographic-coupling neighbors."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def brute_force(self, graph, kind, normalize=True):
+        A = graph.adjacency.toarray()
+        M = A.T @ A if kind == "cocitation" else A @ A.T
+        degree = A.sum(axis=0) if kind == "cocitation" else A.sum(axis=1)
+        result = {}
+        for i, rec_id in enumerate(graph.ids.tolist()):
+            row = {}
+            for j in np.flatnonzero(M[i]):
+                if j != i:
+                    value = M[i, j] / np.sqrt(degree[i] * degree[j]) if normalize else M[i, j]
+                    row[graph.ids[j]] = value
+            result[rec_id] = row
+        return result
+
+    def assert_matches(self, index, graph, kind):
+        expected = self.brute_force(graph, kind)
+        for rec_id in graph.ids.tolist():
+            got = dict(index.neighbors_of(rec_id))
+            self.assertEqual(set(got), set(expected[rec_id]))
+            for other, value in expected[rec_id].items():
+                self.assertAlmostEqual(got[other], value, places=5)
+
+    def test_build_matches_dense_products(self):
+        import paper_tools.analytic as analytic
+        graph = analytic.InspireHEPAnalytics(make_sample_collection(n=40, seed=2)).get_graph()
+        for kind in analytic.SimilarityIndex.KINDS:
+            index = analytic.SimilarityIndex(kind, k=100, block_size=7).build(graph)
+            self.assert_matches(index, graph, kind)
+
+    def test_top_k_truncation(self):
+        import paper_tools.analytic as analytic
+        graph = analytic.InspireHEPAnalytics(make_sample_collection(n=40, seed=2, max_refs=8)).get_graph()
+        index = analytic.SimilarityIndex("coupling", k=3).build(graph)
+        expected = self.brute_force(graph, "coupling")
+        for rec_id in graph.ids.tolist():
+            got = [score for _, score in index.neighbors_of(rec_id)]
+            best = sorted(expected[rec_id].values(), reverse=True)[:3]
+            self.assertTrue(np.allclose(got, best, atol=1e-6))
+
+    def test_incremental_update_matches_rebuild(self):
+        import paper_tools.analytic as analytic
+        collection = make_sample_collection(n=40, seed=9)
+        for kind in analytic.SimilarityIndex.KINDS:
+            cache = os.path.join(self.tmpdir, kind + ".npz")
+            analytic.InspireHEPAnalytics(dict(collection)).similarity(kind, k=100, cache_path=cache)
+
+            grown = dict(collection)
+            grown["41"] = make_sample_record(41, refs=[1, 2, 3])
+            grown["5"] = make_sample_record(5, refs=[7, 8])
+            del grown["6"]
+            analytics = analytic.InspireHEPAnalytics(grown)
+            updated = analytics.similarity(kind, k=100, cache_path=cache)
+            graph = analytics.get_graph("directed")
+            self.assert_matches(updated, graph, kind)
+            reloaded = analytic.SimilarityIndex.load(cache)
+            self.assertEqual(reloaded.neighbors_of("41"), updated.neighbors_of("41"))
+
+    def test_invalid_kind(self):
+        import paper_tools.analytic as analytic
+        with self.assertRaises(ValueError):
+            analytic.SimilarityIndex("cocoupling")
+
+
+class TestBulkGraphAnalytics(unittest.TestCase):
+    """Tests for HITS, k-core, components and the one-pass report."""
+
+    def setUp(self):
+        import paper_tools.analytic as analytic
+        self.collection = make_sample_collection(n=80, seed=21, max_refs=6)
+        self.analytics = analytic.InspireHEPAnalytics(self.collection)
+        self.graph = self.analytics.get_graph()
+        self.G = self.nx_graph()
+
+    def nx_graph(self):
+        import networkx as nx
+        G = nx.DiGraph()
+        G.add_nodes_from(self.graph.ids.tolist())
+        rows, cols = self.graph.adjacency.nonzero()
+        G.add_edges_from(zip(self.graph.ids[rows].tolist(), self.graph.ids[cols].tolist()))
+        return G
+
+    def test_hits_matches_networkx(self):
+        import networkx as nx
+        hubs, authorities = self.analytics.compute_hits(tol=1e-12, max_iter=10000)
+        nx_hubs, nx_authorities = nx.hits(self.G, tol=1e-12, max_iter=10000)
+        for key in nx_hubs:
+            self.assertAlmostEqual(hubs[key], nx_hubs[key], places=5)
+            self.assertAlmostEqual(authorities[key], nx_authorities[key], places=5)
+
+    def test_core_number_matches_networkx(self):
+        import networkx as nx
+        undirected = self.G.to_undirected()
+        undirected.remove_edges_from(list(nx.selfloop_edges(undirected)))
+        self.assertEqual(self.analytics.compute_core_number(), nx.core_number(undirected))
+
+    def test_components_match_networkx(self):
+        import networkx as nx
+        labels = self.analytics.compute_components()
+        for component in nx.weakly_connected_components(self.G):
+            self.assertEqual(len(set(labels[n] for n in component)), 1)
+        self.assertEqual(len(set(labels.values())),
+                         nx.number_weakly_connected_components(self.G))
+
+    def test_report_serial_and_pool_agree(self):
+        serial = self.analytics.report(pagerank_options={"tol": 1e-10, "max_iter": 500})
+        pooled = self.analytics.report(processes=2, pagerank_options={"tol": 1e-10, "max_iter": 500})
+        self.assertEqual(serial["num_nodes"], len(self.collection))
+        self.assertEqual(serial["num_edges"], self.G.number_of_edges())
+        self.assertEqual(sum(serial["component_sizes"]), len(self.collection))
+        in_degrees = [d for _, d in self.G.in_degree()]
+        self.assertEqual(serial["in_degree_distribution"],
+                         np.bincount(in_degrees).tolist())
+        for key in ("core_number", "component", "in_degree_distribution",
+                    "out_degree_distribution", "component_sizes"):
+            self.assertEqual(serial[key], pooled[key])
+        for rec_id in self.collection:
+            self.assertAlmostEqual(serial["pagerank"][rec_id], pooled["pagerank"][rec_id])
+            self.assertAlmostEqual(serial["hubs"][rec_id], pooled["hubs"][rec_id])
+
+
+class TestCitationIndex(unittest.TestCase):
+    """Tests for the persisted, incrementally maintained citation index."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_index_follows_record_writes(self):
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False,
+                                                 track_citations=True)
+        db.record["1"] = make_sample_record(1, refs=[2, 3, 3])
+        db.record.setitem_batched({"2": make_sample_record(2, refs=[3]),
+                                   "3": make_sample_record(3)})
+        index = db.citation
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.references("1"), ["2", "3"])
+        self.assertEqual(sorted(index.citations("3")), ["1", "2"])
+        self.assertEqual(index.citations("1"), [])
+
+        # Overwriting a record replaces its edges
+        db.record["1"] = make_sample_record(1, refs=[2])
+        self.assertEqual(index.citations("3"), ["2"])
+        self.assertEqual(index.citations("2"), ["1"])
+
+        index.remove(["2"])
+        self.assertNotIn("2", index)
+        self.assertEqual(index.citations("3"), [])
+
+    def test_index_built_for_existing_records(self):
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False)
+        collection = make_sample_collection(seed=7)
+        db.record.setitem_batched(collection)
+        self.assertIsNone(db.citation)
+        index = db.open_citation_index()
+        self.assertEqual(len(index), len(collection))
+        for rec_id, record in collection.items():
+            self.assertEqual(index.references(rec_id),
+                             list(dict.fromkeys(inspirehep_tools.reference_ids(record))))
+
+    def test_tracking_is_opt_in(self):
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False)
+        db.record["1"] = make_sample_record(1, refs=[2])
+        self.assertEqual((db.citation, db.columns, db.indexes), (None, None, None))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["bibtex.lmdb", "embedding.lmdb", "record.lmdb"])
+        db.open_citation_index()
+        db.close()
+        # an existing derived store is kept up to date without asking again
+        db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False)
+        db.record["2"] = make_sample_record(2, refs=[1])
+        self.assertEqual(db.citation.references("2"), ["1"])
+        self.assertIsNone(db.columns)
+        db.close()
+
+    def test_analytics_on_citation_index(self):
+        import paper_tools.analytic as analytic
+        import paper_tools.citation_index as citation_index
+        collection = make_sample_collection(seed=8)
+        index = citation_index.CitationIndex(os.path.join(self.tmpdir, "cit.lmdb"),
+                                             map_size=2**26, readonly=False)
+        index.update(collection)
+        from_records = analytic.InspireHEPAnalytics(collection).compute_pagerank(tol=1e-10, max_iter=500)
+        from_index = analytic.InspireHEPAnalytics(index).compute_pagerank(tol=1e-10, max_iter=500)
+        self.assertEqual(set(from_records), set(from_index))
+        for key in from_records:
+            self.assertAlmostEqual(from_records[key], from_index[key], places=10)
+
+    @patch('paper_tools.inspirehep_tools.InspireHEPClient.get_literature_batched')
+    def test_bfs_reads_references_from_index(self, mock_batched):
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        import paper_tools.citation_index as citation_index
+        index = citation_index.CitationIndex(os.path.join(self.tmpdir, "cit.lmdb"),
+                                             map_size=2**26, readonly=False)
+        root = make_sample_record(1, refs=[2])
+        index.update({"1": root})
+        mock_batched.side_effect = lambda ids: {i: make_sample_record(i) for i in ids}
+        class NoReads(dict):
+            def __getitem__(self, key):
+                raise AssertionError("record {} decoded".format(key))
+
+        collection = NoReads({"1": None})
+        with patch('sys.stdout'):
+            inspirehep_tools.inspirehep_bfs_literature_batch(collection, ["1"], max_size=5,
+                                                             citations=index)
+        self.assertIn("2", collection)
+
+
+class TestStreamingAnalytics(unittest.TestCase):
+    """Tests for analytics read straight from an LMDB record store."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_packed_reference_ids_matches_full_decode(self):
+        import msgpack
+        import paper_tools.citation_index as citation_index
+        records = list(make_sample_collection(seed=9).values())
+        no_refs = make_sample_record(100)
+        del no_refs["metadata"]["references"]
+        null_refs = make_sample_record(101)
+        null_refs["metadata"]["references"] = None
+        unlinked = make_sample_record(102, refs=[5])
+        unlinked["metadata"]["references"].insert(0, {"reference": {"title": {"title": "x"}}})
+        records += [no_refs, null_refs, unlinked, {"metadata": {}}]
+        for record in records:
+            self.assertEqual(citation_index.packed_reference_ids(msgpack.packb(record)),
+                             [int(i) for i in citation_index.extract_reference_ids(record)])
+
+    def test_analytics_on_record_store_skips_full_decode(self):
+        import paper_tools.analytic as analytic
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        collection = make_sample_collection(seed=10)
+        store = inspirehep_tools.InspireHEPRecordLmdbWrapper(self.tmpdir, map_size=2**26, readonly=False)
+        store.setitem_batched(collection)
+        expected = analytic.InspireHEPAnalytics(collection).compute_pagerank(tol=1e-10, max_iter=500)
+        with patch.object(inspirehep_tools.InspireHEPRecordLmdbWrapper, 'unpack_value',
+                          side_effect=AssertionError("full record decoded")):
+            scores = analytic.InspireHEPAnalytics(store).compute_pagerank(tol=1e-10, max_iter=500)
+        self.assertEqual(set(scores), set(expected))
+        for key in expected:
+            self.assertAlmostEqual(scores[key], expected[key], places=10)
+
+
+class TestColumnStore(unittest.TestCase):
+    """Tests for the columnar metadata side-store."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def make_records(self):
+        records = {
+            "1": make_sample_record(1, year=2012, citation_count=30, authors=("Einstein, A.", "Bohr, N."),
+                                    title="Dark matter halos", abstract="Ringdown of résumé modes."),
+            "2": make_sample_record(2, year=2020, citation_count=5, authors=("Ling, W.",),
+                                    title="Axion dark matter", abstract="Axions.",
+                                    document_type=("article", "review")),
+            "3": make_sample_record(3, year=2020, citation_count=50, authors=("Einstein, B.",),
+                                    document_type=("conference paper",)),
+        }
+        records["3"]["metadata"]["authors"][0]["affiliations"] = [{"value": "IAS"}]
+        return records
+
+    def test_packed_row_matches_record(self):
+        import msgpack
+        import paper_tools.column_store as column_store
+        for record in self.make_records().values():
+            packed = msgpack.packb(record)
+            created, count, types, titles, authors, offset, length = column_store.packed_row(packed)
+            metadata = record["metadata"]
+            self.assertEqual(count, metadata["citation_count"])
+            self.assertEqual(types, metadata["document_type"])
+            self.assertEqual(titles, [t["title"] for t in metadata["titles"]])
+            self.assertEqual(authors, [a["full_name"] for a in metadata["authors"]])
+            if "abstracts" in metadata:
+                self.assertEqual(packed[offset:offset + length].decode(), metadata["abstracts"][0]["value"])
+            else:
+                self.assertEqual(offset, -1)
+        self.assertEqual(column_store.packed_row(msgpack.packb({"metadata": {}}))[0], column_store.NO_DATE)
+
+    def test_document_type_limit(self):
+        import paper_tools.column_store as column_store
+        def rows(count):
+            return [[column_store.NO_DATE, 0, ["type {:02d}".format(i)], [], [], -1, 0] for i in range(count)]
+        full = column_store.RecordColumns([str(i) for i in range(64)], rows(64))
+        self.assertEqual(full.document_type_mask("type 63").tolist(), [False] * 63 + [True])
+        with self.assertRaisesRegex(ValueError, "65 document types"):
+            column_store.RecordColumns([str(i) for i in range(65)], rows(65))
+
+    def test_update_from_dicts_matches_stored_bytes(self):
+        import paper_tools.column_store as column_store
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False)
+        records = self.make_records()
+        db.record.setitem_batched(records)
+        store = column_store.ColumnStore(os.path.join(self.tmpdir, "columns.lmdb"), map_size=2**26, readonly=False)
+        # Stored records have authors packed after the abstract: plain msgpack offsets would be wrong
+        store.update(records)
+        self.assertEqual(store.abstracts(db.record, ["1", "2"]), {})
+        store.update(records, pack_value=db.record.pack_value)
+        self.assertEqual(store.abstracts(db.record, ["1", "2", "3"]),
+                         {"1": "Ringdown of résumé modes.", "2": "Axions."})
+        store.rebuild(db.record)
+        self.assertEqual(store.abstracts(db.record, ["2"]), {"2": "Axions."})
+        store.rebuild(records)
+        self.assertEqual(store.abstracts(db.record, ["2"]), {})
+        self.assertEqual(sorted(store.columns().ids.tolist()), ["1", "2", "3"])
+
+    def test_columns_follow_record_writes(self):
+        import datetime
+        import pipe
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        import paper_tools.pipe_usage as pipe_usage
+        db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False,
+                                                 track_columns=True)
+        records = self.make_records()
+        db.record.setitem_batched(records)
+        table = db.columns.columns()
+        self.assertEqual(sorted(table.ids.tolist()), ["1", "2", "3"])
+
+        def ids(mask):
+            return set(table.ids[mask].tolist())
+        self.assertEqual(ids(table.year_mask(2020)),
+                         set(db.record.items() | pipe_usage.filter_by_year(2020) | pipe_usage.get_id))
+        self.assertEqual(ids(table.author_mask("einstein")),
+                         set(db.record.items() | pipe_usage.filter_by_author("einstein") | pipe_usage.get_id))
+        self.assertEqual(ids(table.title_mask("DARK")), {"1", "2"})
+        self.assertEqual(ids(table.document_type_mask("review")), {"2"})
+        self.assertEqual(ids(table.created_mask(after=datetime.datetime(2015, 1, 1))), {"2", "3"})
+        self.assertEqual(table.ids[table.top_by_citations()].tolist(),
+                         list(db.record.items() | pipe_usage.sort_by_citations() | pipe_usage.get_id))
+        self.assertEqual(table.ids[table.top_by_citations(table.year_mask(2020), n=1)].tolist(), ["3"])
+        self.assertEqual(db.columns.abstracts(db.record, ["1", "3"]), {"1": "Ringdown of résumé modes."})
+
+        # Cached until the next write
+        self.assertIs(db.columns.columns(), table)
+        db.record["4"] = make_sample_record(4, year=2021, authors=("Einstein, C.",))
+        table = db.columns.columns()
+        self.assertIn("4", table.ids.tolist())
+        self.assertTrue(table.author_mask("einstein, c")[table.row_of_id["4"]])
+
+    def test_store_built_for_existing_records(self):
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False)
+        db.record.setitem_batched(self.make_records())
+        self.assertIsNone(db.columns)
+        store = db.open_column_store()
+        self.assertEqual(len(store), 3)
+        table = store.columns()
+        self.assertEqual(table.citation_count[table.row_of_id["3"]], 50)
+        self.assertEqual(table.year[table.row_of_id["1"]], 2012)
+
+
+class TestRecordQuery(unittest.TestCase):
+    """Tests for lazy query plans behind the pipe_usage operators."""
+
+    def setUp(self):
+        import random
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        self.tmpdir = tempfile.mkdtemp()
+        rng = random.Random(3)
+        words = ["ringdown", "quasinormal mode", "axion", "inflation", "lattice"]
+        self.records = {
+            str(i): make_sample_record(i, year=rng.randint(2010, 2022), citation_count=rng.randint(0, 20),
+                                       authors=(rng.choice(["Einstein, A.", "Bohr, N.", "Ling, W."]),),
+                                       title="On {}".format(rng.choice(words)),
+                                       abstract="We study {} and {}.".format(rng.choice(words), rng.choice(words)),
+                                       document_type=(rng.choice(["article", "review"]),))
+            for i in range(60)
+        }
+        self.db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False,
+                                                      track_columns=True)
+        self.db.record.setitem_batched(self.records)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def chains(self):
+        import pipe
+        import paper_tools.pipe_usage as pu
+        return [
+            lambda src: src | pu.filter_by_abstract('quasinormal mode') | pu.filter_by_abstract('ringdown')
+                            | pu.sort_by_citations() | pipe.take(5),
+            lambda src: src | pu.filter_before(2020, 1, 1) | pu.filter_after(2015, 1, 1),
+            lambda src: src | pu.filter_by_author("einstein") | pu.filter_by_year(2016) | pu.sort_by_citations(False),
+            lambda src: src | pu.sort_by_citations() | pu.filter_by_type("review")
+                            | pu.filter_by_citations(minimum=5, maximum=15) | pipe.take(7),
+            lambda src: src | pu.filter_by_title("AXION") | pu.sort_by_citations() | pu.extract_fields(["citation_count"]),
+        ]
+
+    def test_query_matches_streaming_pipes(self):
+        import paper_tools.record_query as record_query
+        for chain in self.chains():
+            expected = list(chain(self.db.record.items()))
+            self.assertEqual(list(chain(self.db.query())), expected)
+            self.assertEqual(list(chain(record_query.RecordQuery(self.records))),
+                             list(chain(iter(self.records.items()))))
+
+    def test_plan_pushes_column_predicates_first(self):
+        import paper_tools.pipe_usage as pu
+        query = self.db.query() | pu.filter_by_abstract("axion") | pu.filter_by_year(2015) | pu.filter_by_type("article")
+        self.assertEqual([p.name for p in query.plan()],
+                         ["year == 2015", "document_type == 'article'", "abstract ~ 'axion'"])
+
+    def test_sorted_take_decodes_only_k_records(self):
+        import pipe
+        import paper_tools.pipe_usage as pu
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        query = self.db.query() | pu.filter_by_abstract("axion") | pu.sort_by_citations()
+        unpack = inspirehep_tools.InspireHEPRecordLmdbWrapper.unpack_value
+        with patch.object(inspirehep_tools.InspireHEPRecordLmdbWrapper, 'unpack_value',
+                          autospec=True, side_effect=unpack) as mock_unpack:
+            top = list(query | pipe.take(3))
+        self.assertEqual(len(top), 3)
+        self.assertEqual(mock_unpack.call_count, 3)
+
+
+class TestLazyRecords(unittest.TestCase):
+    """Tests for partial decoding of packed records."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_lazy_record(self):
+        import msgpack
+        import paper_tools.column_store as column_store
+        record = make_sample_record(1, refs=["2", "3"], abstract="An abstract")
+        lazy = column_store.LazyRecord(msgpack.packb(record))
+        self.assertEqual(lazy['metadata']['titles'], record['metadata']['titles'])
+        self.assertIsInstance(lazy['metadata'], column_store.LazyRecord)
+        self.assertIs(lazy['metadata'], lazy['metadata'])
+        self.assertIn('created', lazy)
+        self.assertNotIn('missing', lazy)
+        self.assertEqual(lazy.get('missing', 'default'), 'default')
+        with self.assertRaises(KeyError):
+            lazy['metadata']['missing']
+        self.assertEqual(set(lazy), set(record))
+        self.assertEqual(len(lazy['metadata']), len(record['metadata']))
+        self.assertEqual(lazy, record)
+        self.assertEqual(lazy.decode(), record)
+
+    def test_record_store_packs_cold_fields_last(self):
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        db = inspirehep_tools.InspireHEPRecordLmdbWrapper(os.path.join(self.tmpdir, "record.lmdb"), map_size=2**24,
+                                                          readonly=False)
+        record = make_sample_record(1, refs=["2"], abstract="An abstract")
+        db["1"] = record
+        self.assertEqual(list(db["1"]["metadata"])[-2:], list(inspirehep_tools.COLD_FIELDS))
+        self.assertEqual(db["1"], record)
+        self.assertEqual(list(record["metadata"])[1], "authors")  # the written record is not modified
+        lazy = dict(db.items(lazy=True))["1"]
+        self.assertEqual(lazy["metadata"]["abstracts"][0]["value"], "An abstract")
+        projected = db.getitem_batched(["1", "9"], project=lambda r: inspirehep_tools.project_record(r, ("title", "authors")),
+                                       lazy=True)
+        self.assertEqual(projected, {"1": {"title": "Paper 1", "authors": ["A. Author"]}})
+        db.env.close()
+
+    def test_packed_fields_stops_early(self):
+        import msgpack
+        import paper_tools.column_store as column_store
+        record = make_sample_record(1, refs=["2"])
+        reordered = {"metadata": record["metadata"], "created": record["created"]}
+        packed = msgpack.packb(reordered)
+        self.assertEqual(column_store.packed_fields(packed, ("created",), ("titles",)),
+                         {"created": record["created"], "metadata": {"titles": record["metadata"]["titles"]}})
+        # Bytes after the last requested field are never read (0xc1 is invalid msgpack)
+        packed = msgpack.packb({"metadata": {"titles": record["metadata"]["titles"], "references": 0}})[:-1] + b"\xc1"
+        self.assertEqual(column_store.packed_fields(packed, (), ("titles",)),
+                         {"metadata": {"titles": record["metadata"]["titles"]}})
+        metadata = msgpack.packb({"titles": record["metadata"]["titles"], "references": 0})[:-1] + b"\xc1"
+        self.assertEqual(column_store.LazyRecord(metadata)["titles"], record["metadata"]["titles"])
+
+    def test_streaming_query_decodes_matches(self):
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        import paper_tools.record_query as record_query
+        db = inspirehep_tools.InspireHEPRecordLmdbWrapper(os.path.join(self.tmpdir, "record.lmdb"), map_size=2**24,
+                                                          readonly=False)
+        db.setitem_batched({str(i): make_sample_record(i, year=2000 + i % 3, citation_count=i) for i in range(12)})
+        query = record_query.RecordQuery(db).filter_by_year(2001).where(lambda r: r['metadata']['citation_count'] > 3)
+        results = list(query.sort_by_citations())
+        self.assertEqual([rec_id for rec_id, _ in results], ["10", "7", "4"])
+        self.assertTrue(all(type(record) is dict for _, record in results))
+        db.env.close()
+
+
+class TestRecordIndex(unittest.TestCase):
+    """Tests for the date / author / texkey / arXiv ID secondary indexes."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def make_records(self):
+        return {
+            "1": make_sample_record(1, year=2012, authors=("Einstein, A.", "Bohr, N."),
+                                    texkeys=["Einstein:2012ab"], eprint="1201.00001"),
+            "2": make_sample_record(2, year=2016, authors=("Einstein, B.",),
+                                    texkeys=["Einstein:2016xy", "Einstein:2016alt"], eprint="hep-th/0601001"),
+            "3": make_sample_record(3, year=2020, authors=("Ling, W.",), texkeys=["Ling:2020aa"]),
+            "4": make_sample_record(4, year=1965, authors=("Bohr, N.",), texkeys=[]),
+        }
+
+    def test_lookups_follow_record_writes(self):
+        import datetime
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        import paper_tools.pipe_usage as pu
+        db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False,
+                                                 track_indexes=True)
+        db.record.setitem_batched(self.make_records())
+        index = db.indexes
+        self.assertEqual(len(index), 4)
+
+        self.assertEqual(index.created_between(), ["4", "1", "2", "3"])
+        self.assertEqual(index.created_between(datetime.datetime(2015, 1, 1), "2020-06-01T00:00:00+00:00"),
+                         ["2", "3"])
+        self.assertEqual(set(index.created_between(after=datetime.datetime(2015, 1, 1))),
+                         set(db.record.items() | pu.filter_after(2015, 1, 1) | pu.get_id))
+        self.assertEqual(index.created_between(before=datetime.datetime(1970, 1, 1)), ["4"])
+
+        self.assertEqual(index.by_author("BOHR, N."), ["1", "4"])
+        self.assertEqual(index.by_author("einstein", prefix=True), ["1", "2"])
+        self.assertEqual(index.by_author("einstein"), [])
+        self.assertEqual(index.by_texkey(["Einstein:2016alt", "Ling:2020aa", "Nobody:2000"]),
+                         {"Einstein:2016alt": "2", "Ling:2020aa": "3"})
+        self.assertEqual(index.by_arxiv(["arXiv:1201.00001v3", "hep-th/0601001", "9999.99999"]),
+                         {"arXiv:1201.00001v3": "1", "hep-th/0601001": "2"})
+
+        # Overwrites replace the old keys
+        db.record["2"] = make_sample_record(2, year=2021, authors=("Ling, W.",), texkeys=["Ling:2021zz"])
+        self.assertEqual(index.by_texkey(["Einstein:2016xy", "Ling:2021zz"]), {"Ling:2021zz": "2"})
+        self.assertEqual(index.by_author("ling, w."), ["2", "3"])
+        self.assertEqual(index.created_between(after="2020-01-01"), ["3", "2"])
+        self.assertEqual(index.by_arxiv(["hep-th/0601001"]), {})
+
+        index.remove(["3"])
+        self.assertEqual(index.by_author("ling, w."), ["2"])
+
+    def test_indexes_built_for_existing_records(self):
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False)
+        db.record.setitem_batched(self.make_records())
+        self.assertIsNone(db.indexes)
+        index = db.open_indexes()
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.by_texkey(["Einstein:2012ab"]), {"Einstein:2012ab": "1"})
+        self.assertEqual(index.created_between("2016-01-01", "2016-12-31"), ["2"])
+
+
+class TestSharedEnvironmentDatabase(unittest.TestCase):
+    """Tests for InspireHEPDatabase with every store in one environment."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_atomic_multi_store_writes(self):
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        with inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False,
+                                                 shared_env=True, track_citations=True, track_columns=True,
+                                                 track_indexes=True) as db:
+            with db.write_txn() as txn:
+                record = make_sample_record(1, year=2012, refs=["2"], texkeys=["A:2012ab"])
+                db.record.setitem_batched({"1": record}, txn=txn)
+                db.bibtex.setitem_batched({"1": "@article{A:2012ab}"}, txn=txn)
+                db.embedding.setitem_batched({"1": np.ones(4, dtype=np.float16)}, txn=txn)
+            with self.assertRaises(RuntimeError):
+                with db.write_txn() as txn:
+                    db.record.setitem_batched({"3": make_sample_record(3, refs=["1"], texkeys=["C:2013ab"])},
+                                              txn=txn)
+                    db.bibtex.setitem_batched({"3": "@article{C:2013ab}"}, txn=txn)
+                    raise RuntimeError("embedding failed")
+            self.assertEqual((len(db.record), len(db.bibtex), len(db.embedding)), (1, 1, 1))
+            # Index updates were part of the same transactions
+            self.assertEqual(db.citation.references("1"), ["2"])
+            self.assertNotIn("3", db.citation)
+            self.assertEqual(db.indexes.by_texkey(["A:2012ab", "C:2013ab"]), {"A:2012ab": "1"})
+            self.assertEqual(db.columns.columns().ids.tolist(), ["1"])
+        self.assertEqual(os.listdir(self.tmpdir), [inspirehep_tools.InspireHEPDatabase.SHARED_NAME])
+
+        with inspirehep_tools.InspireHEPDatabase(self.tmpdir, shared_env=True) as db:
+            with db.read_txn() as txn:
+                self.assertEqual(db.record.get("1", txn=txn)["id"], "1")
+                self.assertEqual(db.bibtex.getitem_batched(["1", "3"], txn=txn), {"1": "@article{A:2012ab}"})
+            self.assertEqual(db.open_indexes().by_texkey(["A:2012ab"]), {"A:2012ab": "1"})
+            self.assertEqual(db.query().filter_by_year(2012).ids(), ["1"])
+            with self.assertRaises(Exception):
+                with db.write_txn():
+                    pass
+
+    def test_requires_shared_env(self):
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        with inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False) as db:
+            with self.assertRaises(Exception):
+                with db.read_txn():
+                    pass
+
+
+class TestBibliographyResolution(unittest.TestCase):
+    """Tests for resolving cite keys against the texkey index and INSPIRE-HEP."""
+
+    class FakeClient:
+        def __init__(self, remote):
+            self.remote = remote  # id -> (texkeys, bibtex)
+            self.texkey_calls = []
+            self.bibtex_calls = []
+        def get_id_by_texkey(self, texkeys, max_results=50):
+            self.texkey_calls.append(list(texkeys))
+            return {key: rec_id for rec_id, (keys, _) in self.remote.items() if set(keys) & set(texkeys) for key in keys}
+        def get_bibtex_batched(self, ids, max_results=100):
+            self.bibtex_calls.append(list(ids))
+            return [self.remote[i][1] for i in ids if i in self.remote]
+
+    def setUp(self):
+        import paper_tools.inspirehep_tools as inspirehep_tools
+        self.module = inspirehep_tools
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = inspirehep_tools.InspireHEPDatabase(self.tmpdir, map_size=2**26, readonly=False,
+                                                      track_indexes=True)
+        self.db.record.setitem_batched({
+            "1": make_sample_record(1, texkeys=["Local:2012ab"]),
+            "2": make_sample_record(2, texkeys=["Local:2016xy", "Local:2016alt"]),
+        })
+        self.db.bibtex.setitem_batched({"1": "@article{Local:2012ab,\n  title={One}\n}\n"})
+        self.client = self.FakeClient({
+            "2": (["Local:2016xy", "Local:2016alt"], "@article{Local:2016xy,\n  title={Two}\n}"),
+            "7": (["Remote:2020aa", "Remote:2020alias"], "@article{Remote:2020aa,\n  title={Seven}\n}"),
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_resolve_texkeys_requests_only_misses(self):
+        resolved = self.module.resolve_texkeys(["Local:2012ab", "Remote:2020alias", "Nobody:2000"],
+                                               db=self.db, client=self.client)
+        self.assertEqual(resolved, {"Local:2012ab": "1", "Remote:2020alias": "7"})
+        self.assertEqual(self.client.texkey_calls, [["Remote:2020alias", "Nobody:2000"]])
+
+    def test_resolve_texkeys_chunks(self):
+        keys = ["Missing:{}".format(i) for i in range(5)] + ["Remote:2020aa"]
+        resolved = self.module.resolve_texkeys(keys, client=self.client, max_results=2, workers=3)
+        self.assertEqual(resolved, {"Remote:2020aa": "7"})
+        self.assertEqual(sorted(len(c) for c in self.client.texkey_calls), [2, 2, 2])
+
+    def test_write_bibliography(self):
+        path = os.path.join(self.tmpdir, "paper.bib")
+        missing = self.module.write_bibliography(["Remote:2020alias", "Local:2012ab", "Local:2016alt", "Nobody:2000"],
+                                                 path, db=self.db, client=self.client)
+        self.assertEqual(missing, ["Nobody:2000"])
+        with open(path) as f:
+            entries = f.read().split("\n@")
+        self.assertEqual([self.module.bibtex_key(("@" if i else "") + e) for i, e in enumerate(entries)],
+                         ["Remote:2020alias", "Local:2012ab", "Local:2016alt"])
+        # Only the BibTeX missing from the database was requested, and it is now cached
+        self.assertEqual(sorted(i for call in self.client.bibtex_calls for i in call), ["2", "7"])
+        self.assertIn("title={Two}", self.db.bibtex["2"])
+        self.assertIn("title={Seven}", self.db.bibtex["7"])
+
+    def test_fetch_bibtex_without_database(self):
+        entries = self.module.fetch_bibtex(["Remote:2020aa"], client=self.client)
+        self.assertEqual(entries, {"Remote:2020aa": "@article{Remote:2020aa,\n  title={Seven}\n}\n"})
+
+    def test_failed_chunk_reported_as_missing(self):
+        client = self.FakeClient({})
+        def fail(texkeys, max_results=50):
+            raise ConnectionError("offline")
+        client.get_id_by_texkey = fail
+        self.assertEqual(self.module.resolve_texkeys(["Local:2016xy", "Remote:2020aa"], db=self.db, client=client),
+                         {"Local:2016xy": "2"})
+
+
 # ============================================================================
 # Bug detection tests (affirmative tests for known bugs)
 # ============================================================================